@@ -12,11 +12,17 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+# numpy 2 removed trapz
+_trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+
 class PID:
-    def __init__(self, K, this_many, this_old):
+    def __init__(self, K, this_many, this_old, *, i_limit=None):
         self.K = K
         self.this_many = this_many
         self.this_old = this_old
+        # anti-windup: clamp the (weighted) I term to [-i_limit, i_limit]
+        self.i_limit = i_limit
         self.e = []
         logger.debug(f"{K}, keep {this_many}, expire in {this_old}s")
 
@@ -24,8 +30,11 @@ class PID:
     def get_weighted_sum(self, error, *, now=None):
         #return np.dot(self.K, self.update(error, now=now))
         X = self.update(error, now=now)
-        logger.debug(f"{self.K[0]*X[0]:.4f} + {self.K[1]*X[1]:.4f} + {self.K[2]*X[2]:.4f}")
-        return np.dot(self.K, X)
+        terms = [self.K[0]*X[0], self.K[1]*X[1], self.K[2]*X[2], ]
+        if self.i_limit is not None:
+            terms[1] = min(self.i_limit, max(-self.i_limit, terms[1]))
+        logger.debug(f"{terms[0]:.4f} + {terms[1]:.4f} + {terms[2]:.4f}")
+        return sum(terms)
 
     # keeping the three numbers before weighting and summation for
     # simulation use
@@ -39,7 +48,7 @@ class PID:
             # have the memory to keep multiple samples, why not use them
             # all instead of just the most recent two.
             x,y = zip(*self.e)
-            ei = np.trapz(y, x=x)
+            ei = _trapezoid(y, x=x)
             ed = np.polyfit(x, y, 1)[0]
             r = (error, ei, ed, )
         else:
@@ -67,6 +76,129 @@ class PID:
         # keep the most recent estimate. By hey compute is free.
 
 
+class RingPID(PID):
+    """Same numbers as PID (to rounding), but each update is O(1) and
+    allocates nothing, whatever this_many is.
+
+    The history is a fixed-size ring buffer (two NumPy arrays), and
+    what I and D need is kept as running sums, updated as samples come
+    in and go out:
+
+        I = trapezoid  = sum of (t[k+1] - t[k])*(e[k] + e[k+1])/2
+        D = LSQ slope  = (n*Ste - St*Se)/(n*Stt - St**2)
+
+    Times are stored relative to an origin (re-centering), otherwise
+    Stt with t ~ 1.6e9 leaves no digits for the slope. Every this_many
+    updates (or when the origin gets far from the window) the sums are
+    recomputed from the buffer and the origin moved to the oldest
+    sample, so add/subtract rounding can't pile up. Amortized that's
+    still O(1).
+
+    Assumes the samples come in time order (they do: time.time(), or
+    the simulation's clock). PID filters by age anywhere in the
+    history; this only drops from the old end.
+    """
+    def __init__(self, K, this_many, this_old, *, i_limit=None):
+        super().__init__(K, this_many, this_old, i_limit=i_limit)
+        assert this_many >= 1
+        self._t = np.zeros(this_many)
+        self._e = np.zeros(this_many)
+        self._head = 0          # oldest
+        self._n = 0
+        self._origin = None
+        self._since_refresh = 0
+        self._clear_sums()
+
+    def _clear_sums(self):
+        self._st = self._se = self._stt = self._ste = self._trap = 0.0
+
+    @property
+    def e(self):
+        # PID's list of (t, e), oldest first. Not on the hot path.
+        idx = (self._head + np.arange(self._n)) % self.this_many
+        return [(float(t) + self._origin, float(e), ) for t,e in zip(self._t[idx], self._e[idx])]
+
+    @e.setter
+    def e(self, v):
+        # PID.__init__ sets it to []
+        assert not len(v)
+
+    def update(self, error, *, now=None):
+        now = time.time() if now is None else now
+        if self._origin is None:
+            self._origin = now
+        t = now - self._origin
+
+        if self._n == self.this_many:
+            self._pop()
+        if self._n:
+            last = (self._head + self._n - 1) % self.this_many
+            self._trap += 0.5*(t - float(self._t[last]))*(float(self._e[last]) + error)
+        i = (self._head + self._n) % self.this_many
+        self._t[i] = t
+        self._e[i] = error
+        self._n += 1
+        self._st += t
+        self._se += error
+        self._stt += t*t
+        self._ste += t*error
+
+        self._housekeeping(now=now)
+
+        self._since_refresh += 1
+        oldest = float(self._t[self._head])
+        if self._since_refresh >= self.this_many or abs(oldest) > 8*max(t - oldest, 1.0):
+            self._refresh()
+
+        if self._n >= 2:
+            n = self._n
+            denominator = n*self._stt - self._st*self._st
+            ed = (n*self._ste - self._st*self._se)/denominator if denominator > 0 else 0.0
+            return (error, self._trap, ed, )
+        return (error, 0, 0, )
+
+    def _pop(self):
+        i = self._head
+        t,e = float(self._t[i]), float(self._e[i])
+        if self._n >= 2:
+            j = (i + 1) % self.this_many
+            self._trap -= 0.5*(float(self._t[j]) - t)*(e + float(self._e[j]))
+        self._st -= t
+        self._se -= e
+        self._stt -= t*t
+        self._ste -= t*e
+        self._head = (i + 1) % self.this_many
+        self._n -= 1
+
+    def _housekeeping(self, *, now=None):
+        # "Discard records if: too old" (too many is taken care of by
+        # the size of the ring)
+        now = time.time() if now is None else now
+        t = now - self._origin
+        while self._n and t - self._t[self._head] > self.this_old:
+            self._pop()
+
+    def _refresh(self):
+        """Recompute the sums from the buffer, with the oldest sample as
+        the new origin."""
+        self._since_refresh = 0
+        if not self._n:
+            self._origin = None
+            self._clear_sums()
+            return
+        idx = (self._head + np.arange(self._n)) % self.this_many
+        t = self._t[idx]
+        t -= t[0]
+        self._origin += float(self._t[self._head])
+        self._t[idx] = t
+        e = self._e[idx]
+        self._st = float(t.sum())
+        self._se = float(e.sum())
+        self._stt = float(np.dot(t, t))
+        self._ste = float(np.dot(t, e))
+        self._trap = float(_trapezoid(e, x=t)) if self._n >= 2 else 0.0
+
+
 if '__main__' == __name__:
 
     import matplotlib.pyplot as plt
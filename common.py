@@ -1,81 +1,451 @@
-import logging, configparser, time, sys, pika, csv, sqlite3, os, json, redis, socket, calendar
-from datetime import datetime, timedelta
+import logging, configparser, time, sys, sqlite3, os, json, redis, socket, calendar, threading, atexit, re, contextvars, asyncio
+from datetime import datetime
+from collections import deque
 from socket import gethostname
 from xmlrpc.client import ServerProxy
 sys.path.append('/home/pi')
-from cred import cred
-import RPi.GPIO as GPIO
 from zlib import crc32
-import numpy as np
+from temperature_profile import ProfileIndex, ingest_csv, INTERPOLATION_METHODS
+import records
+# pika, RPi.GPIO and cred are imported where they're used: most of the
+# daemons never touch them, and on a Pi Zero every import counts when
+# the whole rack boots at once after a power cut.
 
 
 logger = logging.getLogger(__name__)
+# One pool for the whole process. Anything that talks to the local
+# redis should go through redis_server (or get_redis()) rather than
+# making a client of its own.
+_redis_pool = redis.ConnectionPool(host='localhost', port=6379, db=0)
+redis_server = redis.StrictRedis(connection_pool=_redis_pool)
+
+
+def get_redis():
+    return redis_server
+
+
+# Supervisor mode (see supervisor.py): many tanks in one process, one
+# event loop. Each tank's coroutines run with that tank as the current
+# tank -- a context variable, so the asyncio tasks it spawns inherit it
+# -- and anything per tank (redis keys, config section, profile, records
+# tables, probes, valves) is looked up through it. With no current tank
+# (one tank per Pi, as usual) all the names are what they always were.
+class Tank:
+    def __init__(self, name, *, profile=None, pins=None, probes=None, valve_server=None, threads=True):
+        # it ends up in redis keys and in table names
+        assert re.fullmatch(r'[A-Za-z0-9_]+', name), f"invalid tank name {name}"
+        self.name = name
+        self.key_prefix = f"{name}:"
+        self.table_prefix = f"{name}_"
+        self.section = f"tank.{name}"
+        self.profile = profile
+        # valve -> BCM pin; None: valve_server._valve_pin_map
+        self.pins = pins
+        # DS18B20 serial numbers; None: all of them
+        self.probes = probes
+        # anything with set_valves/valve_on/valve_off; None: XML-RPC
+        self.valve_server = valve_server
+        # run_blocking() in threads; False: inline (the simulator)
+        self.threads = threads
+        self.singletons = {}
+
+    def __repr__(self):
+        return f"Tank({self.name})"
+
+
+_current_tank = contextvars.ContextVar('tank', default=None)
+_singletons = {}
+
+
+def current_tank():
+    return _current_tank.get()
+
+
+def use_tank(tank):
+    """Make "tank" the current tank for the rest of this task (and any
+    task it creates from now on)."""
+    _current_tank.set(tank)
+
+
+def tank_key(k):
+    """Redis key (or channel) k for the current tank."""
+    tank = _current_tank.get()
+    return k if tank is None else tank.key_prefix + k
+
+
+def tank_table(name):
+    """records.db table "name" for the current tank."""
+    tank = _current_tank.get()
+    return name if tank is None else tank.table_prefix + name
+
+
+def per_tank(name, factory):
+    """The current tank's "name", made with factory() the first time."""
+    tank = _current_tank.get()
+    d = _singletons if tank is None else tank.singletons
+    if name not in d:
+        d[name] = factory()
+    return d[name]
+
+
+async def run_blocking(f, *args, **kwargs):
+    """f(*args, **kwargs) off the event loop, for whatever blocks: probe
+    reads (~750 ms), valve ops (XML-RPC, or the GPIO itself in
+    supervisor mode). The other tasks, and tanks, keep going. The
+    current tank goes along (asyncio.to_thread copies the context).
+
+    Inline for a Tank(..., threads=False): the simulator, whose probes
+    and valves are instant and whose clock doesn't wait for threads."""
+    tank = _current_tank.get()
+    if tank is not None and not tank.threads:
+        return f(*args, **kwargs)
+    return await asyncio.to_thread(f, *args, **kwargs)
+
+
+# bumped by the web app whenever a reference temperature is logged
+USERLOG_REVISION_KEY = 'userlog_revision'
+# current "deployed"/"maintenance", and where changes are announced
+TANK_STATUS_KEY = 'tank_status'
+TANK_STATUS_CHANNEL = 'tank_status'
 
 
 # hindsight: configuration changes over time, so really the
 # configuration parameters are time series, and should have been
 # snapshotted into a database.
-def get_configuration(key, *, default=None):
-    config = configparser.ConfigParser()
-    config.read('/var/www/html/config/config.txt')
-    for section in config:
+class ConfigurationStore:
+    """Parsed config.txt kept in memory, re-read only when the file
+    changes (different inode, mtime or size). Replacing the file
+    (upload, editor writing a new copy) and in-place edits both count,
+    so live edits still apply on the next call, same as before.
+
+    One stat() per lookup instead of open + parse per lookup.
+
+    [tank.<name>] sections belong to that tank (supervisor mode): they
+    are left out of the flattened view, and a lookup with section= tries
+    that section first.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self._signature = None
+        self._values = {}
+        self._sections = {}
+        self._typed = {}
+
+    def _stat(self):
         try:
-            return config[section][key]
+            st = os.stat(self.fn)
+            return st.st_ino, st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def refresh(self, *, force=False):
+        signature = self._stat()
+        if not force and signature == self._signature:
+            return False
+        config = configparser.ConfigParser()
+        config.read(self.fn)
+        # first hit wins, same order as iterating over the sections
+        values = {}
+        sections = {}
+        for section in config:
+            if section.startswith('tank.'):
+                sections[section] = dict(config[section].items())
+                continue
+            for k,v in config[section].items():
+                values.setdefault(k, v)
+        self._values = values
+        self._sections = sections
+        self._typed = {}
+        self._signature = signature
+        logger.debug(f"(re)loaded {self.fn}: {len(values)} keys")
+        return True
+
+    def get(self, key, *, default=None, cast=None, section=None):
+        self.refresh()
+        # configparser lowercases the keys
+        key = key.lower()
+        values = self._sections.get(section, {})
+        if key not in values:
+            section = None
+            values = self._values
+        if key not in values:
+            return default
+        if cast is None:
+            return values[key]
+        try:
+            return self._typed[(section, key, cast)]
         except KeyError:
-            pass
-    return default
+            v = cast(values[key])
+            self._typed[(section, key, cast)] = v
+            return v
 
+    def sections(self):
+        """The [tank.<name>] sections, as {section:{key:value}}."""
+        self.refresh()
+        return {section:dict(values) for section,values in self._sections.items()}
 
-def get_probe_offset():
-    calibration_sample_size = max(0, int(get_configuration('calibration_sample_size', default=0)))
-    if calibration_sample_size <= 0:
-        logger.info('calibration_sample_size <= 0, invalid, or undefined; default to 0')
-        return 0
-    
-    with sqlite3.connect('/var/www/html/records.db') as conn:
-        cur = conn.cursor()
+
+_config_store = ConfigurationStore('/var/www/html/config/config.txt')
+
+
+def get_config_store():
+    """The ConfigurationStore behind get_configuration(), for what it
+    doesn't cover (sections())."""
+    return _config_store
+
+
+def get_configuration(key, *, default=None, cast=None):
+    """cast (e.g. int, float) is applied once per config.txt revision,
+    not once per call. default is returned as-is (not cast). The current
+    tank's section, if any, comes first."""
+    tank = _current_tank.get()
+    return _config_store.get(key, default=default, cast=cast, section=None if tank is None else tank.section)
+
+
+class CalibrationOffset:
+    """Mean of the latest N (tref - t0) residuals from userlog, N being
+    calibration_sample_size.
+
+    The residuals are kept in memory. The web app bumps the
+    USERLOG_REVISION_KEY counter in redis whenever it records a tref, so
+    on most calls this is one redis GET and no SQLite at all. New rows
+    are fetched incrementally (by rowid); a change of N, or a long time
+    without a refresh, triggers a full re-read.
+    """
+    def __init__(self, dbfn=records.RECORDS_DB, *, max_age_second=600):
+        self.dbfn = dbfn
+        self.max_age_second = max_age_second
+        self._n = None
+        self._revision = None
+        self._residuals = deque()
+        self._last_rowid = 0
+        self._refreshed = 0
+
+    def _revision_now(self):
         try:
-            # requirement: t0 is before-correction!
-            cur.execute("""SELECT AVG(haha) FROM
-                            (SELECT tref - t0 AS haha
-                            FROM userlog
-                            WHERE t0 is not NULL
-                            AND tref is not NULL
-                            ORDER BY ts DESC
-                            LIMIT ?)""", (calibration_sample_size, ))
-            tmp = cur.fetchone()
-            if tmp is not None:
-                return tmp[0]
+            return redis_server.get(tank_key(USERLOG_REVISION_KEY))
+        except redis.exceptions.RedisError:
+            logger.warning('redis unavailable; re-reading userlog')
+            return object()     # != anything cached
+
+    def _fetch(self, *, full):
+        with records.connect(self.dbfn) as conn:
+            cur = conn.cursor()
+            userlog = tank_table('userlog')
+            if full:
+                cur.execute(f"""SELECT rowid,haha FROM
+                                (SELECT rowid, ts, tref - t0 AS haha
+                                FROM {userlog}
+                                WHERE t0 is not NULL
+                                AND tref is not NULL
+                                ORDER BY ts DESC
+                                LIMIT ?)
+                                ORDER BY ts""", (self._n, ))
+                self._residuals = deque(maxlen=self._n)
+            else:
+                cur.execute(f"""SELECT rowid, tref - t0
+                                FROM {userlog}
+                                WHERE rowid > ?
+                                AND t0 is not NULL
+                                AND tref is not NULL
+                                ORDER BY ts""", (self._last_rowid, ))
+            for rowid,residual in cur.fetchall():
+                self._residuals.append(residual)
+                self._last_rowid = max(self._last_rowid, rowid)
+            if full:
+                cur.execute(f"""SELECT MAX(rowid) FROM {userlog}""")
+                self._last_rowid = cur.fetchone()[0] or 0
+
+    def get(self):
+        n = max(0, get_configuration('calibration_sample_size', default=0, cast=int))
+        if n <= 0:
+            logger.info('calibration_sample_size <= 0, invalid, or undefined; default to 0')
+            self._n = None
+            return 0
+
+        revision = self._revision_now()
+        full = n != self._n or time.time() - self._refreshed > self.max_age_second
+        if full or revision != self._revision:
+            self._n = n
+            try:
+                # requirement: t0 is before-correction!
+                self._fetch(full=full)
+                self._revision = revision
+                self._refreshed = time.time()
+            except sqlite3.OperationalError:
+                logger.warning('probably a missing userlog table (i.e. no user log and thus no cal data yet. default to 0)')
+                self._n = None
+                return 0
+
+        if not len(self._residuals):
             logger.warning('no probe cal data. default to 0')
-        except sqlite3.OperationalError:
-            logger.warning('probably a missing userlog table (i.e. no user log and thus no cal data yet. default to 0)')
-        return 0
+            return 0
+        return sum(self._residuals)/len(self._residuals)
+
+
+def get_probe_offset():
+    return per_tank('calibration_offset', CalibrationOffset).get()
+
+
+CALIBRATION_MODES = ('none', 'offset', 'gain', )
+
+
+class ProbeCalibration:
+    """Per-probe correction, tref = a + b*t, fitted to the latest N
+    probe_log entries of each probe (N being
+    probe_calibration_sample_size, default calibration_sample_size).
+
+    probe_calibration in config.txt picks the model:
+
+        none      no per-probe correction (the tank-wide c0 only)
+        offset    b = 1, a = mean(tref - t) (default)
+        gain      least squares a and b. A probe whose log doesn't span
+                  more than GAIN_MIN_SPAN_CELSIUS, has fewer than 3
+                  entries, or comes out with a gain outside GAIN_LIMITS
+                  gets the offset fit instead: a gain from a few points
+                  at the same temperature is noise.
+
+    All probes are fitted at once (sums per probe with np.bincount), and
+    only when probe_log has grown: the USERLOG_REVISION_KEY counter says
+    when to look, MAX(rowid) whether there's anything new. As with
+    CalibrationOffset, a long time without a refresh re-reads anyway.
+    """
+    GAIN_MIN_SPAN_CELSIUS = 0.5
+    GAIN_LIMITS = (0.9, 1.1)
+
+    def __init__(self, dbfn=records.RECORDS_DB, *, max_age_second=600):
+        self.dbfn = dbfn
+        self.max_age_second = max_age_second
+        self._settings = None
+        self._revision = None
+        self._last_rowid = None
+        self._refreshed = 0
+        self._fit = {}
+
+    _revision_now = CalibrationOffset._revision_now
+
+    def _fetch(self, n):
+        with records.connect(self.dbfn) as conn:
+            cur = conn.cursor()
+            probe_log = tank_table('probe_log')
+            cur.execute(f"""SELECT MAX(rowid) FROM {probe_log}""")
+            last_rowid = cur.fetchone()[0] or 0
+            if last_rowid == self._last_rowid:
+                return None, last_rowid
+            cur.execute(f"""SELECT probe_id, t, tref FROM
+                            (SELECT probe_id, t, tref,
+                            ROW_NUMBER() OVER (PARTITION BY probe_id ORDER BY ts DESC) AS k
+                            FROM {probe_log}
+                            WHERE t is not NULL
+                            AND tref is not NULL)
+                            WHERE k <= ?""", (n, ))
+            return cur.fetchall(), last_rowid
+
+    @classmethod
+    def fit(cls, rows, mode='offset'):
+        """{probe_id: (a, b)} from [(probe_id, t, tref), ...]."""
+        import numpy as np
+        rows = [r for r in rows if r[1] == r[1] and r[2] == r[2]]
+        if 'none' == mode or not len(rows):
+            return {}
+        ids, inverse = np.unique([r[0] for r in rows], return_inverse=True)
+        t = np.array([r[1] for r in rows], dtype=float)
+        tref = np.array([r[2] for r in rows], dtype=float)
+        n = np.bincount(inverse, minlength=len(ids)).astype(float)
+        mean_t = np.bincount(inverse, t, len(ids))/n
+        mean_tref = np.bincount(inverse, tref, len(ids))/n
+        a = mean_tref - mean_t
+        b = np.ones(len(ids))
+        if 'gain' == mode:
+            # centered per probe, so the sums don't lose the digits
+            dt = t - mean_t[inverse]
+            sxx = np.bincount(inverse, dt*dt, len(ids))
+            sxy = np.bincount(inverse, dt*(tref - mean_tref[inverse]), len(ids))
+            span = np.full(len(ids), -np.inf)
+            np.maximum.at(span, inverse, dt)
+            low = np.full(len(ids), np.inf)
+            np.minimum.at(low, inverse, dt)
+            span -= low
+            with np.errstate(divide='ignore', invalid='ignore'):
+                gain = sxy/sxx
+            ok = (n >= 3) & (span > cls.GAIN_MIN_SPAN_CELSIUS) & (gain >= cls.GAIN_LIMITS[0]) & (gain <= cls.GAIN_LIMITS[1])
+            b = np.where(ok, gain, 1.0)
+            a = mean_tref - b*mean_t
+        return {str(k):(float(a_), float(b_)) for k,a_,b_ in zip(ids, a, b)}
+
+    def get(self):
+        mode = get_configuration('probe_calibration', default='offset')
+        if mode not in CALIBRATION_MODES:
+            logger.error(f"unknown probe_calibration {mode}; using offset")
+            mode = 'offset'
+        n = get_configuration('probe_calibration_sample_size', default=None, cast=int)
+        if n is None:
+            n = get_configuration('calibration_sample_size', default=0, cast=int)
+        if 'none' == mode or n <= 0:
+            self._settings = None
+            return {}
+
+        revision = self._revision_now()
+        settings = (mode, n)
+        stale = settings != self._settings or time.time() - self._refreshed > self.max_age_second
+        if stale or revision != self._revision:
+            try:
+                if stale:
+                    self._last_rowid = None
+                rows, last_rowid = self._fetch(n)
+                if rows is not None:
+                    self._fit = self.fit(rows, mode)
+                    logger.info(f"probe calibration ({mode}, {n}): {self._fit}")
+                self._settings = settings
+                self._revision = revision
+                self._last_rowid = last_rowid
+                self._refreshed = time.time()
+            except sqlite3.OperationalError:
+                logger.warning('probably a missing probe_log table (no per-probe cal data yet)')
+                self._settings = None
+                self._fit = {}
+        return self._fit
+
+
+def get_probe_calibration():
+    """{probe_id: (a, b)}: corrected = a + b*t. Probes not in there get
+    the tank-wide get_probe_offset() instead."""
+    return per_tank('probe_calibration', ProbeCalibration).get()
 
 
 def add_operation_entry(event, message):
-    with sqlite3.connect('/var/www/html/records.db') as conn:
-        cur = conn.cursor()
-        cur.execute(f"""CREATE TABLE IF NOT EXISTS operation (
-                        'ts' REAL NOT NULL,
-                        'dt' TEXT NOT NULL,
-                        'e' TEXT NOT NULL,
-                        'm' TEXT NOT NULL
-                        )""")
-        now = int(time.time())
-        nowdt = str(datetime.now())[:19]
-        cur.execute(f"""INSERT OR IGNORE INTO operation ('ts','dt','e','m') VALUES (?,?,?,?)""",
-                    (now, nowdt, event, message, ))
+    """Queued to the records.db writer (see records.py). Returns a Future
+    if you need to know when it's on disk."""
+    now = int(time.time())
+    nowdt = str(datetime.now())[:19]
+    return records.enqueue(f"""INSERT OR IGNORE INTO {tank_table('operation')} ('ts','dt','e','m') VALUES (?,?,?,?)""",
+                           (now, nowdt, event, message, ))
 
 
 def set_tank_status(status):
     assert status in {'deployed', 'maintenance', }
-    add_operation_entry('tank_status_change', status)
-
-
-def get_tank_status():
-    with sqlite3.connect('/var/www/html/records.db') as conn:
+    # records.db keeps the history; redis has the current value for
+    # everyone else, and the publish tells the readers to drop their
+    # cached copy.
+    written = add_operation_entry('tank_status_change', status)
+    try:
+        pipe = redis_server.pipeline(transaction=True)
+        pipe.set(tank_key(TANK_STATUS_KEY), status)
+        pipe.publish(tank_key(TANK_STATUS_CHANNEL), status)
+        pipe.execute()
+        # this process sees it right away, not when the publish comes
+        # back around (the web app reads it back in the same request)
+        _tank_status_cache.put(status)
+    except redis.exceptions.RedisError:
+        logger.exception('tank_status not published; readers fall back to records.db')
+        written.result(timeout=10)
+        _tank_status_cache.invalidate()
+
+
+def _read_tank_status_from_db():
+    with records.connect() as conn:
         cur = conn.cursor()
-        cur.execute("""SELECT m FROM operation
+        cur.execute(f"""SELECT m FROM {tank_table('operation')}
                         WHERE `e`=='tank_status_change'
                         ORDER BY `rowid` DESC LIMIT 1""")
         tmp = cur.fetchone()
@@ -88,39 +458,134 @@ def get_tank_status():
             return tmp
 
 
-def set_valve_pwm(tank_state, *, p=1.0, ex=3600):
+class TankStatusCache:
+    """The current tank_status, cached in-process.
+
+    The cached value is dropped when set_tank_status() publishes on
+    TANK_STATUS_CHANNEL (checked without blocking on every get()), so a
+    mode switch shows up on the very next call instead of costing a
+    SQLite open on every call. set_tank_status() in this process updates
+    it directly. The redis key is the source; records.db
+    is the fallback if the key is missing (redis restarted, first boot
+    after the upgrade) or redis is down.
+
+    One subscription covers every tank in the process (supervisor mode);
+    the cache is per tank.
+    """
+    def __init__(self):
+        self._status = {}
+        self._pubsub = None
+        self._lock = threading.Lock()
+
+    def invalidate(self, prefix=None):
+        """Drop one tank's cached status (by key prefix), or everyone's."""
+        if prefix is None:
+            self._status = {}
+        else:
+            self._status.pop(prefix, None)
+
+    def put(self, status):
+        """The current tank's status, as just set in this process."""
+        with self._lock:
+            if self._poll():
+                self._status[tank_key('')] = status
+            else:
+                self._status = {}
+
+    def _poll(self):
+        try:
+            if self._pubsub is None:
+                # subscribe before reading, so no change slips in between
+                self._pubsub = redis_server.pubsub(ignore_subscribe_messages=True)
+                self._pubsub.subscribe(TANK_STATUS_CHANNEL)
+                self._pubsub.psubscribe(f"*:{TANK_STATUS_CHANNEL}")
+                self._status = {}
+            while True:
+                m = self._pubsub.get_message()
+                if m is None:
+                    break
+                channel = m['channel'].decode()
+                self._status.pop(channel[:-len(TANK_STATUS_CHANNEL)], None)
+            return True
+        except redis.exceptions.RedisError:
+            self._pubsub = None
+            self._status = {}
+            return False
+
+    def get(self):
+        prefix = tank_key('')
+        with self._lock:
+            subscribed = self._poll()
+            if prefix in self._status:
+                return self._status[prefix]
+
+            status = None
+            if subscribed:
+                try:
+                    status = redis_server.get(tank_key(TANK_STATUS_KEY))
+                    if status is not None:
+                        status = status.decode()
+                except redis.exceptions.RedisError:
+                    subscribed = False
+            if status not in {'deployed', 'maintenance'}:
+                status = _read_tank_status_from_db()
+                if subscribed:
+                    # materialize it for next time (and for everyone else)
+                    redis_server.set(tank_key(TANK_STATUS_KEY), status, nx=True)
+            if subscribed:
+                # without the subscription there's no one to tell us
+                # when this goes stale
+                self._status[prefix] = status
+            return status
+
+
+_tank_status_cache = TankStatusCache()
+
+
+def get_tank_status():
+    return _tank_status_cache.get()
+
+
+def invalidate_tank_status(prefix=None):
+    """For whoever learns of a tank_status change first (eztank's
+    EventHub): the next get_tank_status() reads it afresh."""
+    _tank_status_cache.invalidate(prefix)
+
+
+# tank_state -> the one valve that's open
+VALVE_BY_TANK_STATE = {'neutral':None, 'heating':'hot', 'cooling':'cold', 'flush':'ambient', }
+
+
+def set_valve_pwm(tank_state, *, p=1.0, ex=3600, state_ex=None):
+    """Write pwm_hot, pwm_cold and pwm_ambient in one MULTI/EXEC, so the
+    PWM tender never sees a half-updated set (say hot already at 1 while
+    cold is still at 1).
+
+    p=None deletes the three keys instead (this disables the PWM valve
+    controller). If state_ex is given, tank_state is written in the same
+    transaction with that TTL.
+    """
     assert p is None or (p >= 0 and p <= 1)
     assert type(ex) is int
-    
-    redis_server = redis.StrictRedis(host='localhost', port=6379, db=0)
 
+    if tank_state not in VALVE_BY_TANK_STATE:
+        logger.error(f"unknown tank_state {tank_state}")
+        return
+
+    pipe = redis_server.pipeline(transaction=True)
     if p is not None:
-        if tank_state == 'neutral':
-            redis_server.set(f"pwm_hot", json.dumps(0), ex=ex)
-            redis_server.set(f"pwm_cold", json.dumps(0), ex=ex)
-            redis_server.set(f"pwm_ambient", json.dumps(0), ex=ex)
-        elif tank_state == 'heating':
-            redis_server.set(f"pwm_hot", json.dumps(p), ex=ex)
-            redis_server.set(f"pwm_cold", json.dumps(0), ex=ex)
-            redis_server.set(f"pwm_ambient", json.dumps(0), ex=ex)
-        elif tank_state == 'cooling':
-            redis_server.set(f"pwm_hot", json.dumps(0), ex=ex)
-            redis_server.set(f"pwm_cold", json.dumps(p), ex=ex)
-            redis_server.set(f"pwm_ambient", json.dumps(0), ex=ex)
-        elif tank_state == 'flush':
-            redis_server.set(f"pwm_hot", json.dumps(0), ex=ex)
-            redis_server.set(f"pwm_cold", json.dumps(0), ex=ex)
-            redis_server.set(f"pwm_ambient", json.dumps(p), ex=ex)
-        else:
-            logger.error(f"unknown tank_state {tank_state}")
+        for valve in ['hot', 'cold', 'ambient', ]:
+            pwm = p if valve == VALVE_BY_TANK_STATE[tank_state] else 0
+            pipe.set(tank_key(f"pwm_{valve}"), json.dumps(pwm), ex=ex)
     else:
-        # This disables the pwm valve controller.
-        # "tank_state" is ignored.
-        for k in {'pwm_hot', 'pwm_cold', 'pwm_ambient', }:
-            redis_server.delete(k)
+        # "tank_state" is ignored as far as the pwm keys go.
+        pipe.delete(*[tank_key(f"pwm_{valve}") for valve in ['hot', 'cold', 'ambient', ]])
+    if state_ex is not None:
+        pipe.set(tank_key('tank_state'), json.dumps(tank_state), ex=state_ex)
+    pipe.execute()
 
 
-def trigger_valve_direct(tank_state):
+def trigger_valve_direct(tank_state, *, state_ex=None):
     # You either have to suppress the PWM controller, update it to be
     # cooperative, or coax it to do what you want and pray/wait that it
     # does.
@@ -133,159 +598,242 @@ def trigger_valve_direct(tank_state):
     # Redis has some kind of pub-sub "on-change" mechanism too, but I
     # want to keep it as a simple K-V store.
     try:
-        set_valve_pwm(tank_state, p=None)
+        set_valve_pwm(tank_state, p=None, state_ex=state_ex)
     except:
         logger.warning('?')
     
-    proxy = ServerProxy('http://localhost:8001/')
-    
-    if tank_state == 'neutral':
-        proxy.valve_off('hot')
-        proxy.valve_off('cold')
-        proxy.valve_off('ambient')
-    elif tank_state == 'heating':
-        proxy.valve_on('hot')
-        proxy.valve_off('cold')
-        proxy.valve_off('ambient')
-    elif tank_state == 'cooling':
-        proxy.valve_off('hot')
-        proxy.valve_on('cold')
-        proxy.valve_off('ambient')
-    elif tank_state == 'flush':
-        proxy.valve_off('hot')
-        proxy.valve_off('cold')
-        proxy.valve_on('ambient')
-    else:
+    if tank_state not in VALVE_BY_TANK_STATE:
         logger.error(f"unknown tank_state {tank_state}")
+        return
+
+    # one round-trip; the valve server closes before it opens
+    proxy = get_valve_server()
+    return proxy.set_valves({valve:valve == VALVE_BY_TANK_STATE[tank_state] for valve in ['hot', 'cold', 'ambient', ]})
+
+
+def get_valve_server():
+    """The current tank's valves: the valve server over XML-RPC, or
+    whatever the supervisor put in there."""
+    tank = _current_tank.get()
+    if tank is not None and tank.valve_server is not None:
+        return tank.valve_server
+    return ServerProxy('http://localhost:8001/')
 
 
 def is_valve_control_inhibited():
-    redis_server = redis.StrictRedis(host='localhost', port=6379, db=0)
     # if the key does not exist, ttl returns -2. no exception raised
     # there.
     #return max(0, redis_server.ttl('inhibit')) > 0
-    return redis_server.ttl('inhibit') > 0
+    return redis_server.ttl(tank_key('inhibit')) > 0
+
 
+class RabbitPublisher:
+    """One long-lived connection to the local RabbitMQ broker per process.
 
-def send_to_meshlab(d):
+    Used to be one new BlockingConnection per message (never closed).
+    Now: connect on first use, declare each exchange once, publisher
+    confirms on, and on a dropped connection (broker restart, missed
+    heartbeats while idle...) reconnect and retry once before giving up.
+
+    publish(..., flush=False) queues the message instead; flush() sends
+    everything queued in one go. Up to max_pending messages are kept
+    for the next flush() if the broker is unreachable.
+
+    With confirms, a publish waits for the broker: up to
+    blocked_connection_timeout during a resource alarm. Nothing
+    time-critical should call it directly (valve_server queues its
+    edges to a thread).
+    """
+    def __init__(self, name, password, *, host='localhost', heartbeat=60, max_pending=1000):
+        import pika
+        self.parameters = pika.ConnectionParameters(host,
+                                                    5672,
+                                                    '/',
+                                                    pika.PlainCredentials(name, password),
+                                                    heartbeat=heartbeat,
+                                                    blocked_connection_timeout=30,
+                                                    )
+        self.connection = None
+        self.channel = None
+        self._declared = set()
+        self._pending = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import pika
+        if self.connection is not None and self.connection.is_open and self.channel.is_open:
+            return
+        self._close()
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+        self._declared = set()
+
+    def _close(self):
+        import pika
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def _send(self):
+        self._connect()
+        # service heartbeats that came in while we were idle
+        self.connection.process_data_events(time_limit=0)
+        while len(self._pending):
+            exchange, routing_key, body, properties = self._pending[0]
+            if exchange not in self._declared:
+                self.channel.exchange_declare(exchange=exchange, exchange_type='topic', durable=True)
+                self._declared.add(exchange)
+            self.channel.basic_publish(exchange=exchange,
+                                       routing_key=routing_key,
+                                       body=body,
+                                       properties=properties)
+            self._pending.popleft()
+
+    def publish(self, exchange, routing_key, body, *, properties=None, flush=True):
+        with self._lock:
+            self._pending.append((exchange, routing_key, body, properties, ))
+        if flush:
+            self.flush()
+
+    def flush(self):
+        import pika
+        with self._lock:
+            try:
+                self._send()
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError):
+                # the broker got it and said no; retrying won't help
+                self._pending.popleft()
+                raise
+            except pika.exceptions.AMQPError:
+                logger.warning('lost connection to the broker; reconnecting')
+                self._close()
+                self._send()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+_rabbit_publisher = None
+
+
+def get_rabbit_publisher():
+    global _rabbit_publisher
+    if _rabbit_publisher is None:
+        from cred import cred
+        _rabbit_publisher = RabbitPublisher('pi', cred['rabbitmq'], host='localhost')
+        atexit.register(_rabbit_publisher.close)
+    return _rabbit_publisher
+
+
+def _message_properties():
+    import pika
+    return pika.BasicProperties(delivery_mode=2,
+                                content_type='text/plain',
+                                expiration=str(3*24*3600*1000))
+
+
+def send_to_meshlab(d, *, flush=True):
     senderid = get_configuration('serial_number')
-    exchange = 'uhcm'
-    connection, channel = init_rabbit('pi', cred['rabbitmq'])
-    channel.exchange_declare(exchange=exchange, exchange_type='topic', durable=True)
-    channel.basic_publish(exchange=exchange,
-                          routing_key=senderid + '.s',
-                          body=formatsend(None, d, src=senderid).strip(),
-                          properties=pika.BasicProperties(delivery_mode=2,
-                                                          content_type='text/plain',
-                                                          expiration=str(3*24*3600*1000)))
+    get_rabbit_publisher().publish('uhcm',
+                                   senderid + '.s',
+                                   formatsend(None, d, src=senderid).strip(),
+                                   properties=_message_properties(),
+                                   flush=flush)
 
 
-def send_to_one_true_master(message_type, d):
+def send_to_one_true_master(message_type, d, *, flush=True):
     senderid = get_configuration('controller_name')
-    exchange = 'gbrf'
-    routing_key = f"{message_type}.{senderid}.s"
-    connection, channel = init_rabbit('pi',
-                                      cred['rabbitmq'],
-                                      exchange=exchange,
-                                      host='localhost',
-                                      )
-    channel.exchange_declare(exchange=exchange, exchange_type='topic', durable=True)
-    channel.basic_publish(exchange=exchange,
-                          routing_key=routing_key,
-                          body=json.dumps(d, separators=(',', ':')).encode('utf-8'),
-                          properties=pika.BasicProperties(delivery_mode=2,
-                                                          content_type='text/plain',
-                                                          expiration=str(3*24*3600*1000)))
+    get_rabbit_publisher().publish('gbrf',
+                                   f"{message_type}.{senderid}.s",
+                                   json.dumps(d, separators=(',', ':')).encode('utf-8'),
+                                   properties=_message_properties(),
+                                   flush=flush)
 
 
-def get_setpoint(*, fn='/var/www/html/config/profile.csv', force_read=True):
+def flush_rabbit():
+    get_rabbit_publisher().flush()
+
+
+PROFILE_CSV = '/var/www/html/config/profile.csv'
+
+
+def get_profile_fn():
+    """The current tank's profile.csv."""
+    tank = _current_tank.get()
+    if tank is not None and tank.profile is not None:
+        return tank.profile
+    return PROFILE_CSV
+
+
+def get_setpoint(*, fn=None, force_read=True, method=None):
     """HST. The time zone is HST. You can stop reading now.
 
     From the temperature profile, locate the temperature point with a
     timestamp closest to "now". If "now" is not covered by the profile,
     then return NaN.
+
+    Or interpolate between the setpoints: method is one of "nearest"
+    (the default), "linear" or "pchip" (monotone cubic). If None, it's
+    taken from profile_interpolation in config.txt. NA points are gaps
+    and evaluate to NaN either way.
     
     More ideas: If you want to be fancy you can include hard-limits on
     the profile in the config.txt.
-
-    Instead of sticking to the closest setpoint, how about some
-    interpolation with the nearest setpoint(s)?
     
     Generator... hum...
     """
 
     now = time.time()
+    fn = get_profile_fn() if fn is None else fn
 
-    # * * * * *
-    # Timestamps in the temperature profile are interpreted as in HST!
-    # Under the hood everything in the controller uses UTC.
-    # * * * * *
-    timezoneoffset = timedelta(hours=-10)
-
+    # Timestamps in the profile are in HST; see temperature_profile.py.
     dbfn = fn.rsplit('.', 1)[0] + '.db'
     should_read = force_read or not os.path.exists(dbfn)
 
-    with sqlite3.connect(dbfn) as conn:
-        cur = conn.cursor()
-        
-        if should_read:
-            cur.execute(f"""DROP TABLE IF EXISTS A""")
-            cur.execute(f"""CREATE TABLE IF NOT EXISTS A (
-                            'ts' INTEGER PRIMARY KEY,
-                            't' REAL NOT NULL
-                            )""")
-            conn.execute('VACUUM')
-            with open(fn, newline='') as csvfile:
-                for tmp in csv.reader(csvfile):
-                    try:
-                        x,y = tmp
-                        if 12 == len(x):
-                            x = int(dt2ts(datetime.strptime(x, '%Y%m%d%H%M') - timezoneoffset))
-                        elif 14 == len(x):
-                            x = int(dt2ts(datetime.strptime(x, '%Y%m%d%H%M%S') - timezoneoffset))
-                        else:
-                            raise ValueError(f"Bad timestamp: {x}")
-                        y = float(y) if y != 'NA' else 'NA'
-                        cur.execute(f"""INSERT OR REPLACE INTO A ('ts', 't') VALUES (?,?)""", (x, y, ))
-                    except ValueError:
-                        logger.error(f'invalid line in CSV: {tmp}')
-                conn.commit()
-
-        cur.execute(f"""SELECT MAX(ts),t FROM A
-                        WHERE ts <= ?""", (now, ))
-        leftt,leftv = cur.fetchone()
-        if leftt is None:
-            # the profile does not cover this moment in time (we're too
-            # early, or the profile is empty)
-            logger.warning('>we are here< [profile]')
-        if 'NA' == leftv:
-            leftv = float('nan')
-            
-        cur.execute(f"""SELECT MIN(ts),t FROM A
-                        WHERE ts >= ?""", (now, ))
-        rightt,rightv = cur.fetchone()
-        if rightt is None:
-            # the profile does not cover this moment in time (we're too
-            # late, or the profile is empty)
-            logger.warning('[profile] >we are here<')
-        if 'NA' == rightv:
-            rightv = float('nan')
-
-        logger.debug(f'{leftt, leftv, rightt, rightv}')
-        # "return NaN if we are outside of the window the profile covers"
-        if leftt is None or rightt is None:
-            return float('NaN')
-
-        # so both my left and right are valid numbers.
-        return leftv if now - leftt <= rightv - now else rightv
-        # interpolate?
-        # later you can up the deg of polynomial
-        #return np.polyval(np.polyfit([leftt, rightt, ], [leftv, rightv, ], 1), now)
-        # huh interp takes care of the case when x is outside of xp. that's nice.
-        #return np.interp([now], [leftt, rightt, ], [leftv, rightv, ])[0]
+    if should_read:
+        # a hash, unless profile.csv really is new
+        ingest_csv(fn, dbfn=dbfn, if_changed=True)
+
+    # Lookups are served from memory (see temperature_profile.py); the
+    # index notices when profile.db is rebuilt, by us or by the web app.
+    index = _get_profile_index(fn)
+    index.refresh(force=should_read)
+    if method is None:
+        method = get_configuration('profile_interpolation', default='nearest')
+    if method not in INTERPOLATION_METHODS:
+        logger.error(f"unknown profile_interpolation {method}; default to nearest")
+        method = 'nearest'
+    return index.evaluate(now, method=method)
+
+
+def get_setpoint_preview(second, *, step=60, fn=None, method=None):
+    """The setpoints for the next "second" seconds, every "step" seconds,
+    in one go. Returns (timestamps, values) as NumPy arrays."""
+    now = time.time()
+    if method is None:
+        method = get_configuration('profile_interpolation', default='nearest')
+    if method not in INTERPOLATION_METHODS:
+        method = 'nearest'
+    return _get_profile_index(get_profile_fn() if fn is None else fn).preview(now, now + second, step, method=method)
+
+
+_profile_indexes = {}
+
+
+def _get_profile_index(fn):
+    if fn not in _profile_indexes:
+        _profile_indexes[fn] = ProfileIndex(fn)
+    return _profile_indexes[fn]
 
 
 def beep(on=0.1, off=0.9):
+    import RPi.GPIO as GPIO
     pin = 18
 
     try:
@@ -301,6 +849,59 @@ def beep(on=0.1, off=0.9):
         raise
 
 
+def process_age_second():
+    """Seconds since this process was exec'd (so, including the
+    interpreter start-up and all the imports). None if /proc says
+    nothing."""
+    try:
+        with open('/proc/self/stat') as f:
+            # field 22, after the "(comm)" which may contain spaces
+            starttime = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - starttime/os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer:
+    """Where the time goes between exec and doing useful work.
+
+        startup = StartupTimer('eztank')    # first thing in __main__
+        ...
+        startup.mark('profile')
+        ...
+        startup.report()                    # right before the main loop
+
+    report() logs the breakdown and leaves it in the redis hash
+    "startup" (one field per daemon, JSON) for the dashboard.
+    """
+    def __init__(self, name):
+        self.name = name
+        now = time.monotonic()
+        age = process_age_second()
+        self.started = now - (age if age is not None else 0)
+        self.marks = [('imports', now, )] if age is not None else []
+
+    def mark(self, what):
+        self.marks.append((what, time.monotonic(), ))
+
+    def report(self):
+        now = time.monotonic()
+        steps = []
+        last = self.started
+        for what,t in self.marks:
+            steps.append((what, round(t - last, 3), ))
+            last = t
+        d = {'ts':round(time.time(), 3), 'total_second':round(now - self.started, 3), 'steps':dict(steps), }
+        logger.info(f"{self.name} up in {d['total_second']}s: " + ', '.join(f"{what} {second}s" for what,second in steps))
+        try:
+            redis_server.hset(tank_key('startup'), self.name, json.dumps(d, separators=(',', ':')))
+        except redis.exceptions.RedisError:
+            logger.warning('startup timing not recorded')
+        return d
+
+
 def get_checksum(s):
     return '{:08x}'.format(crc32(s.encode()) & 0xffffffff)  # python2-safe?
 
@@ -326,6 +927,7 @@ def dt2ts(dt):
 
 
 def init_rabbit(name, password, *, exchange='uhcm', host='localhost'):
+    import pika
     credentials = pika.PlainCredentials(name, password)
     connection = pika.BlockingConnection(pika.ConnectionParameters(host, 5672, '/', credentials))
     channel = connection.channel()
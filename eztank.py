@@ -18,22 +18,184 @@ densely sampled time series.
 
 SL2021
 """
-import time, logging, redis, json, sys, asyncio, random
+import time, logging, json, sys, asyncio, random, threading, redis
 from datetime import datetime
-from common import get_setpoint, get_configuration, set_valve_pwm, trigger_valve_direct, get_tank_status, is_valve_control_inhibited, add_operation_entry, beep
+from PID import RingPID
+from mpc import ThermalModel, LookaheadController, load_history
+import metrics
+from common import get_setpoint, get_setpoint_preview, get_configuration, set_valve_pwm, trigger_valve_direct, get_tank_status, invalidate_tank_status, is_valve_control_inhibited, add_operation_entry, beep, get_redis, StartupTimer, run_blocking, tank_key, tank_table, TANK_STATUS_KEY, TANK_STATUS_CHANNEL
 sys.path.append('..')
 
 
 logger = logging.getLogger(__name__)
-redis_server = redis.StrictRedis(host='localhost', port=6379, db=0)
+redis_server = get_redis()
 
 
-async def act(state, second, should_continue_f, *, p=1.0):
+class EventHub:
+    """Wakes the tasks up when something they care about changes, instead
+    of having them poll once a second.
+
+    Topics: "inhibit" (pause/resume), "t0c" (new reading) and
+    "tank_status" (deployed/maintenance). A thread listens to redis
+    keyspace notifications for those keys (plus the tank_status channel
+    set_tank_status() publishes on) and hands them over to the event
+    loop.
+
+        changed = await hub.wait('tank_status', 'inhibit', timeout=10)
+
+    If redis or the notifications are unavailable, wait() just times
+    out, so the callers should keep their timeouts as short as their old
+    poll periods (see poll()).
+
+    A tank_status wake-up also drops that tank's get_tank_status()
+    cache before anyone is woken, so the woken task sees the new mode
+    even if the cache's own subscription hasn't caught up yet.
+
+    The keyspace notifications are off by default in redis, and
+    "notify-keyspace-events" is a server-wide setting, so the hub only
+    uses them if they're on already (notify-keyspace-events K$gx in
+    redis.conf); otherwise it says so once and the tasks poll. With
+    redis_keyspace_notifications = auto (config.txt) it turns them on
+    itself, and logs that it did.
+
+    One hub (one subscription) serves every tank in the process: give it
+    their key prefixes (supervisor mode). wait() is for the current
+    tank's topics.
+    """
+    TOPICS = {'inhibit', 't0c', 'tank_status', }
+    POLL_SECOND = 5
+
+    def __init__(self, loop, *, db=0, prefixes=('', )):
+        self.loop = loop
+        self.live = False
+        self._warned = False
+        # (prefix, topic) -> waiters
+        self._waiters = {(p, topic):set() for p in prefixes for topic in self.TOPICS}
+        self._channels = {}
+        for p in prefixes:
+            self._channels.update({f"__keyspace@{db}__:{p}inhibit":(p, 'inhibit'),
+                                   f"__keyspace@{db}__:{p}t0c":(p, 't0c'),
+                                   f"__keyspace@{db}__:{p}{TANK_STATUS_KEY}":(p, 'tank_status'),
+                                   f"{p}{TANK_STATUS_CHANNEL}":(p, 'tank_status'),
+                                   })
+
+    def start(self):
+        threading.Thread(target=self._run, name='eventhub', daemon=True).start()
+
+    def _enable_notifications(self):
+        # K: keyspace channel; $: SET & co.; g: DEL, EXPIRE...; x: expired
+        try:
+            flags = redis_server.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+            if set('K$gx') <= set(flags.replace('A', 'g$lshzxe')):
+                return True
+            if get_configuration('redis_keyspace_notifications', default='off').strip().lower() == 'auto':
+                new_flags = ''.join(sorted(set(flags) | set('K$gx')))
+                # server-wide: every client of this redis gets them too
+                logger.warning(f'changing redis notify-keyspace-events from "{flags}" to "{new_flags}" '
+                               '(redis_keyspace_notifications = auto in config.txt)')
+                redis_server.config_set('notify-keyspace-events', new_flags)
+                return True
+            reason = f'notify-keyspace-events is "{flags}"'
+        except redis.exceptions.ResponseError:
+            # CONFIG disabled/renamed
+            reason = 'cannot read notify-keyspace-events'
+        if not self._warned:
+            # The tank_status channel still works.
+            logger.warning(f"redis keyspace notifications are off ({reason}); polling inhibit and t0c. "
+                           "notify-keyspace-events K$gx in redis.conf to turn them on")
+            self._warned = True
+        return False
+
+    def _run(self):
+        while True:
+            try:
+                keyspace = self._enable_notifications()
+                pubsub = redis_server.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(*self._channels)
+                self.live = keyspace
+                # anything could have changed while we weren't listening
+                for topic in self._waiters:
+                    self._post(topic)
+                for m in pubsub.listen():
+                    topic = self._channels.get(m['channel'].decode())
+                    if topic is not None:
+                        self._post(topic)
+            except redis.exceptions.RedisError:
+                logger.warning('lost the redis subscription; polling until it is back')
+            self.live = False
+            time.sleep(5)
+
+    def _post(self, topic):
+        if topic[1] == 'tank_status':
+            invalidate_tank_status(topic[0])
+        self.loop.call_soon_threadsafe(self._notify, topic)
+
+    def _notify(self, topic):
+        for event in self._waiters[topic]:
+            event.set()
+
+    def poll(self, second):
+        """Timeout to use for a wait() that used to be a poll every
+        "second" seconds: that, unless the notifications are working, in
+        which case at most every POLL_SECOND -- a fallback for a missed
+        notification, not the way changes are picked up."""
+        return second if not self.live else max(second, self.POLL_SECOND)
+
+    async def wait(self, *topics, timeout=None):
+        """True if one of the topics changed, False on timeout."""
+        event = asyncio.Event()
+        prefix = tank_key('')
+        topics = [(prefix, topic) for topic in topics]
+        for topic in topics:
+            self._waiters[topic].add(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            for topic in topics:
+                self._waiters[topic].discard(event)
+
+
+hub = None
+
+
+async def act(state, second, should_continue_f, *, p=1.0, wake_on=(), via_pwm=False):
     assert second >= 0 and type(second) is int
     assert state in {'neutral', 'heating', 'cooling', 'flush', }
     assert p >= 0 and p <= 1
 
-    if not is_valve_control_inhibited():
+    with metrics.span('eztank.valve'):
+        await run_blocking(_apply, state, second, p=p, via_pwm=via_pwm)
+    await _wait(second, should_continue_f, wake_on=wake_on)
+
+
+async def _wait(second, should_continue_f, *, wake_on=(), started=None):
+    """Sleep for "second" -- counted from "started" (time.monotonic())
+    if given, so the time spent getting there is part of the period
+    rather than on top of it -- but wake up (and bail if
+    should_continue_f() says so) on a mode change, or on anything else
+    in wake_on."""
+    deadline = (time.monotonic() if started is None else started) + second
+    while time.monotonic() < deadline:
+        if not should_continue_f():
+            logger.debug('early break')
+            break
+        remaining = deadline - time.monotonic()
+        if await hub.wait('tank_status', *wake_on, timeout=min(remaining, hub.poll(1))):
+            if len(wake_on):
+                logger.debug('woken up')
+                break
+
+
+def _apply(state, second, *, p, via_pwm):
+    if not is_valve_control_inhibited() and via_pwm:
+        # proportional: let the PWM valve controller do the duty cycle.
+        # The keys expire if we die, and the tender then leaves the
+        # valves alone.
+        set_valve_pwm(state, p=p, ex=max(2*second, 1), state_ex=max(2*second, 1))
+    elif not is_valve_control_inhibited():
         '''if 'deployed' == get_tank_status():
             set_valve_pwm(state, p=p)
         elif 'maintenance' == get_tank_status():
@@ -46,24 +208,80 @@ async def act(state, second, should_continue_f, *, p=1.0):
             trigger_valve_direct(state)
         else:
             pass'''
-        trigger_valve_direct(state)     # sigh.
-        
-        redis_server.set('tank_state', json.dumps(state), ex=max(2*second, 1))
+        # tank_state goes into redis together with the pwm keys (one
+        # MULTI/EXEC)
+        trigger_valve_direct(state, state_ex=max(2*second, 1))     # sigh.
     else:
         logger.info('(valve control inhibited, no op)')
 
-    for _ in range(int(second)):
-        if not should_continue_f():
-            logger.debug('early break')
-            break
-        await asyncio.sleep(1)
+
+CONTROL_MODES = {'bangbang', 'pid', 'mpc', }
+
+
+def get_pid_settings(deadband):
+    """(K, this_many, this_old) from config.txt. K is in "duty cycle per
+    °C" (and per °C·s, per °C/s), so Kp=2 means fully open at 0.5 °C
+    off.
+
+    The PID output is only used inside the deadband (bang-bang outside),
+    so Kp defaults to 1/deadband: half open at the edge of it."""
+    K = (get_configuration('PID_P', default=1/deadband if deadband > 0 else 1.0, cast=float),
+         get_configuration('PID_I', default=0.0, cast=float),
+         get_configuration('PID_D', default=0.0, cast=float),
+         )
+    this_many = get_configuration('PID_history_max_count', default=32, cast=int)
+    this_old = get_configuration('PID_history_max_age_second', default=120, cast=int)
+    return K, this_many, this_old
+
+
+def pid_to_tank_state(u, *, min_duty=0.0, tank_state=None):
+    """Signed PID output -> (tank_state, duty cycle). Positive is
+    "too cold".
+
+    Below min_duty the valves stay shut, and within min_duty of 1 it's
+    fully open: either way no valve opens and closes every period for
+    next to no water. Once on, it stays on down to half of min_duty
+    (tank_state: the previous one), so that a duty hovering around
+    min_duty doesn't flicker."""
+    if u > 0:
+        state = 'heating'
+    elif u < 0:
+        state = 'cooling'
+    else:
+        return 'neutral', 0.0
+    duty = min(1.0, abs(u))
+    if duty < (min_duty/2 if state == tank_state else min_duty):
+        return 'neutral', 0.0
+    if duty > 1 - min_duty:
+        duty = 1.0
+    return state, duty
+
+
+def fit_lookahead_controller():
+    """A LookaheadController from the last mpc_history_day days of
+    tank_temperature, or None if the data doesn't support a model."""
+    history_day = get_configuration('mpc_history_day', default=3, cast=float)
+    try:
+        model = ThermalModel.fit(*load_history(history_day*24*3600, table=tank_table('tank_temperature')))
+    except Exception:
+        logger.exception('could not fit a tank model')
+        metrics.count('eztank.mpc_fit.exception')
+        return None
+    logger.info(f"{model}")
+    if model is None:
+        return None
+    return LookaheadController(model,
+                               open_penalty=get_configuration('mpc_open_penalty', default=0.005, cast=float),
+                               use_penalty=get_configuration('mpc_use_penalty', default=0.002, cast=float),
+                               )
 
 
 def get_corrected_current_temp():
     try:
-        return round(json.loads(redis_server.get('t0c')), 6)
+        return round(json.loads(redis_server.get(tank_key('t0c'))), 6)
     except TypeError:
         logger.exception('a dog and a mug in a room on fire.jpg')
+        metrics.count('eztank.no_t0c')
     return float('nan')
 
 
@@ -71,25 +289,85 @@ async def task_deployed():
     # Execute the experiment temperature profile
 
     tank_state = 'neutral'
+    pid = None
+    lookahead = None
+    lookahead_fitted = 0
+    u_prev = 0.0
 
     def wubalubadubdub():
         return should_continue and ('deployed' == get_tank_status())
 
     while should_continue:
-        thermostat_loop_period_second = int(get_configuration('thermostat_loop_period_second'))
+        thermostat_loop_period_second = get_configuration('thermostat_loop_period_second', cast=int)
         if not wubalubadubdub():
             #logger.debug('(task_deployed sleeping)')
-            await asyncio.sleep(3*random.random())
+            await hub.wait('tank_status', timeout=hub.poll(3*random.random()))
             continue
 
-        deadband = float(get_configuration('deadband_celsius'))
-        high_alarm = float(get_configuration('high_alarm_celsius'))
-        low_alarm = float(get_configuration('low_alarm_celsius'))
-        setpoint = get_setpoint(force_read=False)   # refreshed when new upload occurs (see the web app)
-        redis_server.set('setpoint', json.dumps(setpoint), ex=2*thermostat_loop_period_second)
-        current_temp = get_corrected_current_temp()
+        # where the time goes (see metrics.py). "loop" is everything up
+        # to and including the valve op, not the wait.
+        started = time.monotonic()
+        t_loop = time.perf_counter()
+        with metrics.span('eztank.config'):
+            deadband = get_configuration('deadband_celsius', cast=float)
+            high_alarm = get_configuration('high_alarm_celsius', cast=float)
+            low_alarm = get_configuration('low_alarm_celsius', cast=float)
+            control_mode = get_configuration('control_mode', default='bangbang')
+            min_duty = get_configuration('PID_min_duty', default=0.2, cast=float)
+        with metrics.span('eztank.setpoint'):
+            setpoint = get_setpoint(force_read=False)   # refreshed when new upload occurs (see the web app)
+        with metrics.span('eztank.redis'):
+            redis_server.set(tank_key('setpoint'), json.dumps(setpoint), ex=2*thermostat_loop_period_second)
+            current_temp = get_corrected_current_temp()
+        if control_mode not in CONTROL_MODES:
+            logger.error(f"unknown control_mode {control_mode}; default to bangbang")
+            control_mode = 'bangbang'
+
+        t_control = time.perf_counter()
+        if 'pid' == control_mode:
+            K, this_many, this_old = get_pid_settings(deadband)
+            if (pid is None or tuple(pid.K) != K) and abs(K[0])*deadband/2 <= min_duty:
+                logger.error(f"PID_P={K[0]:g} makes at most {abs(K[0])*deadband/2:.2g} duty inside the deadband, "
+                             f"not above PID_min_duty={min_duty:g}: pid mode won't open a valve proportionally. "
+                             f"PID_P > {2*min_duty/deadband:.3g}, or leave it out")
+            if pid is None or (pid.this_many, pid.this_old) != (this_many, this_old):
+                pid = RingPID(K, this_many, this_old, i_limit=1.0)
+            elif tuple(pid.K) != K:
+                # new gains take effect without losing the history
+                pid.change_K(K)
+        else:
+            pid = None
+
+        if 'mpc' == control_mode:
+            # refit every hour: the tank drifts (season, plumbing...)
+            if time.time() - lookahead_fitted > 3600:
+                lookahead = fit_lookahead_controller()
+                lookahead_fitted = time.time()
+            if lookahead is None:
+                logger.warning('no tank model (yet); bang-bang for now')
+        else:
+            lookahead = None
+            lookahead_fitted = 0
 
         pwm = 1
+        wake_on = ()
+
+        # The PID sees every valid sample, in the deadband or not, so
+        # its I and D don't have holes in them.
+        u = None
+        if setpoint == setpoint and current_temp == current_temp:
+            if pid is not None:
+                u = pid.get_weighted_sum(setpoint - current_temp)
+            elif lookahead is not None:
+                step = get_configuration('mpc_step_second', default=60, cast=int)
+                horizon = get_configuration('mpc_horizon_second', default=1800, cast=int)
+                if step <= 0 or horizon < lookahead.blocks*step:
+                    logger.warning(f"mpc_horizon_second={horizon} needs to be at least {lookahead.blocks} mpc_step_second={step} (> 0); bang-bang for now")
+                else:
+                    _,upcoming = get_setpoint_preview(horizon + step, step=step)
+                    # (less than that left: the end of the profile)
+                    if len(upcoming) > lookahead.blocks:
+                        u,_ = lookahead.plan(current_temp, upcoming[1:], step, u_prev=u_prev)
 
         if setpoint is None or setpoint != setpoint:
             logger.warning('No current setpoint, or the "setpoint" is NA')
@@ -97,13 +375,27 @@ async def task_deployed():
         elif current_temp is None or current_temp != current_temp:  # NaN != NaN
             logger.warning('No current temperature reading')
             tank_state = 'neutral'
+            # no point waiting out the whole period once it's back
+            wake_on = ('t0c', )
         elif current_temp > high_alarm or current_temp < low_alarm:
             logger.warning(f"{current_temp} outside [{low_alarm},{high_alarm}]")
             tank_state = 'flush'
+        elif u is not None and lookahead is not None and not (u > 0 and current_temp >= setpoint + deadband/2) and not (u < 0 and current_temp <= setpoint - deadband/2):
+            # the look-ahead controller owns the deadband too: it may
+            # well start heating while still above the setpoint if
+            # there's a ramp coming up. Outside the deadband it may ease
+            # off early, but never push the wrong way (a bad model
+            # would run the tank away).
+            tank_state, pwm = pid_to_tank_state(u, min_duty=min_duty, tank_state=tank_state)
         elif current_temp >= setpoint + deadband/2:
             tank_state = 'cooling'
         elif current_temp <= setpoint - deadband/2:
             tank_state = 'heating'
+        elif u is not None:
+            # Inside the deadband: proportional mixing instead of
+            # bang-bang. Everything above (no data, alarms, way off) still
+            # takes precedence.
+            tank_state, pwm = pid_to_tank_state(u, min_duty=min_duty, tank_state=tank_state)
         elif current_temp < setpoint + deadband/2 and current_temp > setpoint:
             if 'heating' == tank_state:
                 tank_state = 'neutral'
@@ -111,10 +403,22 @@ async def task_deployed():
             if 'cooling' == tank_state:
                 tank_state = 'neutral'
 
+        # what's actually open, for the next plan's opening count
+        u_prev = {'heating':pwm, 'cooling':-pwm, }.get(tank_state, 0.0)
+        metrics.observe('eztank.control', time.perf_counter() - t_control)
+
         logger.info(f"Deployed: SP={setpoint:.2f}°C, PV={current_temp:.2f}°C, e={setpoint - current_temp:+.3f}°C; {tank_state} ({100*pwm:.0f}%)")
 
-        # apply desired tank_state
-        await act(tank_state, thermostat_loop_period_second, wubalubadubdub, p=pwm)
+        # apply desired tank_state (act(), in two halves so that the
+        # valve op is part of the loop time and the wait isn't)
+        assert pwm >= 0 and pwm <= 1
+        try:
+            with metrics.span('eztank.valve'):
+                await run_blocking(_apply, tank_state, thermostat_loop_period_second, p=pwm, via_pwm='bangbang' != control_mode)
+        finally:
+            metrics.observe('eztank.loop', time.perf_counter() - t_loop)
+            metrics.flush()
+        await _wait(thermostat_loop_period_second, wubalubadubdub, wake_on=wake_on, started=started)
         await asyncio.sleep(0.1*random.random())
 
 
@@ -127,14 +431,13 @@ async def task_maintenance():
     while should_continue:
         if not wubalubadubdub():
             #logger.debug('(task_maintenance sleeping)')
-            await asyncio.sleep(3*random.random())
+            await hub.wait('tank_status', timeout=hub.poll(3*random.random()))
             continue
 
         # "The concept of setpoint does not make sense in this context".
         # The proportional valve controller cedes control of the valves
         # if the variables are undefined.
-        for k in {'setpoint', 'pwm_hot', 'pwm_cold', 'pwm_ambient', }:
-            redis_server.delete(k)
+        redis_server.delete(*[tank_key(k) for k in ['setpoint', 'pwm_hot', 'pwm_cold', 'pwm_ambient', ]])
 
         logger.info('Maintenance: heating')
         await act('heating', 5, wubalubadubdub)
@@ -150,7 +453,7 @@ async def task_maintenance():
                 break
             await act('flush', 1, wubalubadubdub)
         logger.info('Maintenance: neutral')
-        for _ in range(int(get_configuration('maintenance_cycle_interval_second'))):
+        for _ in range(get_configuration('maintenance_cycle_interval_second', cast=int)):
             if not wubalubadubdub():
                 break
             await act('neutral', 1, wubalubadubdub)
@@ -192,16 +495,19 @@ async def task_warning():
         else:
             warning = False
         
+        # pause/resume wakes this up right away
         if warning:
             beep(on=1, off=0)
-            await asyncio.sleep(9)
+            await hub.wait('inhibit', timeout=9)
         else:
-            await asyncio.sleep(1)
+            await hub.wait('inhibit', timeout=hub.poll(1))
             continue
 
 
 if '__main__' == __name__:
     
+    startup = StartupTimer('eztank')
+
     logging.basicConfig(level=logging.DEBUG)
     logging.getLogger('asyncio').setLevel(logging.WARNING)
     logging.getLogger('pika').setLevel(logging.WARNING)
@@ -214,8 +520,11 @@ if '__main__' == __name__:
     for i in range(int(3*random.random()) + 1, 0, -1):
         print(i)
         time.sleep(1)
+    startup.mark('jitter')
 
-    get_setpoint(force_read=True)   # force a profile.csv -> profile.db conversion
+    # profile.csv -> profile.db, if profile.csv changed since
+    get_setpoint(force_read=True)
+    startup.mark('profile')
 
     message = json.dumps({'tank_number':get_configuration('tank_number'),
                           'controller_name':get_configuration('controller_name'),
@@ -224,11 +533,15 @@ if '__main__' == __name__:
 
     should_continue = True
 
-    # "when it beeps, we have a reasonable belief that the init process
-    # succeeded"
-    beep(on=2, off=0)
-
     async def main():
+        global hub
+        hub = EventHub(asyncio.get_running_loop())
+        hub.start()
+        startup.report()
+        # "when it beeps, we have a reasonable belief that the init
+        # process succeeded". The thermostat doesn't wait for the beep
+        # to end.
+        asyncio.get_running_loop().run_in_executor(None, beep, 2, 0)
         await asyncio.gather(
             task_deployed(),
             task_maintenance(),
@@ -1,6 +1,6 @@
 import sys, logging, time, redis, asyncio, shutil, json, socket
 sys.path.append('..')
-from common import get_configuration, send_to_meshlab, send_to_one_true_master
+from common import get_configuration, send_to_meshlab, send_to_one_true_master, StartupTimer
 
 
 logger = logging.getLogger(__name__)
@@ -19,9 +19,9 @@ async def task_relay():
             return None
 
     while should_continue:
-        cloud_report_interval_second = int(get_configuration('cloud_report_interval_second'))
+        cloud_report_interval_second = get_configuration('cloud_report_interval_second', cast=int)
         
-        tank_number = int(get_configuration('tank_number'))
+        tank_number = get_configuration('tank_number', cast=int)
         uptime_second = int(float(open('/proc/uptime').readline().split()[0]))
         free = int(shutil.disk_usage('/').free/1e6)
         cpu_temp = round(float(open('/sys/class/thermal/thermal_zone0/temp').readline())*1e-3, 1)
@@ -46,7 +46,8 @@ async def task_relay():
         redis_server.set('freeMB', json.dumps(free), ex=2*cloud_report_interval_second)
         redis_server.set('cpu_temp', json.dumps(cpu_temp), ex=2*cloud_report_interval_second)
 
-        send_to_meshlab(d)
+        # both go out in one flush, over the one connection
+        send_to_meshlab(d, flush=False)
 
         try:
             send_to_one_true_master('operation', d)
@@ -60,12 +61,15 @@ async def task_relay():
 
 if '__main__' == __name__:
     
+    startup = StartupTimer('cloud_relay')
+
     logging.basicConfig(level=logging.DEBUG)
     logging.getLogger('asyncio').setLevel(logging.WARNING)
     logging.getLogger('pika').setLevel(logging.WARNING)
     logging.getLogger('common').setLevel(logging.WARNING)
 
     should_continue = True
+    startup.report()
 
     async def main():
         await asyncio.gather(
@@ -28,14 +28,30 @@ seamlessly takes care of
     3. Truly one func to rule them all (see the assert)
 
 """
-import sys, logging, asyncio, redis, json, random
-from xmlrpc.client import ServerProxy
+import sys, logging, asyncio, json, random, time
 sys.path.append('..')
-from common import get_configuration, is_valve_control_inhibited
+from common import get_configuration, is_valve_control_inhibited, get_redis, get_valve_server, run_blocking, tank_key, StartupTimer
+import metrics
 
 
 logger = logging.getLogger(__name__)
 
+# how often a cycle in progress looks for a new duty cycle
+RECHECK_SECOND = 1
+OPPOSITE = {'hot':'cold', 'cold':'hot', }
+
+
+def read_pwm(valve):
+    """pwm_<valve>, clipped to [0, 1]. None if undefined."""
+    try:
+        with metrics.span("pwm_valve_controller.redis"):
+            pwm = json.loads(get_redis().get(tank_key(f"pwm_{valve}")))
+    except TypeError:
+        return None
+    if pwm < 0 or pwm > 1:
+        logger.warning(f"pwm_{valve}={pwm} out of bound: {pwm}; clipped")
+    return min(1, max(0, pwm))
+
 
 # One func to handle any number of valves. Added a new valve? Just spawn
 # another instance of this.
@@ -43,44 +59,51 @@ async def task_valve_tender(valve):
 
     assert valve in {'hot', 'cold', 'ambient', }
 
-    proxy = ServerProxy('http://localhost:8001/')
-    redis_server = redis.StrictRedis(host='localhost', port=6379, db=0)
+    proxy = get_valve_server()
 
     await asyncio.sleep(2.3*random.random())
 
     try:
         while should_continue:
-            thermostat_loop_period_second = int(get_configuration('thermostat_loop_period_second'))
+            thermostat_loop_period_second = get_configuration('thermostat_loop_period_second', cast=int)
             assert thermostat_loop_period_second > 0
-            pwm_min_actuation_second = float(get_configuration('pwm_min_actuation_second'))
+            pwm_min_actuation_second = get_configuration('pwm_min_actuation_second', cast=float)
             assert pwm_min_actuation_second >= 0
 
-            pwm = None
-
-            try:
-                pwm = json.loads(redis_server.get(f"pwm_{valve}"))
-            except TypeError:
+            pwm = read_pwm(valve)
+            if pwm is None:
                 logger.warning(f"pwm_{valve} undefined. No action.")
-                pwm = None
 
             if pwm is not None:
-                if pwm < 0 or pwm > 1:
-                    logger.warning(f"pwm_{valve}={pwm} out of bound: {pwm}; clipped")
-                pwm = min(1, max(0, pwm))
-                
                 logger.info(f"{valve}: {100*pwm:.0f}%")
 
                 # ... I guess you could randomize the order of these two too.
 
                 # "if the resulting valve actuation time (ON or OFF) in
                 # seconds is less than this, don't bother"
-                on_time = pwm*thermostat_loop_period_second
-                off_time = thermostat_loop_period_second - on_time
-                
+                period = thermostat_loop_period_second
+                cycle_start = time.monotonic()
+                opened = False
+
                 if not is_valve_control_inhibited():
-                    if on_time >= pwm_min_actuation_second:
-                        proxy.valve_on(valve)
-                        await asyncio.sleep(on_time)
+                    if pwm*period >= pwm_min_actuation_second:
+                        with metrics.span("pwm_valve_controller.rpc"):
+                            # hot and cold are never open together: if the
+                            # other one is being closed, don't wait for its
+                            # tender to get around to it
+                            if valve in OPPOSITE and 0 == read_pwm(OPPOSITE[valve]):
+                                await run_blocking(proxy.valve_off, OPPOSITE[valve])
+                            await run_blocking(proxy.valve_on, valve)
+                        opened = True
+                        # The duty cycle is re-read every RECHECK_SECOND:
+                        # a smaller one ends the ON phase early (0: right
+                        # away), instead of after the rest of the period.
+                        while True:
+                            remaining = cycle_start + pwm*period - time.monotonic()
+                            if remaining <= 0:
+                                break
+                            await asyncio.sleep(min(remaining, RECHECK_SECOND))
+                            pwm = read_pwm(valve) or 0
                 else:
                     await asyncio.sleep(1)
 
@@ -88,15 +111,29 @@ async def task_valve_tender(valve):
                 # Better check again. Nothing replaces an atomic op of
                 # course, but failure is rare and is a mere annoyance.
                 if not is_valve_control_inhibited():
-                    if off_time >= pwm_min_actuation_second:
-                        proxy.valve_off(valve)
-                        await asyncio.sleep(off_time)
+                    if period - pwm*period >= pwm_min_actuation_second:
+                        with metrics.span("pwm_valve_controller.rpc"):
+                            await run_blocking(proxy.valve_off, valve)
+                        # If the valve didn't open this period and now
+                        # should, start over right away rather than at
+                        # the end of the period. (A duty that merely
+                        # changed waits: restarting early would only
+                        # make more, shorter cycles.)
+                        while True:
+                            remaining = cycle_start + period - time.monotonic()
+                            if remaining <= 0:
+                                break
+                            await asyncio.sleep(min(remaining, RECHECK_SECOND))
+                            if not opened and (read_pwm(valve) or 0)*period >= pwm_min_actuation_second:
+                                break
                 else:
                     await asyncio.sleep(1)
             else:
                 logger.info(f"pwm_{valve} undefined. No action.")
                 await asyncio.sleep(thermostat_loop_period_second)
 
+            metrics.flush()
+
             # so the valves can eventually go out of sync. (to avoid
             # power spikes and pressure dips)
             await asyncio.sleep(0.001*random.random())
@@ -112,11 +149,14 @@ async def task_valve_tender(valve):
 
 if '__main__' == __name__:
     
+    startup = StartupTimer('pwm_valve_controller')
+
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('pika').setLevel(logging.ERROR)
     logging.getLogger('common').setLevel(logging.WARNING)
 
     should_continue = True
+    startup.report()
 
     # the newer asyncio.run() is better than the old
     # run_until_complete(). run() actually lets the tasks do their
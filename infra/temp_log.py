@@ -1,25 +1,140 @@
-import logging, time, sys, redis, json, asyncio, sqlite3, random
+"""Logs the tank temperature to records.db once a minute, in three
+tiers (RRD style), so a long experiment fits on a small SD card:
+
+    tank_temperature        every minute, for keep_local_temperature_record_days
+    tank_temperature_15m    15-minute rollups, for keep_15min_temperature_record_days
+    tank_temperature_1d     daily (UTC) rollups, for keep_daily_temperature_record_days
+
+A rollup row is n (minutes with a t0c), t0c min/mean/max, and the mean
+t0, setpoint and valve duty cycles. The current 15-minute and day
+buckets are recomputed after every insert (at most 15 and 96 rows, by
+primary key), so the tiers are always up to date and a restart loses
+nothing; at startup, whatever was logged while they weren't kept (or
+before this existed) is rolled up, a day (a month, for the daily tier)
+per statement.
+
+Pruning is every minute, at most PRUNE_BATCH rows per tier: no random
+DELETE of a month's worth, no VACUUM (SQLite reuses the freed pages).
+0 or less for the rollup tiers keeps them forever.
+
+SL2021
+"""
+import logging, time, sys, json, asyncio
 from datetime import datetime
 sys.path.append('..')
-from common import get_configuration
+from common import get_configuration, get_redis, tank_key, tank_table, StartupTimer
+import records
+
+
+TIERS = [
+    # table suffix, bucket (second), source table suffix, config key, default days
+    ('_15m', 15*60, '', 'keep_15min_temperature_record_days', 365),
+    ('_1d', 24*3600, '_15m', 'keep_daily_temperature_record_days', 3650),
+]
+PRUNE_BATCH = 500
+# rows of the source table per backfill statement
+BACKFILL_SECOND = {'_15m':24*3600, '_1d':30*24*3600, }
+
+_COLUMNS = "'ts', 'n', 't0c_min', 't0c_mean', 't0c_max', 't0_mean', 'setpoint_mean', 'hot', 'cold', 'ambient'"
+
+
+def rollup_sql(table, width, source):
+    """INSERT OR REPLACE of the width-second buckets of table, from the
+    rows of source with lo <= ts < hi. source is tank_temperature itself
+    (minute rows) or a rollup (weighted by n)."""
+    if source == tank_table('tank_temperature'):
+        select = """count(t0c), min(t0c), avg(t0c), max(t0c), avg(t0),
+                    avg(CASE WHEN typeof(setpoint) IN ('integer', 'real') THEN setpoint END),
+                    avg(hot), avg(cold), avg(ambient)"""
+    else:
+        select = """sum(n), min(t0c_min), sum(t0c_mean*n)/sum(n), max(t0c_max), sum(t0_mean*n)/sum(n),
+                    sum(setpoint_mean*n)/sum(n),
+                    sum(hot*n)/sum(n), sum(cold*n)/sum(n), sum(ambient*n)/sum(n)"""
+    return f"""INSERT OR REPLACE INTO {table} ({_COLUMNS})
+               SELECT ts/{width}*{width} AS bucket, {select}
+               FROM {source}
+               WHERE ts >= ? AND ts < ?
+               GROUP BY bucket"""
+
+
+def roll_up(now):
+    """Recompute the buckets now is in, every tier, through the records
+    writer (so after whatever was enqueued before)."""
+    base = tank_table('tank_temperature')
+    for suffix,width,source,_,_ in TIERS:
+        lo = now//width*width
+        records.enqueue(rollup_sql(base + suffix, width, base + source), (lo, lo + width))
+
+
+def prune(now, keep_day):
+    """Delete up to PRUNE_BATCH of the oldest expired rows of each tier."""
+    base = tank_table('tank_temperature')
+    keep = [('', keep_day)] + [(suffix, get_configuration(key, default=default, cast=int))
+                               for suffix,_,_,key,default in TIERS]
+    for suffix,day in keep:
+        if day <= 0:
+            continue
+        table = base + suffix
+        records.enqueue(f"""DELETE FROM {table} WHERE ts IN
+                            (SELECT ts FROM {table} WHERE ts < ? ORDER BY ts LIMIT ?)""",
+                        (now - day*24*3600, PRUNE_BATCH, ))
+
+
+def backfill(now):
+    """Roll up what isn't yet: from the last bucket of each tier (or the
+    start of its source) to now."""
+    base = tank_table('tank_temperature')
+    for suffix,width,source,_,_ in TIERS:
+        with records.connect() as conn:
+            last = conn.execute(f"""SELECT MAX(ts) FROM {base + suffix}""").fetchone()[0]
+            if last is None:
+                last = conn.execute(f"""SELECT MIN(ts) FROM {base + source}""").fetchone()[0]
+        if last is None:
+            continue
+        lo = last//width*width
+        step = BACKFILL_SECOND[suffix]
+        n = 0
+        while lo < now:
+            records.enqueue(rollup_sql(base + suffix, width, base + source), (lo, lo + step)).result()
+            lo += step
+            n += 1
+        logging.info(f"{base + suffix}: rolled up in {n} steps")
+
+
+def get_valve_duty(f):
+    """(hot, cold, ambient) duty cycles right now, for the model fits (see
+    mpc.py). From pwm_* if the PWM tender is in charge, from tank_state
+    otherwise. None if unknown."""
+    pwm = [f(f"pwm_{valve}") for valve in ['hot', 'cold', 'ambient']]
+    if any(p is not None for p in pwm):
+        return tuple(min(1, max(0, p)) if type(p) in {int, float} else 0 for p in pwm)
+    tank_state = f('tank_state')
+    M = {'neutral':(0, 0, 0), 'heating':(1, 0, 0), 'cooling':(0, 1, 0), 'flush':(0, 0, 1), }
+    return M.get(tank_state, (None, None, None))
 
 
 async def task_temperature_log():
 
     log_period_second = 60
     
-    redis_server = redis.StrictRedis(host='localhost', port=6379, db=0)
+    redis_server = get_redis()
 
     def f(v):
         try:
-            return json.loads(redis_server.get(v))
+            return json.loads(redis_server.get(tank_key(v)))
         except TypeError:
-            return redis_server.get(v)
+            return redis_server.get(tank_key(v))
+
+    if get_configuration('keep_local_temperature_record_days', cast=int) > 0:
+        try:
+            await asyncio.to_thread(backfill, int(time.time()))
+        except Exception:
+            logging.exception('rollup backfill')
 
     while should_continue:
         await asyncio.sleep(log_period_second)
         
-        keep_day = int(get_configuration('keep_local_temperature_record_days'))
+        keep_day = get_configuration('keep_local_temperature_record_days', cast=int)
         
         if keep_day > 0:
             now = int(time.time())
@@ -39,24 +154,16 @@ async def task_temperature_log():
                 t0 = f('t0')
                 t0c = f('t0c')
                 setpoint = f('setpoint')
+                hot, cold, ambient = get_valve_duty(f)
 
                 logging.info(f"{setpoint}, {t0}, {t0c}")
 
-                conn = sqlite3.connect('/var/www/html/records.db')
-                if random.random() > 0.9999:
-                    conn.execute('VACUUM')
-                with conn as conn:
-                    cur = conn.cursor()
-                    cur.execute(f"""CREATE TABLE IF NOT EXISTS tank_temperature (
-                                    'ts' INTEGER PRIMARY KEY,
-                                    'dt' TEXT NOT NULL,
-                                    't0' REAL,
-                                    't0c' REAL,
-                                    'setpoint' REAL
-                                    )""")
-                    if random.random() > 0.99:
-                        cur.execute(f"""DELETE FROM tank_temperature WHERE ts < ?""", (now - keep_day*24*3600, ))
-                    cur.execute(f"""INSERT OR IGNORE INTO tank_temperature ('ts', 'dt', 't0', 't0c', 'setpoint') VALUES (?,?,?,?,?)""", (now, nowdt, t0, t0c, setpoint, ))
+                # the tables are created by records.py
+                table = tank_table('tank_temperature')
+                prune(now, keep_day)
+                await records.enqueue_async(f"""INSERT OR IGNORE INTO {table} ('ts', 'dt', 't0', 't0c', 'setpoint', 'hot', 'cold', 'ambient') VALUES (?,?,?,?,?,?,?,?)""",
+                                            (now, nowdt, t0, t0c, setpoint, hot, cold, ambient, ))
+                roll_up(now)
             except KeyboardInterrupt:
                 raise
             except:
@@ -67,10 +174,13 @@ async def task_temperature_log():
 
 if '__main__' == __name__:
     
+    startup = StartupTimer('temp_log')
+
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('common').setLevel(logging.WARNING)
 
     should_continue = True
+    startup.report()
 
     async def main():
         await asyncio.gather(
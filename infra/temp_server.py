@@ -1,32 +1,152 @@
 # Want to create more work and failure modes? Stick a Kalman filter or
 # two in here... TODO
 # SL2021
-import time, logging, sys, statistics, redis, asyncio, json, glob, re, random, typing
+import time, logging, sys, statistics, asyncio, json, glob, re, random, typing, os
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 from os.path import join, expanduser, basename
 sys.path.append(expanduser('~'))
 sys.path.append('..')
-from scipy.signal import medfilt
-import numpy as np
-from common import get_configuration, get_probe_offset
+from common import get_configuration, get_probe_offset, get_probe_calibration, get_redis, tank_key, current_tank, StartupTimer, per_tank, run_blocking
+import metrics, samplebus
+from probefilter import ProbeFuser, FILTERS, calibrate
 
 
 logger = logging.getLogger(__name__)
 
 
+W1_DEVICES = '/sys/bus/w1/devices'
+
+
+class ProbeReader:
+    """All the DS18B20s under "root" (the w1 sysfs, or a fake one), read
+    at the same time.
+
+    Each read is ~750 ms of conversion in the kernel, so reading them one
+    after another made a sample take n*750 ms; here they go to a thread
+    pool and a sample takes about one conversion. A probe that doesn't
+    answer within timeout_second is left out of that sample (and skipped
+    until its read comes back).
+
+    The device list is cached: re-listed every refresh_second, or as
+    soon as the bus master's list of slaves changes (hot plug).
+
+    read() returns what it got; errors[sn] counts what it didn't (crc,
+    parse, reset, timeout, busy, io).
+    """
+    def __init__(self, root=None, *, refresh_second=300, timeout_second=2.0, max_workers=8, read_f=None):
+        self.root = W1_DEVICES if root is None else root
+        self.refresh_second = refresh_second
+        self.timeout_second = timeout_second
+        self.read_f = _read_file if read_f is None else read_f
+        self.errors = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ds18b20')
+        self._pending = {}
+        self._sn = []
+        self._listed = None
+        self._signature = None
+
+    def _bus_signature(self):
+        # cheap: no conversion involved
+        r = []
+        for fn in sorted(glob.glob(join(self.root, 'w1_bus_master*', 'w1_master_slaves'))):
+            try:
+                r.append(self.read_f(fn))
+            except OSError:
+                pass
+        return tuple(r)
+
+    def serial_numbers(self):
+        signature = self._bus_signature()
+        if self._listed is None or time.monotonic() - self._listed > self.refresh_second or signature != self._signature:
+            self._sn = sorted(basename(x)[3:] for x in glob.glob(join(self.root, '28-*')))
+            self._listed = time.monotonic()
+            self._signature = signature
+            logger.debug(f"probes: {self._sn}")
+        return self._sn
+
+    def _error(self, sn, kind):
+        counts = self.errors.setdefault(sn, {})
+        counts[kind] = counts.get(kind, 0) + 1
+        metrics.count(f"temp_server.probe_{kind}")
+        logger.warning(f"{sn}: {kind}")
+
+    def read(self, SN=None):
+        """{sn: °C} for the probes (all of them, or those in SN) that
+        answered."""
+        SN = self.serial_numbers() if SN is None else SN
+        futures = {}
+        for sn in SN:
+            if sn in self._pending:
+                if not self._pending[sn].done():
+                    self._error(sn, 'busy')
+                    continue
+                del self._pending[sn]
+            futures[sn] = self._executor.submit(self.read_f, join(self.root, f"28-{sn}", 'w1_slave'))
+        wait(futures.values(), timeout=self.timeout_second)
+
+        T = {}
+        for sn,future in futures.items():
+            if not future.done():
+                self._pending[sn] = future
+                self._error(sn, 'timeout')
+                continue
+            try:
+                T[sn] = parse_w1_slave(future.result())
+            except OSError:
+                # unplugged? list them again next time
+                self._listed = None
+                self._error(sn, 'io')
+            except ValueError as e:
+                self._error(sn, str(e))
+        return T
+
+
+def _read_file(fn):
+    with open(fn) as f:
+        return f.read()
+
+
+def parse_w1_slave(s):
+    """°C from the w1_slave text:
+
+        72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        72 01 4b 46 7f ff 0e 10 57 t=23125
+
+    ValueError('crc') if the CRC check failed, 'reset' for the 85 °C
+    power-on value, 'parse' for anything else."""
+    lines = s.strip().splitlines()
+    if len(lines) < 2 or 'crc=' not in lines[0]:
+        raise ValueError('parse')
+    if not lines[0].rstrip().endswith('YES'):
+        raise ValueError('crc')
+    m = re.search(r't=(-?\d+)$', lines[1].strip())
+    if m is None:
+        raise ValueError('parse')
+    t = int(m.group(1))
+    if 85000 == t:
+        raise ValueError('reset')
+    return t*1e-3
+
+
+def _get_probe_reader():
+    return per_tank('probe_reader', ProbeReader)
+
+
 def read_ds18b20_serial_numbers():
-    r = [basename(x) for x in glob.glob('/sys/bus/w1/devices/28-*')]
-    return sorted([rr[3:] for rr in r if rr.startswith('28-')])
+    SN = _get_probe_reader().serial_numbers()
+    # supervisor mode: only this tank's probes
+    tank = current_tank()
+    if tank is not None and tank.probes is not None:
+        SN = [sn for sn in SN if sn in tank.probes]
+    return SN
 
 
 # The resolution of the DS18B20 is only 0.0625 °C, and read time is long
 # (~750 ms). You'd have to keep a long history if you want to
 # meaningfully oversample them.
 def read_ds18b20s():
-    #return [int(re.match('.+t=(?P<t>\d{5})$', open(join(x, 'w1_slave')).read(), re.MULTILINE | re.DOTALL).group('t'))*1e-3 for x in sorted(glob.glob('/sys/bus/w1/devices/28-*'))]
-    SN = read_ds18b20_serial_numbers()
-    T = [int(re.match('.+t=(?P<t>\d{5})$', open(join(x, 'w1_slave')).read(), re.MULTILINE | re.DOTALL).group('t'))*1e-3 for x in [f"/sys/bus/w1/devices/28-{sn}" for sn in SN]]
-    return dict(zip(SN, T))
+    return _get_probe_reader().read(read_ds18b20_serial_numbers())
 
 
 def get_temperature() -> typing.Tuple[float, dict]:
@@ -37,40 +157,161 @@ def get_temperature() -> typing.Tuple[float, dict]:
         return float('nan'), {}
 
 
+def _get_probe_fuser():
+    return per_tank('probe_fuser', ProbeFuser)
+
+
+def get_probe_filter():
+    """probe_filter from config.txt. Off ('none') unless set: then t0c is
+    the median of the probes (plus their calibration), as it always was,
+    and t0f is only published next to it."""
+    method = get_configuration('probe_filter', default='none')
+    if method not in FILTERS:
+        logger.error(f"unknown probe_filter {method}; using none")
+        method = 'none'
+    return method
+
+
+def get_filtered_temperature(probes, *, now=None):
+    """(°C, standard deviation) of the tank from this sample's {sn: °C},
+    through the per-probe filters (see probefilter.py; probe_filter in
+    config.txt, 'none' by default: the latest readings, fused)."""
+    method = get_probe_filter()
+    fuser = _get_probe_fuser()
+    fuser.configure(method,
+                    window=get_configuration('probe_filter_window', default=12, cast=int),
+                    spike_celsius=get_configuration('probe_spike_celsius', default=0.5, cast=float),
+                    stuck_count=get_configuration('probe_stuck_count', default=360, cast=int),
+                    stuck_celsius=get_configuration('probe_stuck_celsius', default=0.25, cast=float),
+                    q=get_configuration('probe_kalman_q', default=1e-4, cast=float),
+                    r=get_configuration('probe_kalman_r', default=0.03, cast=float),
+                    )
+    return fuser.update(probes, now=time.time() if now is None else now)
+
+
+def make_fake_sysfs(root, temperatures, *, crc_ok=True):
+    """A directory that looks like /sys/bus/w1/devices, for ProbeReader
+    off the Pi. temperatures: {sn: °C}."""
+    os.makedirs(join(root, 'w1_bus_master1'), exist_ok=True)
+    with open(join(root, 'w1_bus_master1', 'w1_master_slaves'), 'w') as f:
+        f.write(''.join(f"28-{sn}\n" for sn in sorted(temperatures)))
+    for sn,t in temperatures.items():
+        os.makedirs(join(root, f"28-{sn}"), exist_ok=True)
+        with open(join(root, f"28-{sn}", 'w1_slave'), 'w') as f:
+            f.write(f"72 01 4b 46 7f ff 0e 10 57 : crc=57 {'YES' if crc_ok else 'NO'}\n"
+                    f"72 01 4b 46 7f ff 0e 10 57 t={int(round(t*1000))}\n")
+
+
 async def task_sample():
-    redis_server = redis.StrictRedis(host='localhost', port=6379, db=0)
+    redis_server = get_redis()
 
     refresh_period_second = 5 + int(random.random())
 
     while should_continue:
-        t0,probes = get_temperature()
-        redis_server.set('t0',
-                         json.dumps(t0),
-                         ex=2*refresh_period_second)
-        redis_server.set('t_probes',
-                         json.dumps(probes),
-                         ex=2*refresh_period_second)
-
-        c0 = get_probe_offset()
-        redis_server.set('c0',
-                         json.dumps(c0),
-                         ex=2*refresh_period_second)
-
-        t0c = t0 + c0
-        redis_server.set('t0c',
-                         json.dumps(t0c),
-                         ex=2*refresh_period_second)
-
-        logger.info(f"{str(datetime.now())[:19]}, t0={t0:.3f}°C, c0={c0:.6f}°C, t0c={t0c:.3f}°C")
+        t_loop = time.perf_counter()
+        with metrics.span('temp_server.probes'):
+            t0,probes = await run_blocking(get_temperature)
+        if t0 != t0:
+            metrics.count('temp_server.no_reading')
+        with metrics.span('temp_server.filter'):
+            t0f,t0f_sigma = get_filtered_temperature(probes)
+        if t0f != t0f and t0 == t0:
+            # every probe stuck or spiking: better the raw median than
+            # nothing
+            logger.warning('no filtered reading; using the raw median')
+            t0f,t0f_sigma = t0, float('nan')
+        with metrics.span('temp_server.offset'):
+            c0 = get_probe_offset()
+            calibration = get_probe_calibration()
+        corrected = calibrate(probes, calibration, c0)
+        # what the controller sees: each probe corrected (its own fit
+        # from probe_log if it has one, c0 if not), then the median, or
+        # with a probe_filter, the filtered estimates fused
+        if 'none' == get_probe_filter():
+            valid = [t for t in corrected.values() if t == t]
+            t0c = statistics.median(valid) if len(valid) else float('nan')
+        else:
+            t0c,_ = _get_probe_fuser().estimate(probes, calibration=calibration, offset=c0)
+            if t0c != t0c:
+                t0c = t0f + c0
+
+        with metrics.span('temp_server.redis'):
+            redis_server.set(tank_key('t0'),
+                             json.dumps(t0),
+                             ex=2*refresh_period_second)
+            redis_server.set(tank_key('t_probes'),
+                             json.dumps(corrected),
+                             ex=2*refresh_period_second)
+            # (what goes into probe_log, to fit the calibration to)
+            redis_server.set(tank_key('t_probes_raw'),
+                             json.dumps(probes),
+                             ex=2*refresh_period_second)
+            redis_server.set(tank_key('t0f'),
+                             json.dumps(t0f),
+                             ex=2*refresh_period_second)
+            redis_server.set(tank_key('t0f_sigma'),
+                             json.dumps(t0f_sigma),
+                             ex=2*refresh_period_second)
+            redis_server.set(tank_key('probe_status'),
+                             json.dumps(_get_probe_fuser().status()),
+                             ex=2*refresh_period_second)
+            redis_server.set(tank_key('c0'),
+                             json.dumps(c0),
+                             ex=2*refresh_period_second)
+            redis_server.set(tank_key('t0c'),
+                             json.dumps(t0c),
+                             ex=2*refresh_period_second)
+            # ...and the history (see samplebus.py)
+            samplebus.publish({'t0':t0, 't0f':t0f, 's':t0f_sigma, 'c0':c0, 't0c':t0c, 'p':corrected, },
+                              redis_server=redis_server)
+            if len(_get_probe_reader().errors):
+                redis_server.set(tank_key('probe_errors'),
+                                 json.dumps(_get_probe_reader().errors),
+                                 ex=2*refresh_period_second)
+        metrics.observe('temp_server.loop', time.perf_counter() - t_loop)
+        metrics.flush()
+
+        logger.info(f"{str(datetime.now())[:19]}, t0={t0:.3f}°C, t0f={t0f:.3f}±{t0f_sigma:.3f}°C, c0={c0:.6f}°C, t0c={t0c:.3f}°C")
 
         await asyncio.sleep(refresh_period_second)
 
 
 if '__main__' == __name__:
 
-    logging.basicConfig(level=logging.DEBUG)
+    startup = StartupTimer('temp_server')
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sysfs', default=W1_DEVICES, help='w1 devices directory (or a fake one, see make_fake_sysfs)')
+    parser.add_argument('--bench', type=int, default=None, metavar='N', help='just time N reads and exit')
+    parser.add_argument('--fake-probes', type=int, default=None, metavar='N', help='make a fake sysfs with N probes in --sysfs first')
+    parser.add_argument('--fake-conversion', type=float, default=0, metavar='SECOND', help='pretend each read takes this long')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.bench else logging.DEBUG)
+
+    W1_DEVICES = args.sysfs
+    if args.fake_probes is not None:
+        make_fake_sysfs(args.sysfs, {f"0316a279{i:04x}":25 + 0.0625*i for i in range(args.fake_probes)})
+    if args.fake_conversion > 0:
+        _really_read_file = _read_file
+        def _read_file(fn):
+            if fn.endswith('w1_slave'):
+                time.sleep(args.fake_conversion)
+            return _really_read_file(fn)
+
+    if args.bench is not None:
+        latencies = []
+        for _ in range(args.bench):
+            t = time.perf_counter()
+            T = read_ds18b20s()
+            latencies.append(time.perf_counter() - t)
+        print(f"{len(T)} probes, {args.bench} reads: median {1e3*statistics.median(latencies):.1f} ms, max {1e3*max(latencies):.1f} ms")
+        print(f"errors: {_get_probe_reader().errors}")
+        sys.exit(0)
 
     should_continue = True
+    startup.report()
 
     try:
         asyncio.get_event_loop().run_until_complete(asyncio.gather(
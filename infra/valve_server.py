@@ -1,35 +1,132 @@
-import logging, time, json, os, sys, redis
+import logging, time, json, os, sys, queue, threading, contextvars
 import RPi.GPIO as GPIO
 sys.path.append('..')
-from common import send_to_one_true_master
+from common import send_to_one_true_master, get_redis, current_tank, tank_key, StartupTimer
 from common import beep as _beep
+import metrics
 
 
 logger = logging.getLogger(__name__)
+redis_server = get_redis()
 
 _valve_pin_map = {'cold':17, 'hot':22, 'ambient':27}
 
 
+def _pin_map():
+    # supervisor mode: each tank has its own pins
+    tank = current_tank()
+    if tank is not None and tank.pins is not None:
+        return tank.pins
+    return _valve_pin_map
+
+
+# One valve op at a time per tank, as under the (single-threaded) XML-RPC
+# server: the supervisor calls these from threads, and set_valves()
+# closing before opening only holds if nothing else gets in between.
+# Other tanks' ops don't wait.
+_valve_locks = {}
+_valve_locks_lock = threading.Lock()
+
+
+def _valve_lock():
+    with _valve_locks_lock:
+        return _valve_locks.setdefault(tank_key(''), threading.Lock())
+
+
+def _write_valve(valve, state):
+    """GPIO + redis only. Returns the timestamp if this was an edge,
+    None otherwise."""
+    ts = time.time()
+    level = GPIO.HIGH if state else GPIO.LOW
+    pin = _pin_map()[valve]
+
+    with metrics.span('valve_server.gpio'):
+        GPIO.setup(pin, GPIO.OUT)
+        prev_state = GPIO.input(pin)
+        GPIO.output(pin, level)
+    with metrics.span('valve_server.redis'):
+        redis_server.set(tank_key(valve), json.dumps(bool(state)))
+    if prev_state != level:
+        metrics.count(f"valve_server.toggle.{valve}")
+        return ts
+    return None
+
+
+# The edges go out from a thread of their own: a broker that's slow to
+# confirm (a resource alarm can hold a publish for 30 s) must not hold up
+# the valves (see the design notes in valve_on()). If it's down for
+# long, whatever doesn't fit in the queue is dropped (and counted).
+TELEMETRY_QUEUE_SIZE = 1000
+_telemetry = queue.Queue(maxsize=TELEMETRY_QUEUE_SIZE)
+_telemetry_thread = None
+_telemetry_lock = threading.Lock()
+
+
+def _send_edge(valve, state, ts):
+    try:
+        with metrics.span('valve_server.telemetry'):
+            send_to_one_true_master('valve', {'ts':ts, 'valve_id':valve, 'valve_state':bool(state), }, )
+    except:
+        logger.exception('whatever')
+
+
+def _telemetry_worker():
+    while True:
+        # (run in the caller's context: its tank, in supervisor mode)
+        context, valve, state, ts = _telemetry.get()
+        context.run(_send_edge, valve, state, ts)
+
+
+def _report_edge(valve, state, ts):
+    global _telemetry_thread
+    if ts is not None:
+        with _telemetry_lock:
+            if _telemetry_thread is None or not _telemetry_thread.is_alive():
+                _telemetry_thread = threading.Thread(target=_telemetry_worker, name='valve-telemetry', daemon=True)
+                _telemetry_thread.start()
+        try:
+            _telemetry.put_nowait((contextvars.copy_context(), valve, state, ts, ))
+        except queue.Full:
+            metrics.count('valve_server.telemetry.dropped')
+            logger.warning(f"telemetry queue full; {valve} edge not reported")
+    else:
+        logger.debug('new=old, skip telemetry')
+    metrics.flush()
+
+
+def set_valves(states):
+    """Apply all of {'hot':False, 'cold':True, 'ambient':False} in one
+    call. Closing first, then opening, so hot and cold are never both
+    open in between. Telemetry is queued after all the GPIO writes.
+
+    Returns the resulting valve states.
+    """
+    for valve in states:
+        if valve not in _pin_map():
+            raise ValueError(f"unknown valve {valve}")
+    logger.info(f"{states}")
+
+    edges = []
+    with _valve_lock():
+        for state in [False, True]:
+            for valve,v in states.items():
+                if bool(v) == state:
+                    edges.append((valve, state, _write_valve(valve, state), ))
+    for valve,state,ts in edges:
+        _report_edge(valve, state, ts)
+    return {valve:get_valve_state(valve) for valve in states}
+
+
 def valve_on(valve):
     logger.info(f"{valve} on")
 
-    ts = time.time()
-    
-    GPIO.setup(_valve_pin_map[valve], GPIO.OUT)
-    prev_state = GPIO.input(_valve_pin_map[valve])
-    GPIO.output(_valve_pin_map[valve], GPIO.HIGH)
-    redis_server.set(valve, json.dumps(True))
+    with _valve_lock():
+        ts = _write_valve(valve, True)
 
     # Using a queue (which consumes local resources) means you can't
     # defer edge detection to server, because now every update incurs
     # memory cost locally, whether there was indeed a valve op or not.
-    if prev_state != GPIO.HIGH:
-        try:
-            send_to_one_true_master('valve', {'ts':ts, 'valve_id':valve, 'valve_state':True, }, )
-        except:
-            logger.exception('whatever')
-    else:
-        logger.debug('new=old, skip telemetry')
+    _report_edge(valve, True, ts)
 
     # This might look like a reasonble place to send update via MQTT,
     # guarded by catch-all even. But the problem is some network
@@ -78,20 +175,9 @@ def valve_on(valve):
 def valve_off(valve):
     logger.info(f"{valve} off")
 
-    ts = time.time()
-    
-    GPIO.setup(_valve_pin_map[valve], GPIO.OUT)
-    prev_state = GPIO.input(_valve_pin_map[valve])
-    GPIO.output(_valve_pin_map[valve], GPIO.LOW)
-    redis_server.set(valve, json.dumps(False))
-
-    if prev_state != GPIO.LOW:
-        try:
-            send_to_one_true_master('valve', {'ts':ts, 'valve_id':valve, 'valve_state':False, }, )
-        except:
-            logger.exception('whatever')
-    else:
-        logger.debug('new=old, skip telemetry')
+    with _valve_lock():
+        ts = _write_valve(valve, False)
+    _report_edge(valve, False, ts)
 
 
 def beep(second):
@@ -104,7 +190,7 @@ def get_valve_state(valve):
         # changes, yet one more place to remember to update...
         #return GPIO.HIGH == GPIO.input(_valve_pin_map[valve])
         # alternatively:
-        return json.loads(redis_server.get(valve))
+        return json.loads(redis_server.get(tank_key(valve)))
     except:
         # unknown, or whatever.
         return None
@@ -112,6 +198,8 @@ def get_valve_state(valve):
 
 if '__main__' == __name__:
 
+    startup = StartupTimer('valve_server')
+
     logging.basicConfig(level=logging.DEBUG)
     logger.setLevel(logging.DEBUG)
     logging.getLogger('pika').setLevel(logging.WARNING)
@@ -121,7 +209,6 @@ if '__main__' == __name__:
     GPIO.setmode(GPIO.BCM)
     GPIO.setwarnings(False)
 
-    redis_server = redis.StrictRedis(host='localhost', port=6379, db=0)
     for k in _valve_pin_map:
         redis_server.delete(k)
 
@@ -129,8 +216,10 @@ if '__main__' == __name__:
         server = SimpleXMLRPCServer(('localhost', 8001), allow_none=True, logRequests=False)
         server.register_function(valve_on, 'valve_on')
         server.register_function(valve_off, 'valve_off')
+        server.register_function(set_valves, 'set_valves')
         server.register_function(get_valve_state, 'get_valve_state')
         server.register_function(beep, 'beep')
+        startup.report()
         server.serve_forever()
     except KeyboardInterrupt:
         print('user interrupted')
@@ -0,0 +1,200 @@
+"""Always-on timing of the hot paths: how long each stage of a loop
+takes (config, setpoint, redis, valve RPC...), plus a few counters
+(valve toggles, exceptions).
+
+    with metrics.span('eztank.setpoint'):
+        setpoint = get_setpoint()
+    metrics.count('valve_server.toggle.hot')
+    metrics.flush()         # every loop; only writes every FLUSH_SECOND
+
+Spans use perf_counter (monotonic). Each stage is a fixed set of
+buckets, so memory doesn't grow with uptime and recording is a bisect
+and an increment. An exception escaping a span is counted as
+"<stage>.exception" (and passed on).
+
+Every process keeps its own numbers and, every FLUSH_SECOND, writes
+them into the redis hash "metrics" (tank_key'd in supervisor mode), one
+field per stage:
+
+    h:eztank.setpoint   [n, sum, max, [count per bucket]]
+    c:eztank.exception  n
+    ts                  time of the last flush
+
+The web app renders all of that as Prometheus text at /metrics
+(render_prometheus()). Numbers are since the process started; a
+restart resets them, which Prometheus copes with.
+
+SL2021
+"""
+import logging, time, json, bisect
+from contextlib import contextmanager
+from common import get_redis, current_tank, tank_key
+
+
+logger = logging.getLogger(__name__)
+
+
+METRICS_KEY = 'metrics'
+FLUSH_SECOND = 10
+
+# upper bounds, in seconds: 50 µs to 30 s, 1-2.5-5 steps. The Pi's
+# GPIO/redis calls are at the bottom, the probes (~750 ms each) and a
+# misbehaving HIMB network at the top.
+BUCKETS = (5e-5, 1e-4, 2.5e-4, 5e-4,
+           1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, )
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0]*(len(BUCKETS) + 1)    # the last one is +Inf
+        self.n = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, second):
+        self.counts[bisect.bisect_left(BUCKETS, second)] += 1
+        self.n += 1
+        self.sum += second
+        if second > self.max:
+            self.max = second
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q-quantile falls in (capped at
+        the max seen). NaN if empty."""
+        return quantile(self.counts, q, self.max)
+
+    def dump(self):
+        return [self.n, round(self.sum, 6), round(self.max, 6), self.counts]
+
+
+def quantile(counts, q, max_=float('inf')):
+    n = sum(counts)
+    if not n:
+        return float('nan')
+    target = q*n
+    seen = 0
+    for i,c in enumerate(counts):
+        seen += c
+        if seen >= target and c:
+            return min(BUCKETS[i] if i < len(BUCKETS) else max_, max_)
+    return max_
+
+
+class _Registry:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.flushed = 0
+
+
+# one per tank (supervisor mode); None is the one-tank-per-Pi case
+_registries = {}
+
+
+def _registry():
+    tank = current_tank()
+    k = None if tank is None else tank.name
+    reg = _registries.get(k)
+    if reg is None:
+        reg = _registries[k] = _Registry()
+    return reg
+
+
+def observe(stage, second):
+    reg = _registry()
+    h = reg.histograms.get(stage)
+    if h is None:
+        h = reg.histograms[stage] = Histogram()
+    h.observe(second)
+
+
+def count(event, n=1):
+    reg = _registry()
+    reg.counters[event] = reg.counters.get(event, 0) + n
+
+
+@contextmanager
+def span(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count(f"{stage}.exception")
+        raise
+    finally:
+        observe(stage, time.perf_counter() - t0)
+
+
+def flush(*, force=False):
+    """Write this process's numbers to redis, at most once every
+    FLUSH_SECOND (unless force). Never raises: no metrics is better than
+    no control loop."""
+    reg = _registry()
+    now = time.monotonic()
+    if not force and now - reg.flushed < FLUSH_SECOND:
+        return
+    reg.flushed = now
+    mapping = {f"h:{stage}":json.dumps(h.dump(), separators=(',', ':')) for stage,h in reg.histograms.items()}
+    mapping.update({f"c:{event}":n for event,n in reg.counters.items()})
+    if not len(mapping):
+        return
+    mapping['ts'] = time.time()
+    try:
+        get_redis().hset(tank_key(METRICS_KEY), mapping=mapping)
+    except Exception:
+        logger.debug('could not flush the metrics', exc_info=True)
+
+
+def _label(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _fmt(v):
+    return repr(float(v)) if v == v else 'NaN'
+
+
+def render_prometheus(redis_server):
+    """Prometheus text format (0.0.4) from the "metrics" hashes in
+    redis: the one-tank one, and "<tank>:metrics" for each supervised
+    tank."""
+    keys = [METRICS_KEY] + sorted(k.decode() if isinstance(k, bytes) else k
+                                  for k in redis_server.scan_iter(f"*:{METRICS_KEY}"))
+    histograms = []
+    counters = []
+    for key in keys:
+        tank = key[:-len(METRICS_KEY) - 1]
+        for field,value in redis_server.hgetall(key).items():
+            field = field.decode() if isinstance(field, bytes) else field
+            try:
+                if field.startswith('h:'):
+                    histograms.append((tank, field[2:], json.loads(value)))
+                elif field.startswith('c:'):
+                    counters.append((tank, field[2:], int(value)))
+            except ValueError:
+                logger.warning(f"{key} {field}: {value}")
+
+    lines = ['# HELP tankcontrol_stage_seconds Time spent in each stage of the control loops.',
+             '# TYPE tankcontrol_stage_seconds histogram']
+    for tank,stage,(n,total,_,counts) in histograms:
+        labels = f'tank="{_label(tank)}",stage="{_label(stage)}"'
+        cumulative = 0
+        for le,c in zip(BUCKETS + ('+Inf', ), counts):
+            cumulative += c
+            lines.append(f'tankcontrol_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'tankcontrol_stage_seconds_sum{{{labels}}} {_fmt(total)}')
+        lines.append(f'tankcontrol_stage_seconds_count{{{labels}}} {n}')
+    # the histogram is enough for Prometheus; these are for a human
+    # with curl
+    for name,what,f in [('max', 'Longest', lambda counts,max_:max_),
+                        ('p99', '99th percentile (bucket upper bound) of the', lambda counts,max_:quantile(counts, 0.99, max_)),
+                        ]:
+        lines.append(f'# HELP tankcontrol_stage_{name}_seconds {what} time spent in each stage since the process started.')
+        lines.append(f'# TYPE tankcontrol_stage_{name}_seconds gauge')
+        for tank,stage,(_,_,max_,counts) in histograms:
+            lines.append(f'tankcontrol_stage_{name}_seconds{{tank="{_label(tank)}",stage="{_label(stage)}"}} {_fmt(f(counts, max_))}')
+    lines.append('# HELP tankcontrol_events_total Valve toggles, exceptions...')
+    lines.append('# TYPE tankcontrol_events_total counter')
+    for tank,event,n in counters:
+        lines.append(f'tankcontrol_events_total{{tank="{_label(tank)}",event="{_label(event)}"}} {n}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,165 @@
+"""Look-ahead control: instead of reacting to the nearest setpoint, plan
+the valves over the next stretch of the profile with a (very) simple
+model of the tank.
+
+The model is first order:
+
+    dT/dt = a + b*T + h*hot + c*cold + m*ambient
+
+where hot, cold, ambient are the valve duty cycles (0~1). a and b lump
+together the ambient losses, h > 0 and c < 0 are the heating and
+cooling rates. It's fitted by least squares from the tank_temperature
+table (t0c plus the duty cycles logged by temp_log, once a minute).
+
+Each loop the controller simulates every candidate duty sequence over
+the horizon in one go (NumPy, [candidates, steps]) and picks the
+cheapest: squared tracking error, plus a little for every valve
+opening and for water. Only the first move is applied; next loop it
+plans again. The candidates are piecewise constant: the first step at
+one of a few signed duty levels (positive = hot, negative = cold), then
+a couple of longer blocks at an average duty cycle, which can be small:
+the tank may need a minute of hot water in ten, not a quarter of every
+minute. A couple of thousand sequences cover it and a plan takes
+milliseconds even on a Pi.
+
+SL2021
+"""
+import logging, itertools, time
+import numpy as np
+import records
+
+
+logger = logging.getLogger(__name__)
+
+
+# The tank's own pull toward room temperature (b) is hours: closed-loop
+# history, the tank held within a fraction of a degree, hardly pins it
+# down, and probe noise in T drags the estimate toward "much faster".
+# A model that thinks the tank settles by itself in minutes won't bother
+# steering it.
+MIN_TIME_CONSTANT_SECOND = 3*3600
+
+
+def load_history(second, *, now=None, dbfn=None, table='tank_temperature'):
+    """(ts, t0c, hot, cold, ambient) arrays from tank_temperature (or
+    "table") for the last "second" seconds. Rows without a reading or
+    without duty cycles are dropped."""
+    now = time.time() if now is None else now
+    with records.connect(records.RECORDS_DB if dbfn is None else dbfn) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""SELECT ts, t0c, hot, cold, ambient
+                       FROM {table}
+                       WHERE ts >= ?
+                       AND t0c IS NOT NULL
+                       AND hot IS NOT NULL
+                       ORDER BY ts""", (now - second, ))
+        rows = cur.fetchall()
+    if not len(rows):
+        return tuple(np.empty(0) for _ in range(5))
+    return tuple(np.array(c, dtype=float) for c in zip(*rows))
+
+
+class ThermalModel:
+    def __init__(self, theta):
+        # theta = (a, b, h, c, m)
+        self.theta = np.asarray(theta, dtype=float)
+
+    def __repr__(self):
+        a,b,h,c,m = self.theta
+        return f"ThermalModel(a={a:.3g}, b={b:.3g}, h={h:.3g}, c={c:.3g}, m={m:.3g})"
+
+    @classmethod
+    def fit(cls, ts, T, hot, cold, ambient, *, max_gap_second=180, min_samples=30):
+        """Least squares over consecutive samples. None if there isn't
+        enough data, or if the data says heating doesn't heat (or cooling
+        doesn't cool), e.g. the hot valve was never opened in that
+        window."""
+        ts, T = np.asarray(ts, dtype=float), np.asarray(T, dtype=float)
+        dt = np.diff(ts)
+        ok = (dt > 0) & (dt <= max_gap_second) & np.isfinite(T[1:]) & np.isfinite(T[:-1])
+        if ok.sum() < min_samples:
+            logger.warning(f"only {ok.sum()} usable samples; no model")
+            return None
+
+        y = (np.diff(T)/np.where(dt > 0, dt, 1))[ok]
+        # about the mean temperature, so that a is the drift there
+        # whatever b turns out to be
+        T_mean = T[:-1][ok].mean()
+        # temp_log samples the duty cycles at its own point in the
+        # minute, not the thermostat's: a step's water shows up partly
+        # under the row that logged it and partly under the one before.
+        # Both ends of each interval, then, and the sum is the rate.
+        hot, cold, ambient = (np.asarray(x, dtype=float) for x in (hot, cold, ambient))
+        X = np.column_stack([np.ones(len(T) - 1), T[:-1] - T_mean,
+                             hot[:-1], hot[1:], cold[:-1], cold[1:], ambient[:-1], ambient[1:]])[ok]
+        beta, *_ = np.linalg.lstsq(X, y, rcond=None)
+        theta = np.concatenate([beta[:2], beta[2::2] + beta[3::2]])
+        if not (theta[2] > 0 and theta[3] < 0):
+            logger.warning(f"implausible fit {theta}; no model")
+            return None
+        # no runaway tanks, and none that settle by themselves in minutes
+        theta[1] = min(0, max(-1/MIN_TIME_CONSTANT_SECOND, theta[1]))
+        theta[0] -= theta[1]*T_mean
+        return cls(theta)
+
+    def simulate(self, T0, hot, cold, step_second, *, ambient=None):
+        """T0: scalar or [N]; hot, cold (, ambient): [N, steps] duty
+        cycles. Returns [N, steps] temperatures at the end of each step
+        (forward Euler)."""
+        a,b,h,c,m = self.theta
+        hot = np.atleast_2d(hot)
+        cold = np.atleast_2d(cold)
+        ambient = np.zeros_like(hot) if ambient is None else np.atleast_2d(ambient)
+        T = np.broadcast_to(np.asarray(T0, dtype=float), hot.shape[:1]).copy()
+        out = np.empty(hot.shape)
+        for k in range(hot.shape[1]):
+            T = T + step_second*(a + b*T + h*hot[:, k] + c*cold[:, k] + m*ambient[:, k])
+            out[:, k] = T
+        return out
+
+
+class LookaheadController:
+    def __init__(self, model, *, levels=9, rates=(1/32, 1/16, 1/8, 1/4, 1/2, 1), blocks=3, open_penalty=0.005, use_penalty=0.002):
+        self.model = model
+        # what can be applied now; and the average duty cycles after that
+        self.levels = np.linspace(-1, 1, levels)
+        rates = np.asarray(rates, dtype=float)
+        self.rates = np.concatenate([-rates[::-1], [0], rates])
+        self.blocks = blocks
+        self.open_penalty = open_penalty
+        self.use_penalty = use_penalty
+        # a level now, then a rate per block: [candidates, blocks]
+        self.candidates = np.array([(u, ) + r for u in self.levels for r in itertools.product(self.rates, repeat=blocks - 1)])
+
+    def plan(self, T0, setpoints, step_second, *, u_prev=0.0):
+        """setpoints: [steps] profile values over the horizon (NaN = don't
+        care). Returns (u, predicted temperatures) for the best candidate;
+        u is the signed duty cycle to apply now. (None, None) if there's
+        nothing to track in the horizon. u_prev: the signed duty cycle
+        applied last step."""
+        setpoints = np.asarray(setpoints, dtype=float)
+        care = np.isfinite(setpoints)
+        if not care.any():
+            return None, None
+
+        steps = len(setpoints)
+        assert steps >= self.blocks
+        # one step first (the move we actually apply), then longer and
+        # longer blocks
+        edges = 1 + (np.linspace(0, 1, self.blocks)**2*(steps - 1)).round().astype(int)
+        edges = np.concatenate([[0], np.maximum(edges, np.arange(1, self.blocks + 1))])
+        block_len = np.diff(edges)
+        U = np.repeat(self.candidates, block_len, axis=1)      # [candidates, steps]
+        T = self.model.simulate(T0, np.clip(U, 0, 1), np.clip(-U, 0, 1), step_second)
+
+        err = (T - setpoints)[:, care]
+        J = (err**2).mean(axis=1)
+        before = np.column_stack([np.full(len(U), u_prev), self.candidates[:, :-1]])
+        # Valve openings. Now: the PWM tender opens once at a fractional
+        # duty, and a fully open valve stays open. Later blocks are
+        # averages; a later plan can make each of them one run.
+        opens = (self.candidates != 0) & ((np.abs(self.candidates) < 1) | (self.candidates != before))
+        J = J + self.open_penalty*opens.sum(axis=1) + self.use_penalty*np.abs(U).mean(axis=1)
+
+        best = int(np.argmin(J))
+        return float(U[best, 0]), T[best]
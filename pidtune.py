@@ -0,0 +1,300 @@
+"""PID gain sweep: thousands of (Kp, Ki, Kd, this_many, this_old) at once
+against a tank model and a setpoint trace, ranked.
+
+    python3 pidtune.py --history-day 3 --profile profile.csv --day 2 \\
+        --kp 0.5,1,2,4,8 --ki 0,1e-4,3e-4,1e-3 --kd 0,30,100 \\
+        --this-many 5,10,20 --this-old 300,600,1200
+
+The model is mpc.ThermalModel, fitted from records.db (--history-day) or
+given (--theta a,b,h,c,m). The controller is eztank's pid mode: full
+heating/cooling outside the deadband, PID duty cycle inside through
+eztank.pid_to_tank_state() (shut below PID_min_duty, or half of it if
+that valve is already on; fully open within PID_min_duty of 1), and the
+PID (same I and D as PID.PID: trapezoid and least-squares slope over the
+last this_many samples no older than this_old) sees every valid sample.
+Not modelled: the alarms, pwm_min_actuation_second, probe quantization.
+
+Everything is [candidates] arrays stepped through time together, so the
+cost is one pass over the trace whatever the number of candidates. The
+I and D window sums come from running cumulative sums (a ring of
+window-size columns), O(1) per step per candidate. With a plant that
+isn't cheap to vectorize, --processes splits the candidates over a
+process pool.
+
+Ranked by a weighted sum of IAE, overshoot and valve switching, each
+divided by its median over the candidates (see rank()); ISE is
+reported too.
+
+SL2021
+"""
+import logging, itertools, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+METRICS = ('iae', 'ise', 'overshoot', 'switches', )
+DEFAULT_WEIGHTS = {'iae':1.0, 'overshoot':0.5, 'switches':0.25, }
+# a setpoint change at least this big is a step (smaller: a ramp)
+STEP_CELSIUS = 0.1
+
+
+def grid(kp, ki, kd, this_many, this_old):
+    """Every combination. Returns (K [C, 3], this_many [C], this_old
+    [C])."""
+    combos = np.array(list(itertools.product(kp, ki, kd, this_many, this_old)), dtype=float)
+    return combos[:, :3], combos[:, 3].astype(int), combos[:, 4]
+
+
+def evaluate(plant, setpoints, step_second, K, this_many, this_old, *, T0=None, deadband=None, min_duty=0.2, i_limit=1.0, noise=0.0, seed=None, processes=None):
+    """Closed-loop run of every candidate. plant: anything with
+    ThermalModel's simulate(); setpoints: [steps] (NaN = NA, valves
+    neutral, the PID isn't fed); K [C, 3], this_many and this_old [C]
+    (or scalars). noise: probe noise (°C, normal), the same for every
+    candidate. deadband None means PID everywhere. min_duty:
+    PID_min_duty.
+
+    Returns {metric:[C]} (see METRICS), plus 'T': [C, steps]
+    temperatures."""
+    K = np.atleast_2d(np.asarray(K, dtype=float))
+    C = len(K)
+    this_many = np.broadcast_to(np.asarray(this_many, dtype=int), (C, )).copy()
+    this_old = np.broadcast_to(np.asarray(this_old, dtype=float), (C, )).copy()
+    assert (this_many >= 1).all()
+    setpoints = np.asarray(setpoints, dtype=float)
+    rng = np.random.default_rng(seed)
+    noise = noise*rng.standard_normal(len(setpoints))
+
+    if processes is not None and processes > 1 and C > 1:
+        chunks = np.array_split(np.arange(C), min(processes, C))
+        with ProcessPoolExecutor(processes) as executor:
+            parts = list(executor.map(_evaluate,
+                                      *zip(*[(plant, setpoints, step_second, K[i], this_many[i], this_old[i], T0, deadband, min_duty, i_limit, noise) for i in chunks])))
+        return {k:np.concatenate([part[k] for part in parts]) for k in parts[0]}
+    return _evaluate(plant, setpoints, step_second, K, this_many, this_old, T0, deadband, min_duty, i_limit, noise)
+
+
+def _evaluate(plant, setpoints, step_second, K, this_many, this_old, T0, deadband, min_duty, i_limit, noise):
+    C = len(K)
+    steps = len(setpoints)
+    valid = np.isfinite(setpoints)
+    if T0 is None:
+        T0 = setpoints[valid][0] if valid.any() else 25.0
+    T = np.full(C, float(T0))
+    rows = np.arange(C)
+
+    # Times are in steps (integers, so the shared sums are exact); the
+    # per-second conversions are at the end. The window of a candidate
+    # never holds more than this many samples:
+    R = int(min(this_many.max(), this_old.max()//step_second + 1)) + 1
+    # ring of cumulative sums, indexed by sample count mod R: sum of e,
+    # of k*e, trapezoid sum up to that sample
+    Se = np.zeros((C, R))
+    Ske = np.zeros((C, R))
+    Strap = np.zeros((C, R))
+    ks = np.zeros(R, dtype=np.int64)        # step of each sample (ring too)
+    m = 0                                   # samples so far
+    e_prev = np.zeros(C)
+
+    iae = np.zeros(C)
+    ise = np.zeros(C)
+    overshoot = np.zeros(C)
+    switches = np.zeros(C, dtype=int)
+    approach = np.zeros(C)      # sign of the error when the setpoint last moved
+    sp_prev = float('nan')
+    moving = False
+    hot_prev = np.zeros(C)
+    cold_prev = np.zeros(C)
+    out = np.empty((C, steps))
+
+    for k in range(steps):
+        out[:, k] = T
+        sp = setpoints[k]
+        hot = np.zeros(C)
+        cold = np.zeros(C)
+        if valid[k]:
+            pv = T + noise[k]
+            e = sp - pv
+
+            # PID.update(), for all candidates
+            i = m % R
+            j = (m - 1) % R
+            ks[i] = k
+            if m:
+                Se[:, i] = Se[:, j] + e
+                Ske[:, i] = Ske[:, j] + k*e
+                Strap[:, i] = Strap[:, j] + 0.5*(k - ks[j])*(e_prev + e)
+            else:
+                Se[:, i] = e
+                Ske[:, i] = k*e
+                Strap[:, i] = 0.0
+            m += 1
+            # oldest sample in the window: not older than this_old, not
+            # more than this_many back
+            recent = ks[(m - 1 - np.arange(min(m, R) - 1, -1, -1)) % R]    # oldest first
+            first_young = np.searchsorted(recent, k - this_old/step_second, side='left')
+            n = np.minimum(np.minimum(len(recent) - first_young, this_many), R - 1)
+            n = np.maximum(n, 1)
+            # sums over the last n samples: cumulative[m-1] - cumulative[m-1-n]
+            before = (m - 1 - n) % R
+            has_before = m - 1 - n >= 0
+            se = Se[:, i] - np.where(has_before, Se[rows, before], 0)
+            ske = Ske[:, i] - np.where(has_before, Ske[rows, before], 0)
+            # the trapezoid between the oldest sample in the window and
+            # the one before it is not in the window
+            oldest = (m - n) % R
+            trap = Strap[:, i] - Strap[rows, oldest]
+            # sum of k and k^2 over the window's steps
+            kk = recent[::-1]                   # newest first
+            ck = np.concatenate([[0], np.cumsum(kk)])
+            ckk = np.concatenate([[0], np.cumsum(kk.astype(float)**2)])
+            sk = ck[n].astype(float)
+            skk = ckk[n]
+            denominator = n*skk - sk*sk
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = np.where(denominator > 0, (n*ske - sk*se)/denominator, 0.0)
+            ei = np.where(n >= 2, trap*step_second, 0.0)
+            ed = np.where(n >= 2, slope/step_second, 0.0)
+            u = K[:, 0]*e + np.clip(K[:, 1]*ei, -i_limit, i_limit) + K[:, 2]*ed
+            e_prev = e
+
+            # eztank's pid mode: pid_to_tank_state(), the previous
+            # tank_state being whichever valve was on
+            duty = np.minimum(1.0, np.abs(u))
+            was_on = np.where(u > 0, hot_prev > 0, cold_prev > 0)
+            duty = np.where(duty < np.where(was_on, min_duty/2, min_duty), 0.0, duty)
+            duty = np.where(duty > 1 - min_duty, 1.0, duty)
+            hot = np.where(u > 0, duty, 0.0)
+            cold = np.where(u < 0, duty, 0.0)
+            if deadband is not None:
+                too_hot = pv >= sp + deadband/2
+                too_cold = pv <= sp - deadband/2
+                hot = np.where(too_cold, 1.0, np.where(too_hot, 0.0, hot))
+                cold = np.where(too_hot, 1.0, np.where(too_cold, 0.0, cold))
+
+            err = T - sp
+            iae += np.abs(err)*step_second
+            ise += err*err*step_second
+            # overshoot: past a held setpoint, on the other side from
+            # where it came from. Ramps don't count.
+            if abs(sp - sp_prev) >= STEP_CELSIUS or sp_prev != sp_prev:
+                approach = np.sign(-err)
+                moving = False
+            elif abs(sp - sp_prev) > 1e-9:
+                approach = np.zeros(C)
+                moving = True
+            elif moving:
+                approach = np.sign(-err)
+                moving = False
+            overshoot = np.maximum(overshoot, approach*err)
+            sp_prev = sp
+
+        # valve edges: each period is ON for duty, then OFF
+        for d,d_prev in [(hot, hot_prev), (cold, cold_prev)]:
+            switches += ((d > 0) & (d_prev < 1)).astype(int) + ((d > 0) & (d < 1)).astype(int)
+        hot_prev, cold_prev = hot, cold
+
+        T = plant.simulate(T, hot[:, None], cold[:, None], step_second)[:, 0]
+
+    return {'iae':iae, 'ise':ise, 'overshoot':overshoot + 0.0, 'switches':switches, 'T':out, }
+
+
+def rank(result, *, weights=None):
+    """Candidate indices, best first. Cost: sum of weight*metric/median
+    (over the candidates) for each metric in weights."""
+    weights = DEFAULT_WEIGHTS if weights is None else weights
+    cost = np.zeros(len(result['iae']))
+    for metric,w in weights.items():
+        v = np.asarray(result[metric], dtype=float)
+        scale = np.median(v)
+        cost += w*v/(scale if scale > 0 else 1.0)
+    return np.argsort(cost, kind='stable'), cost
+
+
+def default_trace(step_second, *, day=1.0):
+    """Something with steps and ramps in it: 26 °C, +1 °C step at 2 h,
+    ramp back down to 25.5 °C over 6 h, then a daily sine."""
+    t = np.arange(0, day*24*3600, step_second, dtype=float)
+    sp = np.full(len(t), 26.0)
+    sp[t >= 2*3600] = 27.0
+    ramp = (t >= 8*3600) & (t < 14*3600)
+    sp[ramp] = 27.0 - 1.5*(t[ramp] - 8*3600)/(6*3600)
+    late = t >= 14*3600
+    sp[late] = 25.5 + 0.5*np.sin(2*np.pi*(t[late] - 14*3600)/(24*3600))
+    return sp
+
+
+if '__main__' == __name__:
+
+    import argparse
+    from mpc import ThermalModel, load_history
+
+    def floats(s):
+        return [float(x) for x in s.split(',')]
+
+    parser = argparse.ArgumentParser(description='Sweep PID gains against a tank model.')
+    parser.add_argument('--theta', type=floats, default=None, help='a,b,h,c,m (see mpc.ThermalModel)')
+    parser.add_argument('--history-day', type=float, default=3, help='otherwise: fit from this many days of records.db')
+    parser.add_argument('--profile', default=None, help='setpoint trace from this profile.csv (default: a synthetic one)')
+    parser.add_argument('--start', type=float, default=None, help='POSIX time in the profile to start at (default: its start)')
+    parser.add_argument('--day', type=float, default=1.0)
+    parser.add_argument('--step', type=int, default=60, help='thermostat_loop_period_second')
+    parser.add_argument('--deadband', type=float, default=0.2, help='deadband_celsius (negative: PID everywhere)')
+    parser.add_argument('--min-duty', type=float, default=0.2, help='PID_min_duty')
+    parser.add_argument('--noise', type=float, default=0.02, help='probe noise, °C')
+    parser.add_argument('--kp', type=floats, default=[1, 2.5, 5, 10, 20])
+    parser.add_argument('--ki', type=floats, default=[0, 1e-4, 3e-4, 1e-3, 3e-3])
+    parser.add_argument('--kd', type=floats, default=[0, 10, 30, 100])
+    parser.add_argument('--this-many', type=floats, default=[5, 10, 20])
+    parser.add_argument('--this-old', type=floats, default=[300, 600, 1200])
+    parser.add_argument('--i-limit', type=float, default=1.0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.theta is not None:
+        model = ThermalModel(args.theta)
+    else:
+        model = ThermalModel.fit(*load_history(args.history_day*24*3600))
+        if model is None:
+            raise SystemExit('no usable history; try --theta')
+    logger.info(f"{model}")
+
+    if args.profile is not None:
+        from temperature_profile import ProfileIndex, ingest_csv
+        ingest_csv(args.profile, if_changed=True)
+        index = ProfileIndex(args.profile)
+        index.refresh(force=True)
+        start = float(index.ts[0]) if args.start is None else args.start
+        _,setpoints = index.preview(start, start + args.day*24*3600, args.step)
+    else:
+        setpoints = default_trace(args.step, day=args.day)
+
+    K, this_many, this_old = grid(args.kp, args.ki, args.kd, args.this_many, args.this_old)
+    t0 = time.perf_counter()
+    result = evaluate(model, setpoints, args.step, K, this_many, this_old,
+                      deadband=args.deadband if args.deadband >= 0 else None,
+                      min_duty=args.min_duty,
+                      i_limit=args.i_limit,
+                      noise=args.noise,
+                      seed=args.seed,
+                      processes=args.processes)
+    logger.info(f"{len(K)} candidates x {len(setpoints)} steps in {time.perf_counter() - t0:.2f} s")
+
+    order, cost = rank(result)
+    hours = len(setpoints)*args.step/3600
+    print(f"{'kp':>8} {'ki':>8} {'kd':>8} {'many':>5} {'old':>6} | {'cost':>6} {'MAE °C':>7} {'RMS °C':>7} {'over °C':>7} {'edges/h':>7}")
+    for c in order[:args.top]:
+        kp,ki,kd = K[c]
+        print(f"{kp:8.3g} {ki:8.3g} {kd:8.3g} {this_many[c]:5d} {this_old[c]:6.0f} | "
+              f"{cost[c]:6.3f} {result['iae'][c]/(hours*3600):7.4f} {np.sqrt(result['ise'][c]/(hours*3600)):7.4f} "
+              f"{result['overshoot'][c]:7.3f} {result['switches'][c]/hours:7.1f}")
+    best = order[0]
+    print('\n# config.txt')
+    print(f"PID_P = {K[best, 0]:g}\nPID_I = {K[best, 1]:g}\nPID_D = {K[best, 2]:g}")
+    print(f"PID_history_max_count = {this_many[best]}\nPID_history_max_age_second = {this_old[best]:g}")
@@ -0,0 +1,303 @@
+"""Per-probe streaming filters, and one tank temperature out of them.
+
+The DS18B20 reads in steps of 0.0625 °C. One reading is one step of
+resolution, but the noise (and the water) moves it around, so averaging
+a minute's worth of readings gets under the step. The filters:
+
+    mean      rolling mean over the last "window" readings
+    median    rolling median over the same (robust, but still in steps
+              of 0.0625 °C)
+    kalman    scalar Kalman filter, random walk model (process noise q
+              °C^2/s, measurement noise r °C)
+
+The mean lags by half its window. Fine with the PID mode (which
+averages anyway), not so with bang-bang on a tank that moves fast: in
+the simulator (13 °C/h valves), a 12-reading mean costs twice the
+tracking error of no filter at all. The Kalman filter, with q sized for
+how fast the tank can move, barely lags; that's the one to try.
+
+temp_server only feeds them to the controller if probe_filter is set
+(config.txt); by default t0c stays the median of the probes, and the
+filtered t0f is published next to it for comparison.
+
+All of them are O(1) per reading and allocate nothing after the start:
+each probe has a preallocated ring buffer, the mean a running sum (and
+sum of squares, for its uncertainty), the median a count per 1/16 °C
+level plus a pointer that moves a level or two per reading.
+
+Before a reading gets to the filter:
+
+    - spikes: more than spike_celsius away from the current estimate is
+      dropped, unless spike_confirm readings in a row say so (then it's
+      a real step, e.g. the probe was moved, and the filter starts over
+      from there)
+    - stuck: the exact same value stuck_count times in a row (no LSB
+      flicker at all for that long) *and* more than stuck_celsius off
+      the median of the other probes, and the probe is left out of the
+      fused temperature until it moves again. Flat alone isn't enough: a
+      probe in a calm tank can sit on one 1/16 °C level for half an hour
+      and still be right (then it agrees with the others). A lone probe
+      is never left out: there's nothing to tell it's wrong
+
+fuse() combines the probes' estimates, weighted by 1/variance. Its
+uncertainty is the larger of what the weights say and the spread
+between the probes (they disagree by more than their noise until
+they're calibrated).
+
+The filters run on the raw readings (a new calibration doesn't look
+like a step to them); a per-probe calibration {sn: (a, b)} is applied
+to each probe's estimate, before fuse() (ProbeFuser.estimate()).
+
+SL2021
+"""
+import math, logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+FILTERS = ('none', 'mean', 'median', 'kalman', )
+RESOLUTION = 0.0625
+# a reading quantized to RESOLUTION is off by up to half a step: uniform,
+# so this much standard deviation
+QUANTIZATION_SIGMA = RESOLUTION/math.sqrt(12)
+
+
+class ProbeFilter:
+    def __init__(self, method='kalman', *, window=12, spike_celsius=0.5, spike_confirm=3, stuck_count=360, stuck_celsius=0.25, q=1e-4, r=0.03):
+        assert method in FILTERS
+        self.method = method
+        self.window = max(1, int(window))
+        self.spike_celsius = spike_celsius
+        self.spike_confirm = spike_confirm
+        self.stuck_count = stuck_count
+        self.stuck_celsius = stuck_celsius
+        self.q = q
+        self.r = r
+        self.spikes = 0
+        # flat: no change for stuck_count readings. stuck: flat and off
+        # from the other probes (ProbeFuser decides)
+        self.flat = False
+        self.stuck = False
+        self._ring = np.zeros(self.window)
+        self._same = 0
+        self._last_raw = None
+        self._pending = 0
+        self.reset()
+
+    def reset(self):
+        self._head = 0
+        self._n = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+        # median: readings per 1/16 °C level, and the level the lower
+        # median is at, with how many readings are below it
+        self._counts = {}
+        self._med = None
+        self._below = 0
+        self._m = 0
+        # kalman
+        self._x = None
+        self._p = None
+        self._ts = None
+
+    def __len__(self):
+        return self._n
+
+    def update(self, t, *, now=None):
+        """Feed one reading. Returns False if it was rejected (spike)."""
+        if self._last_raw is not None and t == self._last_raw:
+            self._same += 1
+        else:
+            self._same = 0
+        self._last_raw = t
+        self.flat = self._same + 1 >= self.stuck_count
+
+        estimate = self.estimate()[0]
+        if estimate == estimate and abs(t - estimate) > self.spike_celsius:
+            self._pending += 1
+            if self._pending < self.spike_confirm:
+                self.spikes += 1
+                return False
+            logger.info(f"step to {t:.3f} °C (from {estimate:.3f} °C); starting over")
+            self.reset()
+        self._pending = 0
+
+        if 'kalman' == self.method:
+            self._update_kalman(t, now)
+        else:
+            self._push(t)
+        return True
+
+    def _push(self, t):
+        if self._n == self.window:
+            old = float(self._ring[self._head])
+            self._sum -= old
+            self._sumsq -= old*old
+            self._median_remove(old)
+            self._head = (self._head + 1) % self.window
+            self._n -= 1
+        self._ring[(self._head + self._n) % self.window] = t
+        self._n += 1
+        self._sum += t
+        self._sumsq += t*t
+        self._median_add(t)
+        if not self._head and self._n == self.window:
+            # once per trip around the ring, so the add/subtract rounding
+            # doesn't pile up
+            self._sum = float(self._ring.sum())
+            self._sumsq = float(np.dot(self._ring, self._ring))
+
+    @staticmethod
+    def _level(t):
+        return int(round(t/RESOLUTION))
+
+    def _median_add(self, t):
+        level = self._level(t)
+        self._counts[level] = self._counts.get(level, 0) + 1
+        self._m += 1
+        if self._med is None:
+            self._med = level
+        elif level < self._med:
+            self._below += 1
+        self._median_settle()
+
+    def _median_remove(self, t):
+        level = self._level(t)
+        self._counts[level] -= 1
+        if not self._counts[level]:
+            del self._counts[level]
+        self._m -= 1
+        if level < self._med:
+            self._below -= 1
+        self._median_settle()
+
+    def _median_settle(self):
+        # lower median: the k-th reading (0-based), k = (m - 1)//2. The
+        # pointer only has to move as far as the median did, in levels.
+        if not self._m:
+            self._med = None
+            self._below = 0
+            return
+        k = (self._m - 1)//2
+        while self._below + self._counts.get(self._med, 0) <= k:
+            self._below += self._counts.get(self._med, 0)
+            self._med += 1
+        while self._below > k:
+            self._med -= 1
+            self._below -= self._counts.get(self._med, 0)
+
+    def _update_kalman(self, t, now):
+        if self._x is None or now is None or self._ts is None:
+            self._x, self._p = t, self.r*self.r
+        else:
+            dt = max(0.0, now - self._ts)
+            p = self._p + self.q*dt
+            k = p/(p + self.r*self.r)
+            self._x += k*(t - self._x)
+            self._p = (1 - k)*p
+        self._ts = now
+        self._n = min(self._n + 1, self.window)
+
+    def estimate(self):
+        """(°C, standard deviation of that, in °C). NaN if nothing yet."""
+        if not self._n:
+            return float('nan'), float('nan')
+        if 'kalman' == self.method:
+            return self._x, math.sqrt(self._p)
+        n = self._n
+        mean = self._sum/n
+        var = max(0.0, self._sumsq/n - mean*mean)
+        if 'none' == self.method:
+            return float(self._ring[(self._head + n - 1) % self.window]), max(math.sqrt(var), QUANTIZATION_SIGMA)
+        # standard error; never better than one reading's quantization
+        # over sqrt(n)
+        se = math.sqrt((var + QUANTIZATION_SIGMA**2)/n)
+        if 'median' == self.method:
+            return self._med*RESOLUTION, 1.2533*se
+        return mean, se
+
+
+def calibrate(probes, calibration, offset=0.0):
+    """{sn: a + b*t}, or t + offset for the probes calibration has
+    nothing for."""
+    r = {}
+    for sn,t in probes.items():
+        a, b = calibration.get(sn, (offset, 1.0))
+        r[sn] = a + b*t
+    return r
+
+
+def fuse(estimates):
+    """(°C, standard deviation) from [(°C, standard deviation), ...],
+    NaN if there's nothing to go on."""
+    estimates = [(t, s) for t,s in estimates if t == t and s == s]
+    if not len(estimates):
+        return float('nan'), float('nan')
+    t = np.array([e[0] for e in estimates])
+    w = 1/np.maximum(np.array([e[1] for e in estimates]), 1e-6)**2
+    fused = float((w*t).sum()/w.sum())
+    sigma = math.sqrt(1/w.sum())
+    if len(t) > 1:
+        # the probes disagree by more than their noise says? then that's
+        # the uncertainty
+        sigma = max(sigma, float(t.std(ddof=1))/math.sqrt(len(t)))
+    return fused, sigma
+
+
+class ProbeFuser:
+    """A ProbeFilter per probe (created as probes show up) and the fused
+    tank temperature."""
+    def __init__(self, method='kalman', **kwargs):
+        self.method = method
+        self.kwargs = kwargs
+        self.filters = {}
+
+    def configure(self, method, **kwargs):
+        """New settings start the filters over (only if they changed)."""
+        if (method, kwargs) != (self.method, self.kwargs):
+            self.method = method
+            self.kwargs = kwargs
+            self.filters = {}
+
+    def update(self, probes, *, now=None):
+        """probes: {sn: °C} (what temp_server read this time). Returns
+        (°C, standard deviation)."""
+        for sn,t in probes.items():
+            if t != t:
+                continue
+            if sn not in self.filters:
+                self.filters[sn] = ProbeFilter(self.method, **self.kwargs)
+            self.filters[sn].update(t, now=now)
+        return self.estimate(probes)
+
+    def estimate(self, probes, *, calibration=None, offset=0.0):
+        """Fused (°C, standard deviation) of the probes in probes, each
+        probe's estimate corrected first (see calibrate())."""
+        calibration = calibration or {}
+        estimates = {}
+        for sn,f in self.filters.items():
+            if sn not in probes:
+                continue
+            t, sigma = f.estimate()
+            a, b = calibration.get(sn, (offset, 1.0))
+            estimates[sn] = (a + b*t, abs(b)*sigma)
+        for sn,(t,_) in estimates.items():
+            f = self.filters[sn]
+            others = [e[0] for other,e in estimates.items() if other != sn and e[0] == e[0]]
+            f.stuck = f.flat and len(others) > 0 and t == t and abs(t - float(np.median(others))) > f.stuck_celsius
+        return fuse([e for sn,e in estimates.items() if not self.filters[sn].stuck])
+
+    def status(self):
+        """{sn: {...}} for the dashboard."""
+        r = {}
+        for sn,f in self.filters.items():
+            t, sigma = f.estimate()
+            r[sn] = {'t':round(t, 4) if t == t else None,
+                     'sigma':round(sigma, 4) if sigma == sigma else None,
+                     'flat':f.flat,
+                     'stuck':f.stuck,
+                     'spikes':f.spikes,
+                     }
+        return r
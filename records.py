@@ -0,0 +1,361 @@
+"""records.db: the operation log, user log, probe log and temperature
+history.
+
+Used to be: every writer opens its own connection, default rollback
+journal, CREATE TABLE IF NOT EXISTS on every insert, one commit per row.
+Now:
+
+    - WAL, so readers (web UI, get_tank_status...) don't block the
+      writer and vice versa. synchronous=NORMAL: in WAL mode that's
+      still consistent after a power cut, you just might lose the last
+      few commits.
+    - the schema (and the indexes) is created once per process, and
+      the columns added later (MIGRATIONS) too, by the daemons: they
+      own the file (user pi). The web app (www-data, schema_owner =
+      False) runs no DDL when it reads, and its writer only creates
+      the tables it writes to if they're missing; it never migrates
+    - records.db and its -wal/-shm are kept group-writable, so that pi
+      and www-data (in one group, with /var/www/html setgid to it) can
+      both write
+    - each process has one writer thread fed by a queue. Whatever
+      piles up while it's busy goes out in one transaction (group
+      commit), so the SD card sees a fraction of the fsyncs.
+
+Different processes still each have their own writer; WAL plus the
+busy timeout serializes them.
+
+Usage:
+
+    records.enqueue(sql, params)        # fire and forget
+    records.enqueue(...).result()       # ... or wait until committed
+    await records.enqueue_async(...)    # same, for the asyncio daemons
+    records.flush()                     # everything so far committed
+
+SL2021
+"""
+import sqlite3, threading, queue, logging, time, atexit, asyncio, os
+from concurrent.futures import Future, InvalidStateError
+
+
+logger = logging.getLogger(__name__)
+
+
+RECORDS_DB = '/var/www/html/records.db'
+
+# {p}: table name prefix. '' is the one-tank-per-Pi set; each tank run by
+# the supervisor has its own set (see common.Tank, add_table_prefix()).
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS {p}operation (
+        'ts' REAL NOT NULL,
+        'dt' TEXT NOT NULL,
+        'e' TEXT NOT NULL,
+        'm' TEXT NOT NULL
+        )""",
+    # (an index implicitly ends with rowid, so this is (e, rowid) for
+    # the "latest event of this kind" queries)
+    """CREATE INDEX IF NOT EXISTS {p}operation_e ON {p}operation (e)""",
+    """CREATE INDEX IF NOT EXISTS {p}operation_ts ON {p}operation (ts)""",
+    # hot, cold, ambient: valve duty cycle (0~1) at the time
+    """CREATE TABLE IF NOT EXISTS {p}tank_temperature (
+        'ts' INTEGER PRIMARY KEY,
+        'dt' TEXT NOT NULL,
+        't0' REAL,
+        't0c' REAL,
+        'setpoint' REAL,
+        'hot' REAL,
+        'cold' REAL,
+        'ambient' REAL
+        )""",
+    # tank_temperature rolled up (see temp_log.py). ts: start of the
+    # 15-minute / day (UTC) bucket; n: minutes in it with a t0c, the
+    # other means are weighted by it too
+    """CREATE TABLE IF NOT EXISTS {p}tank_temperature_15m (
+        'ts' INTEGER PRIMARY KEY,
+        'n' INTEGER NOT NULL,
+        't0c_min' REAL,
+        't0c_mean' REAL,
+        't0c_max' REAL,
+        't0_mean' REAL,
+        'setpoint_mean' REAL,
+        'hot' REAL,
+        'cold' REAL,
+        'ambient' REAL
+        )""",
+    """CREATE TABLE IF NOT EXISTS {p}tank_temperature_1d (
+        'ts' INTEGER PRIMARY KEY,
+        'n' INTEGER NOT NULL,
+        't0c_min' REAL,
+        't0c_mean' REAL,
+        't0c_max' REAL,
+        't0_mean' REAL,
+        'setpoint_mean' REAL,
+        'hot' REAL,
+        'cold' REAL,
+        'ambient' REAL
+        )""",
+    """CREATE TABLE IF NOT EXISTS {p}userlog (
+        'ts' INTEGER NOT NULL,
+        'dt' TEXT NOT NULL,
+        'ts_user' INTEGER,
+        'dt_user' TEXT,
+        't0' REAL,
+        'tref' REAL,
+        'tref_note' TEXT
+        )""",
+    """CREATE INDEX IF NOT EXISTS {p}userlog_ts ON {p}userlog (ts)""",
+    """CREATE TABLE IF NOT EXISTS {p}probe_log (
+        'ts' INTEGER NOT NULL,
+        'ts_user' INTEGER,
+        'probe_id' TEXT NOT NULL,
+        't' REAL NOT NULL,
+        'tref' REAL NOT NULL,
+        UNIQUE(ts,probe_id)
+        )""",
+    """CREATE INDEX IF NOT EXISTS {p}probe_log_ts ON {p}probe_log (ts)""",
+]
+
+# columns added after the fact: table -> [(column, type), ...]
+MIGRATIONS = {
+    'tank_temperature':[('hot', 'REAL'), ('cold', 'REAL'), ('ambient', 'REAL'), ],
+}
+
+_table_prefixes = {'', }
+_schema_ready = set()
+_schema_lock = threading.Lock()
+
+# False in the web app: it creates the tables it writes to if they're
+# missing, but leaves the migrations to the daemons
+schema_owner = True
+
+
+def add_table_prefix(prefix):
+    """Have create_schema() create (and migrate) the tables with this
+    prefix too."""
+    with _schema_lock:
+        _table_prefixes.add(prefix)
+
+
+def _share(dbfn):
+    # rw for the group too. SQLite gives -wal and -shm the mode of the
+    # db file, but only when it creates them.
+    for fn in [dbfn, f"{dbfn}-wal", f"{dbfn}-shm"]:
+        try:
+            st = os.stat(fn)
+            if st.st_uid == os.getuid() and 0o060 != st.st_mode & 0o060:
+                os.chmod(fn, st.st_mode | 0o060)
+        except OSError:
+            pass
+
+
+def _connect(dbfn, timeout):
+    conn = sqlite3.connect(dbfn, timeout=timeout)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def connect(dbfn=None, *, timeout=10):
+    """A connection to records.db (RECORDS_DB, as of the call) in WAL
+    mode. The schema is in place if this process is a schema_owner."""
+    dbfn = RECORDS_DB if dbfn is None else dbfn
+    if schema_owner:
+        create_schema(dbfn)
+    return _connect(dbfn, timeout)
+
+
+def create_schema(dbfn=None, *, migrate=None, timeout=10):
+    """Create the tables (every prefix) that aren't there yet and, if
+    migrate (default: schema_owner), add the columns they lack. Once per
+    process and file. Each prefix in one IMMEDIATE transaction, so two
+    processes don't both add a column."""
+    dbfn = RECORDS_DB if dbfn is None else dbfn
+    migrate = schema_owner if migrate is None else migrate
+    with _schema_lock:
+        todo = [p for p in sorted(_table_prefixes) if (dbfn, p, migrate) not in _schema_ready]
+        if not len(todo):
+            return
+        conn = _connect(dbfn, timeout)
+        conn.isolation_level = None
+        try:
+            for p in todo:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for sql in SCHEMA:
+                        conn.execute(sql.format(p=p))
+                    for table,columns in MIGRATIONS.items() if migrate else []:
+                        existing = {r[1] for r in conn.execute(f"PRAGMA table_info({p}{table})")}
+                        for column,t in columns:
+                            if column not in existing:
+                                conn.execute(f"ALTER TABLE {p}{table} ADD COLUMN '{column}' {t}")
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                _schema_ready.add((dbfn, p, migrate))
+        finally:
+            conn.close()
+        _share(dbfn)
+
+
+def _resolve(future, result=None, *, exception=None):
+    # An enqueue_async() whose task got cancelled cancels its future
+    # (from the event loop's thread, at any time). The statement still
+    # runs; there's just nobody to tell.
+    try:
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+    except InvalidStateError:
+        pass
+
+
+class RecordsWriter:
+    """The one thread in this process that writes to records.db.
+
+    If records.db can't be opened (locked, read-only, permissions...),
+    whatever is queued fails (the futures raise) and the next batch
+    tries again, at most every retry_second."""
+    def __init__(self, dbfn=None, *, max_batch=500, linger_second=0.2, retry_second=5):
+        self.dbfn = dbfn
+        self.max_batch = max_batch
+        self.linger_second = linger_second
+        self.retry_second = retry_second
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='records-writer', daemon=True)
+                self._thread.start()
+
+    def enqueue(self, sql, params=()):
+        """Queue one statement. Returns a Future that resolves (to the
+        lastrowid) once the transaction containing it has committed."""
+        future = Future()
+        self._queue.put((sql, params, future, ))
+        self._start()
+        return future
+
+    def flush(self, timeout=None):
+        """Block until everything enqueued so far is committed."""
+        return self.enqueue(None).result(timeout)
+
+    def _open(self):
+        create_schema(self.dbfn)
+        conn = _connect(self.dbfn or RECORDS_DB, 10)
+        try:
+            # hand out the checkpoints in small steps, and not too often
+            conn.execute('PRAGMA wal_autocheckpoint=1000')
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _fail(self, batch, e):
+        # the batch, and everything queued behind it
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for _,_,future in batch:
+            _resolve(future, exception=e)
+
+    def _run(self):
+        conn = None
+        failed = 0
+        try:
+            while True:
+                batch = [self._queue.get()]
+                if conn is None:
+                    time.sleep(max(0, failed + self.retry_second - time.monotonic()))
+                    try:
+                        conn = self._open()
+                    except sqlite3.Error as e:
+                        logger.error(f"cannot open {self.dbfn or RECORDS_DB} ({e}); {len(batch) + self._queue.qsize()} records dropped")
+                        self._fail(batch, e)
+                        failed = time.monotonic()
+                        continue
+                deadline = time.monotonic() + self.linger_second
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+                try:
+                    self._commit(conn, batch)
+                except Exception as e:
+                    # don't leave anyone waiting; start over with a new
+                    # connection
+                    logger.exception('records writer')
+                    self._fail(batch, e)
+                    conn.close()
+                    conn = None
+                    failed = time.monotonic()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _commit(self, conn, batch):
+        results = []
+        try:
+            with conn:
+                for sql,params,future in batch:
+                    if sql is None:     # flush marker
+                        results.append((future, None, ))
+                        continue
+                    results.append((future, conn.execute(sql, params).lastrowid, ))
+        except sqlite3.Error as e:
+            logger.warning(f"batch failed ({e}); retrying the statements one by one")
+            results = []
+            for sql,params,future in batch:
+                if sql is None:
+                    results.append((future, None, ))
+                    continue
+                try:
+                    with conn:
+                        results.append((future, conn.execute(sql, params).lastrowid, ))
+                except sqlite3.Error as e:
+                    logger.error(f"{' '.join(sql.split()[:4])}...: {e}")
+                    _resolve(future, exception=e)
+        for future,r in results:
+            _resolve(future, r)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = RecordsWriter()
+            atexit.register(_flush_on_exit)
+    return _writer
+
+
+def _flush_on_exit():
+    try:
+        _writer.flush(timeout=5)
+    except Exception:
+        logger.exception('records not flushed on exit')
+
+
+def enqueue(sql, params=()):
+    return get_writer().enqueue(sql, params)
+
+
+async def enqueue_async(sql, params=()):
+    return await asyncio.wrap_future(enqueue(sql, params))
+
+
+def flush(timeout=None):
+    return get_writer().flush(timeout)
+
+
+async def flush_async():
+    return await enqueue_async(None)
@@ -0,0 +1,111 @@
+"""The temperature samples as a redis stream, for whoever wants the
+last few minutes of them: no SQLite, no polling, no sample missed.
+
+temp_server still SETs t0, t0c, c0, t_probes... (with a TTL) for
+everything that only wants the latest value. On top of that, every
+sample goes here:
+
+    samplebus.publish({'t0':..., 't0c':..., 'p':probes})   # temp_server
+    samplebus.last(60)              # the last 60 samples, oldest first
+    samplebus.since(time.time() - 300)
+    last_id, new = samplebus.read(last_id, block_ms=10000)  # waits for new ones
+
+The stream is "samples" (tank_key'd in supervisor mode), capped at about
+sample_stream_length entries (config.txt; default 4320, i.e. 6 hours at
+one sample every 5 s) with XADD MAXLEN ~, so redis trims it a whole
+node at a time and it costs next to nothing. The entry ID is the time
+(ms); the fields are short and the same for every entry (redis stores
+the names once per node):
+
+    t0, t0f, s, c0, t0c     °C (s: standard deviation of t0f), "" if NaN
+    p                       probes {sn: °C}, compact JSON
+
+read() blocks on XREAD, so it's for threads (or asyncio.to_thread()),
+not for the event loop itself.
+
+SL2021
+"""
+import logging, json
+from common import get_redis, get_configuration, tank_key
+
+
+logger = logging.getLogger(__name__)
+
+
+STREAM_KEY = 'samples'
+DEFAULT_LENGTH = 4320
+FIELDS = ('t0', 't0f', 's', 'c0', 't0c', )
+
+
+def _number(v):
+    return '' if v is None or v != v else f"{v:.4f}"
+
+
+def encode(sample):
+    """{'t0':°C, ..., 'p':{sn: °C}} -> XADD fields."""
+    fields = {k:_number(sample.get(k)) for k in FIELDS}
+    fields['p'] = json.dumps({sn:round(t, 4) for sn,t in sample.get('p', {}).items() if t == t},
+                             separators=(',', ':'))
+    return fields
+
+
+def decode(entry_id, fields):
+    """One stream entry -> {'ts':second, 't0':°C, ..., 'p':{sn: °C}}
+    (NaN where there was nothing)."""
+    entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+    fields = {(k.decode() if isinstance(k, bytes) else k):(v.decode() if isinstance(v, bytes) else v)
+              for k,v in fields.items()}
+    r = {'ts':int(entry_id.split('-')[0])/1000}
+    for k in FIELDS:
+        v = fields.get(k, '')
+        r[k] = float(v) if len(v) else float('nan')
+    r['p'] = json.loads(fields.get('p') or '{}')
+    return r
+
+
+def publish(sample, *, redis_server=None):
+    """Append one sample. Returns its ID."""
+    redis_server = redis_server or get_redis()
+    maxlen = get_configuration('sample_stream_length', default=DEFAULT_LENGTH, cast=int)
+    return redis_server.xadd(tank_key(STREAM_KEY), encode(sample), maxlen=max(1, maxlen), approximate=True)
+
+
+def last(k, *, redis_server=None):
+    """The last k samples, oldest first."""
+    redis_server = redis_server or get_redis()
+    entries = redis_server.xrevrange(tank_key(STREAM_KEY), count=k)
+    return [decode(entry_id, fields) for entry_id,fields in reversed(entries)]
+
+
+def since(ts, *, redis_server=None):
+    """The samples from time ts (second) on, oldest first."""
+    redis_server = redis_server or get_redis()
+    entries = redis_server.xrange(tank_key(STREAM_KEY), min=int(ts*1000))
+    return [decode(entry_id, fields) for entry_id,fields in entries]
+
+
+def latest_id(*, redis_server=None):
+    """ID of the last sample ('0-0' if none yet): where read() starts
+    if only new samples are wanted."""
+    redis_server = redis_server or get_redis()
+    entries = redis_server.xrevrange(tank_key(STREAM_KEY), count=1)
+    if not len(entries):
+        return '0-0'
+    entry_id = entries[0][0]
+    return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+
+def read(last_id=None, *, block_ms=None, count=None, redis_server=None):
+    """The samples after last_id (latest_id() if None), waiting up to
+    block_ms for one if there's none yet (None: don't wait). Returns
+    (last_id, [sample, ...]); pass that last_id to the next call."""
+    redis_server = redis_server or get_redis()
+    if last_id is None:
+        last_id = latest_id(redis_server=redis_server)
+    r = redis_server.xread({tank_key(STREAM_KEY):last_id}, count=count, block=block_ms)
+    samples = []
+    for _,entries in r or []:
+        for entry_id,fields in entries:
+            samples.append(decode(entry_id, fields))
+            last_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+    return last_id, samples
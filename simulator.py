@@ -0,0 +1,618 @@
+"""Closed-loop simulation of a tank, off the Pi, faster than real time.
+
+Runs the real coroutines (eztank.task_deployed/task_maintenance,
+pwm_valve_controller.task_valve_tender, temp_server.task_sample,
+temp_log.task_temperature_log)
+against:
+
+    - a virtual clock: the event loop jumps straight to the next timer
+      instead of sleeping (time.time() and time.monotonic() follow it)
+    - FakeRedis, an in-memory stand-in for the handful of redis calls
+      the controller makes. Key changes are fed to eztank's EventHub
+      directly, so the tasks wake up the way they would on a Pi
+    - SimValveServer, in place of the XML-RPC valve server
+    - TankPlant, a well-mixed tank with hot, cold and ambient (seawater)
+      inflows and heat loss to the air, solved exactly between valve
+      changes, plus probe noise and DS18B20 quantization
+
+and reports tracking error, valve cycles and loop latency (wall clock).
+With --tanks, that many tanks share the one event loop the way
+supervisor.py runs them, which is how the supervisor's scaling is
+measured.
+
+    python3 simulator.py profile.csv --set control_mode=pid --set PID_P=2
+    python3 simulator.py profile.csv --tanks 50 --day 1
+
+Needs numpy and redis (the package; no server) installed, as usual.
+Nothing Pi-only: GPIO, RabbitMQ and the credentials are never touched.
+
+SL2021
+"""
+import sys, os, time, json, math, types, random, asyncio, selectors, logging, tempfile
+from os.path import dirname, join, abspath
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class VirtualClock:
+    def __init__(self, now):
+        self.now = float(now)
+
+    def time(self):
+        return self.now
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """Never blocks on a timeout: advances the clock by it instead."""
+    TICK = 1e-6
+    def __init__(self, clock, *, speed=None):
+        self._real = selectors.DefaultSelector()
+        self._clock = clock
+        self._speed = speed
+
+    def register(self, fileobj, events, data=None):
+        return self._real.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._real.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._real.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self._real.get_map()
+
+    def close(self):
+        self._real.close()
+
+    def select(self, timeout=None):
+        ready = self._real.select(0)
+        if timeout is None and not len(ready):
+            # nothing scheduled; only another thread can wake us up
+            return self._real.select(None)
+        if len(ready) or not timeout:
+            # Every trip around the loop costs a little, like it would on
+            # a real clock. asyncio runs a timer up to _clock_resolution
+            # early; with time standing still, a loop that re-arms a
+            # timer for "whatever's left" (eztank.act()) would spin.
+            self._clock.now += self.TICK
+            return ready
+        if self._speed is not None:
+            time.sleep(timeout/self._speed)
+        self._clock.now += timeout
+        return []
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock, *, speed=None):
+        self.clock = clock
+        super().__init__(selector=_VirtualSelector(clock, speed=speed))
+        # asyncio runs the timers due before time() + _clock_resolution.
+        # At ~1.6e9 s a float can't tell a nanosecond apart, so a timer
+        # due "now" would never run.
+        self._clock_resolution = 1e-6
+
+    def time(self):
+        return self.clock.now
+
+
+class FakeRedis:
+    """Just enough of redis.StrictRedis for the controller: strings with
+    TTL, transactions (applied as-is), publish and a silent pubsub."""
+    def __init__(self, clock):
+        self.clock = clock
+        self._data = {}
+        self._expire = {}
+        # called with the key (or channel) name on every change
+        self.listeners = []
+
+    def _alive(self, k):
+        k = k.decode() if isinstance(k, bytes) else k
+        if k in self._expire and self._expire[k] <= self.clock.now:
+            self._data.pop(k, None)
+            self._expire.pop(k, None)
+        return k
+
+    def _notify(self, k):
+        for f in self.listeners:
+            f(k)
+
+    def get(self, k):
+        k = self._alive(k)
+        return self._data.get(k)
+
+    def set(self, k, v, ex=None, nx=False):
+        k = self._alive(k)
+        if nx and k in self._data:
+            return None
+        if not isinstance(v, bytes):
+            v = str(v).encode()
+        self._data[k] = v
+        self._expire.pop(k, None)
+        if ex is not None:
+            self._expire[k] = self.clock.now + ex
+        self._notify(k)
+        return True
+
+    def incr(self, k):
+        v = int(self.get(k) or 0) + 1
+        self.set(k, v)
+        return v
+
+    def delete(self, *keys):
+        n = 0
+        for k in keys:
+            k = self._alive(k)
+            if k in self._data:
+                del self._data[k]
+                self._expire.pop(k, None)
+                self._notify(k)
+                n += 1
+        return n
+
+    def exists(self, k):
+        return int(self._alive(k) in self._data)
+
+    def ttl(self, k):
+        k = self._alive(k)
+        if k not in self._data:
+            return -2
+        if k not in self._expire:
+            return -1
+        return int(math.ceil(self._expire[k] - self.clock.now))
+
+    def hset(self, k, key=None, value=None, mapping=None):
+        k = self._alive(k)
+        h = self._data.setdefault(k, {})
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        n = len(set(items) - set(h))
+        h.update({f:str(v).encode() for f,v in items.items()})
+        self._notify(k)
+        return n
+
+    def hgetall(self, k):
+        return {f.encode():v for f,v in self._data.get(self._alive(k), {}).items()}
+
+    def publish(self, channel, message):
+        self._notify(channel)
+        return 0
+
+    # streams: a list of (ID, fields), IDs off the virtual clock
+    def xadd(self, k, fields, id='*', maxlen=None, approximate=True):
+        k = self._alive(k)
+        s = self._data.setdefault(k, [])
+        ms = int(self.clock.now*1000)
+        seq = 0
+        if len(s):
+            last_ms, last_seq = map(int, s[-1][0].decode().split('-'))
+            if ms <= last_ms:
+                ms, seq = last_ms, last_seq + 1
+        entry_id = f"{ms}-{seq}".encode()
+        s.append((entry_id, {f.encode():str(v).encode() for f,v in fields.items()}))
+        if maxlen is not None and len(s) > maxlen:
+            del s[:len(s) - maxlen]
+        self._notify(k)
+        return entry_id
+
+    @staticmethod
+    def _id(entry_id):
+        entry_id = entry_id.decode() if isinstance(entry_id, bytes) else str(entry_id)
+        ms, _, seq = entry_id.partition('-')
+        return int(ms), int(seq or 0)
+
+    def xrange(self, k, min='-', max='+', count=None):
+        lo = (-1, -1) if '-' == min else self._id(min)
+        hi = (math.inf, math.inf) if '+' == max else self._id(max)
+        r = [e for e in self._data.get(self._alive(k), []) if lo <= self._id(e[0]) <= hi]
+        return r if count is None else r[:count]
+
+    def xrevrange(self, k, max='+', min='-', count=None):
+        r = self.xrange(k, min=min, max=max)[::-1]
+        return r if count is None else r[:count]
+
+    def xread(self, streams, count=None, block=None):
+        # never blocks: nothing else would run
+        r = []
+        for k,last_id in streams.items():
+            after = self._id(last_id)
+            entries = [e for e in self._data.get(self._alive(k), []) if self._id(e[0]) > after]
+            if len(entries):
+                r.append([k.encode(), entries if count is None else entries[:count]])
+        return r
+
+    def xlen(self, k):
+        return len(self._data.get(self._alive(k), []))
+
+    def pubsub(self, **kwargs):
+        return types.SimpleNamespace(subscribe=lambda *a, **k: None,
+                                     psubscribe=lambda *a, **k: None,
+                                     get_message=lambda *a, **k: None,
+                                     close=lambda: None)
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, r):
+        self._r = r
+        self._ops = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._ops.append((name, args, kwargs, ))
+            return self
+        return queue
+
+    def execute(self):
+        r = [getattr(self._r, name)(*args, **kwargs) for name,args,kwargs in self._ops]
+        self._ops = []
+        return r
+
+
+class TankPlant:
+    """Well-mixed tank. Each inflow pulls the tank toward its supply
+    temperature at its own rate (1/s, when fully open); so does the air.
+    With the valves fixed that's a linear ODE, solved exactly."""
+    def __init__(self, clock, *, T=26.0, T_air=24.0, k_air=1/(6*3600),
+                 T_hot=35.0, k_hot=4e-4, T_cold=18.0, k_cold=4e-4, T_ambient=26.0, k_ambient=4e-4,
+                 probe_noise=0.02, probes=3, seed=None):
+        self.clock = clock
+        self.T = T
+        self.t = clock.now
+        self.T_air, self.k_air = T_air, k_air
+        self.supply = {'hot':(T_hot, k_hot), 'cold':(T_cold, k_cold), 'ambient':(T_ambient, k_ambient), }
+        self.valves = {'hot':False, 'cold':False, 'ambient':False, }
+        self.probe_noise = probe_noise
+        self.probes = [f"sim{i:010d}" for i in range(probes)]
+        self.rng = random.Random(seed)
+
+    def advance(self):
+        dt = self.clock.now - self.t
+        if dt > 0:
+            k = self.k_air
+            kT = self.k_air*self.T_air
+            for valve,(T_supply, k_valve) in self.supply.items():
+                if self.valves[valve]:
+                    k += k_valve
+                    kT += k_valve*T_supply
+            T_eq = kT/k
+            self.T = T_eq + (self.T - T_eq)*math.exp(-k*dt)
+            self.t = self.clock.now
+        return self.T
+
+    def set_valve(self, valve, state):
+        self.advance()
+        self.valves[valve] = bool(state)
+
+    def read_probes(self):
+        T = self.advance()
+        # DS18B20: 1/16 °C steps
+        return {sn:round((T + self.rng.gauss(0, self.probe_noise))*16)/16 for sn in self.probes}
+
+
+class SimValveServer:
+    """Stands in for the valve server (see common.get_valve_server())."""
+    def __init__(self, plant, r, *, key_prefix=''):
+        self.plant = plant
+        self.r = r
+        self.key_prefix = key_prefix
+        self.edges = {valve:0 for valve in plant.valves}
+        self.open_second = {valve:0.0 for valve in plant.valves}
+        self._opened_at = {}
+        # hot and cold open at the same time: water down the drain
+        self.overlap_second = 0.0
+        self._overlap_since = None
+
+    def _write(self, valve, state):
+        now = self.plant.clock.now
+        if state and not self.plant.valves[valve]:
+            self.edges[valve] += 1
+            self._opened_at[valve] = now
+        elif not state and self.plant.valves[valve]:
+            self.open_second[valve] += now - self._opened_at.pop(valve, now)
+        self.plant.set_valve(valve, state)
+        both = self.plant.valves['hot'] and self.plant.valves['cold']
+        if both and self._overlap_since is None:
+            self._overlap_since = now
+        elif not both and self._overlap_since is not None:
+            self.overlap_second += now - self._overlap_since
+            self._overlap_since = None
+        self.r.set(self.key_prefix + valve, json.dumps(bool(state)))
+
+    def valve_on(self, valve):
+        self._write(valve, True)
+
+    def valve_off(self, valve):
+        self._write(valve, False)
+
+    def set_valves(self, states):
+        for state in [False, True]:
+            for valve,v in states.items():
+                if bool(v) == state:
+                    self._write(valve, state)
+        return {valve:self.get_valve_state(valve) for valve in states}
+
+    def get_valve_state(self, valve):
+        return self.plant.valves[valve]
+
+    def beep(self, second):
+        pass
+
+    def finish(self):
+        for valve in list(self._opened_at):
+            self.open_second[valve] += self.plant.clock.now - self._opened_at.pop(valve)
+        if self._overlap_since is not None:
+            self.overlap_second += self.plant.clock.now - self._overlap_since
+            self._overlap_since = None
+
+
+DEFAULT_CONFIG = {
+    'thermostat_loop_period_second':60,
+    'deadband_celsius':0.2,
+    'high_alarm_celsius':34,
+    'low_alarm_celsius':16,
+    'pwm_min_actuation_second':2,
+    'maintenance_cycle_interval_second':3600,
+    'calibration_sample_size':0,
+    'control_mode':'bangbang',
+    'tank_number':0,
+    'controller_name':'sim',
+    'keep_local_temperature_record_days':7,
+}
+
+
+def _percentile(x, q):
+    return float(np.percentile(x, q)) if len(x) else float('nan')
+
+
+def simulate(profile, *, n_tank=1, config=None, start=None, duration=None, plant=None, seed=None, speed=None, sample_second=60):
+    """Run the controller against "profile" (a profile.csv) from "start"
+    (default: the start of the profile) for "duration" seconds (default:
+    to the end of it). config overrides DEFAULT_CONFIG; plant is a dict
+    of TankPlant parameters. n_tank tanks run side by side in one
+    event loop, as supervisor.py would run them. Returns the report (a
+    dict)."""
+    here = dirname(abspath(__file__))
+    for d in [here, join(here, 'infra')]:
+        if d not in sys.path:
+            sys.path.insert(0, d)
+
+    import common, eztank, pwm_valve_controller, temp_server, temp_log, records, supervisor, metrics
+    from temperature_profile import ingest_csv
+
+    random.seed(seed)
+    workdir = tempfile.mkdtemp(prefix='coraltank-sim-')
+    fn = join(workdir, 'profile.csv')
+    with open(profile) as fin, open(fn, 'w') as fout:
+        fout.write(fin.read())
+    ingest_csv(fn)
+    index = common._get_profile_index(fn)
+    index.refresh(force=True)
+    if not len(index):
+        raise ValueError(f"{profile}: empty profile")
+    start = float(index.ts[0]) if start is None else float(start)
+    duration = float(index.ts[-1] - start) if duration is None else float(duration)
+
+    cfg = dict(DEFAULT_CONFIG)
+    cfg.update(config or {})
+    with open(join(workdir, 'config.txt'), 'w') as f:
+        f.write('[system]\n')
+        for k,v in cfg.items():
+            f.write(f"{k} = {v}\n")
+
+    clock = VirtualClock(start)
+    r = FakeRedis(clock)
+    method = cfg.get('profile_interpolation', 'nearest')
+    # every tank gets the same profile, a plant (with its own noise) and
+    # valves; see supervisor.py
+    plants = {}
+    tanks = []
+    for i in range(n_tank):
+        name = f"sim{i:02d}"
+        plants[name] = TankPlant(clock, seed=None if seed is None else seed + i, **(plant or {}))
+        tank = common.Tank(name, profile=fn, threads=False)
+        tank.valve_server = SimValveServer(plants[name], r, key_prefix=tank.key_prefix)
+        tanks.append(tank)
+
+    saved = {}
+    def patch(obj, name, value):
+        saved[(obj, name)] = getattr(obj, name)
+        setattr(obj, name, value)
+
+    patch(time, 'time', clock.time)
+    patch(time, 'monotonic', clock.time)
+    # an empty records.db of its own: temp_log fills in the history as
+    # it goes, and control_mode=mpc runs bang-bang until there's enough
+    # of it for a model (eztank refits every hour)
+    patch(records, 'RECORDS_DB', join(workdir, 'records.db'))
+    # The writer is a real thread. Awaiting it would leave the loop
+    # with nothing but timers, and the virtual clock would jump ahead
+    # (minutes of missing samples, a different run every time): block
+    # on it instead, and don't let it linger.
+    writer = records.RecordsWriter(linger_second=0)
+    patch(records, 'get_writer', lambda: writer)
+    async def enqueue_async(sql, params=()):
+        return writer.enqueue(sql, params).result()
+    patch(records, 'enqueue_async', enqueue_async)
+    for tank in tanks:
+        records.add_table_prefix(tank.table_prefix)
+    patch(common, 'redis_server', r)
+    patch(common, '_config_store', common.ConfigurationStore(join(workdir, 'config.txt')))
+    patch(common, '_tank_status_cache', common.TankStatusCache())
+    patch(eztank, 'redis_server', r)
+    patch(eztank, 'beep', lambda *args, **kwargs: None)
+    def get_temperature():
+        probes = plants[common.current_tank().name].read_probes()
+        return float(np.median(list(probes.values()))), probes
+    patch(temp_server, 'get_temperature', get_temperature)
+    patch(temp_server, 'get_probe_offset', lambda: 0)
+    patch(temp_server, 'get_probe_calibration', lambda: {})
+
+    for tank in tanks:
+        r.set(tank.key_prefix + common.TANK_STATUS_KEY, 'deployed')
+
+    latencies = []
+    tracking = {tank.name:[] for tank in tanks}
+    errors = []
+    last_act = {}
+    act = eztank.act
+
+    async def timed_act(*args, **kwargs):
+        # wall clock from the end of one act() to the start of the next
+        # (same tank): the controller's own work, plus whatever else got
+        # to run in between
+        name = common.current_tank().name
+        if name in last_act:
+            latencies.append(time.perf_counter() - last_act[name])
+        try:
+            return await act(*args, **kwargs)
+        finally:
+            last_act[name] = time.perf_counter()
+    patch(eztank, 'act', timed_act)
+
+    async def monitor():
+        while True:
+            sp = index.evaluate(clock.now, method=method)
+            for name,tank in plants.items():
+                tracking[name].append((tank.advance(), sp, ))
+            await asyncio.sleep(sample_second)
+
+    def tank_coroutines():
+        return [
+            temp_server.task_sample(),
+            eztank.task_deployed(),
+            eztank.task_maintenance(),
+            temp_log.task_temperature_log(),
+            ] + [pwm_valve_controller.task_valve_tender(valve) for valve in supervisor.VALVES]
+
+    async def run_tank(tank):
+        common.use_tank(tank)
+        tasks = [asyncio.ensure_future(c) for c in tank_coroutines()]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            for t,result in zip(tasks, await asyncio.gather(*tasks, return_exceptions=True)):
+                if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                    logger.error(f"{tank} {t.get_coro().__name__} died: {result!r}")
+                    errors.append(result)
+
+    async def main():
+        hub = eztank.EventHub(asyncio.get_running_loop(), prefixes=[tank.key_prefix for tank in tanks])
+        hub.live = True
+        def on_change(k):
+            # what the keyspace notifications (or the channel) would say
+            for channel in [f"__keyspace@0__:{k}", k]:
+                if channel in hub._channels:
+                    hub._post(hub._channels[channel])
+        r.listeners.append(on_change)
+        patch(eztank, 'hub', hub)
+        supervisor.set_should_continue(True)
+
+        tasks = [asyncio.ensure_future(c) for c in [run_tank(tank) for tank in tanks] + [monitor()]]
+        await asyncio.sleep(duration)
+        supervisor.set_should_continue(False)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # while the writer's clock is still this one
+        await records.flush_async()
+
+    loop = VirtualClockEventLoop(clock, speed=speed)
+    wall = time.perf_counter()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+        for (obj, name),value in saved.items():
+            setattr(obj, name, value)
+    wall = time.perf_counter() - wall
+
+    T,sp = np.array([x for v in tracking.values() for x in v]).reshape(-1, 2).T
+    e = (T - sp)[np.isfinite(sp)]
+    deadband = float(cfg['deadband_celsius'])
+    edges = {valve:0 for valve in supervisor.VALVES}
+    open_second = {valve:0.0 for valve in supervisor.VALVES}
+    overlap_second = 0.0
+    for tank in tanks:
+        tank.valve_server.finish()
+        overlap_second += tank.valve_server.overlap_second
+        for valve in supervisor.VALVES:
+            edges[valve] += tank.valve_server.edges[valve]
+            open_second[valve] += tank.valve_server.open_second[valve]
+    tank_second = n_tank*duration
+    # the controller's own timings (see metrics.py), all tanks pooled.
+    # Wall clock, so that's what the code costs, not the simulated I/O.
+    stages = {}
+    for tank in tanks:
+        for stage,h in metrics._registries.pop(tank.name, metrics._Registry()).histograms.items():
+            pooled = stages.setdefault(stage, metrics.Histogram())
+            pooled.counts = [a + b for a,b in zip(pooled.counts, h.counts)]
+            pooled.n += h.n
+            pooled.max = max(pooled.max, h.max)
+    return {
+        'tanks':n_tank,
+        'simulated_second':duration,
+        'errors':[repr(e) for e in errors],
+        'wall_second':round(wall, 3),
+        'speedup':round(duration/wall, 1) if wall > 0 else float('inf'),
+        # CPU cost of one tank (single core): 1000 ms per tank-hour
+        # would be 1000 tanks on a core, give or take
+        'wall_ms_per_tank_hour':round(1e3*wall/tank_second*3600, 3) if tank_second > 0 else None,
+        # all tanks pooled
+        'tracking':{
+            'samples':int(len(e)),
+            'mae':round(float(np.abs(e).mean()), 4) if len(e) else None,
+            'rmse':round(float(np.sqrt((e**2).mean())), 4) if len(e) else None,
+            'max_abs':round(float(np.abs(e).max()), 4) if len(e) else None,
+            'within_half_deadband':round(float((np.abs(e) <= deadband/2).mean()), 4) if len(e) else None,
+        },
+        # per tank (mean over the tanks)
+        'valve_cycles':{valve:round(v/n_tank, 1) for valve,v in edges.items()},
+        'valve_open_fraction':{valve:round(v/tank_second, 4) if tank_second > 0 else 0 for valve,v in open_second.items()},
+        'hot_cold_overlap_second':round(overlap_second/n_tank, 1),
+        'loop_latency_ms':{
+            'n':len(latencies),
+            'p50':round(1e3*_percentile(latencies, 50), 3),
+            'p99':round(1e3*_percentile(latencies, 99), 3),
+            'max':round(1e3*max(latencies), 3) if len(latencies) else float('nan'),
+        },
+        # p50/p99 are bucket upper bounds
+        'stage_ms':{stage:{'n':h.n,
+                           'p50':round(1e3*h.quantile(0.5), 3),
+                           'p99':round(1e3*h.quantile(0.99), 3),
+                           'max':round(1e3*h.max, 3),
+                           } for stage,h in sorted(stages.items())},
+    }
+
+
+if '__main__' == __name__:
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the tank controller against a simulated tank.')
+    parser.add_argument('profile', help='profile.csv')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='config.txt override (repeatable)')
+    parser.add_argument('--plant', action='append', default=[], metavar='KEY=VALUE', help='TankPlant parameter (repeatable)')
+    parser.add_argument('--day', type=float, default=None, help='how long to simulate (default: the whole profile)')
+    parser.add_argument('--speed', type=float, default=None, help='pace at this many times real time (default: as fast as possible)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--tanks', type=int, default=1, help='run this many tanks side by side (see supervisor.py)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    print(json.dumps(simulate(args.profile,
+                              n_tank=args.tanks,
+                              config=dict(kv.split('=', 1) for kv in args.set),
+                              plant={k:float(v) for k,v in (kv.split('=', 1) for kv in args.plant)},
+                              duration=None if args.day is None else args.day*24*3600,
+                              seed=args.seed,
+                              speed=args.speed,
+                              ), indent=2))
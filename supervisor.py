@@ -0,0 +1,189 @@
+"""Supervisor mode: many tanks, one process, one event loop.
+
+Instead of one Pi per tank running eztank, temp_server,
+pwm_valve_controller, valve_server and temp_log, this runs all of those
+for every tank listed in config.txt. Each tank has a section there:
+
+    [tank.t01]
+    hot_pin = 22
+    cold_pin = 17
+    ambient_pin = 27
+    probes = 0316a2790e4b,0316a27931c1
+    profile = /var/www/html/config/t01/profile.csv
+    # anything else in here overrides the global value for this tank
+    deadband_celsius = 0.3
+
+hot_pin, cold_pin and ambient_pin are required (BCM numbering, no two
+tanks on the same pin). probes defaults to every DS18B20 on the bus (so
+really only for the one-tank case), profile to
+/var/www/html/config/<name>/profile.csv.
+
+Each tank's coroutines run with the tank as common.current_tank(), which
+puts its redis keys under "<name>:" (t01:t0c, t01:pwm_hot...), its
+records.db tables under "<name>_" (t01_tank_temperature...), and picks
+its config section, profile, probes and pins. The redis connection pool,
+the records.db writer, the keyspace notification listener (one
+EventHub) and the event loop are shared.
+
+The valves are driven in-process (no XML-RPC valve server), and there's
+one beeper for the lot: it beeps if any tank is paused. Valve ops and
+probe reads go through common.run_blocking() (temp_server.ProbeReader
+reads all of a tank's probes at once, in threads), so neither holds up
+the event loop.
+
+The web app doesn't know about tanks (yet): /status, /pause, /samples,
+the reference temperature log and the rest all use the plain,
+unprefixed names, so there's no dashboard for the tanks run here. Look
+at them in redis (t01:t0c...) and records.db (t01_tank_temperature...)
+for now.
+
+How it scales (control loop only, simulated; see simulator.py):
+
+    python3 simulator.py profile.csv --tanks 50
+
+SL2021
+"""
+import sys, logging, asyncio, random, json
+from os.path import dirname, join, abspath
+sys.path.append(join(dirname(abspath(__file__)), 'infra'))
+from common import Tank, use_tank, StartupTimer, get_setpoint, add_operation_entry, get_configuration, is_valve_control_inhibited, beep, set_valve_pwm, trigger_valve_direct, get_config_store
+import records
+import eztank, temp_server, pwm_valve_controller, temp_log
+
+
+logger = logging.getLogger(__name__)
+
+VALVES = ['hot', 'cold', 'ambient', ]
+BEEPER_PIN = 18
+
+
+def load_tanks(*, valve_server=None):
+    """Tanks from the [tank.<name>] sections of config.txt."""
+    tanks = []
+    pins_taken = {BEEPER_PIN:'beeper', }
+    for section,values in get_config_store().sections().items():
+        name = section[len('tank.'):]
+        pins = {}
+        for valve in VALVES:
+            try:
+                pin = int(values[f"{valve}_pin"])
+            except KeyError:
+                raise ValueError(f"[{section}]: {valve}_pin is missing")
+            if pin in pins_taken:
+                raise ValueError(f"[{section}]: pin {pin} is already taken by {pins_taken[pin]}")
+            pins_taken[pin] = f"{name} {valve}"
+            pins[valve] = pin
+        probes = values.get('probes')
+        if probes is not None:
+            probes = [sn.strip() for sn in probes.split(',') if len(sn.strip())]
+        tanks.append(Tank(name,
+                          profile=values.get('profile', f"/var/www/html/config/{name}/profile.csv"),
+                          pins=pins,
+                          probes=probes,
+                          valve_server=valve_server,
+                          ))
+    return tanks
+
+
+def tank_coroutines(*, with_log=True):
+    """Everything one tank runs, minus the valve server (in-process) and
+    the beeper (shared)."""
+    r = [
+        temp_server.task_sample(),
+        eztank.task_deployed(),
+        eztank.task_maintenance(),
+        ] + [pwm_valve_controller.task_valve_tender(valve) for valve in VALVES]
+    if with_log:
+        r.append(temp_log.task_temperature_log())
+    return r
+
+
+async def run_tank(tank, coroutines_f=tank_coroutines):
+    use_tank(tank)
+    # a bit of randomness so that the tanks don't all open their valves
+    # at the same time (see eztank.py)
+    await asyncio.sleep(3*random.random())
+    try:
+        get_setpoint(force_read=True)   # profile.csv -> profile.db
+    except Exception:
+        logger.exception(f"{tank}: no profile")
+    add_operation_entry('start', json.dumps({'tank_number':get_configuration('tank_number'),
+                                             'controller_name':get_configuration('controller_name'),
+                                             'supervisor':True,
+                                             }, separators=(',', ':')))
+    # the coroutines are created (and their tasks too, by gather) in
+    # this task, so they all see this tank
+    await asyncio.gather(*coroutines_f())
+
+
+async def task_warning(tanks):
+    """eztank.task_warning, for all the tanks and one beeper."""
+    while should_continue:
+        paused = []
+        for tank in tanks:
+            use_tank(tank)
+            if is_valve_control_inhibited():
+                paused.append(tank.name)
+        use_tank(None)
+        if len(paused):
+            logger.warning(f"valve operation inhibited: {paused}")
+            await asyncio.to_thread(beep, on=1, off=0)
+            await asyncio.sleep(9)
+        else:
+            await asyncio.sleep(1)
+
+
+def set_should_continue(v):
+    global should_continue
+    should_continue = v
+    for m in [eztank, temp_server, pwm_valve_controller, temp_log]:
+        m.should_continue = v
+
+
+if '__main__' == __name__:
+
+    startup = StartupTimer('supervisor')
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('pika').setLevel(logging.WARNING)
+    logging.getLogger('common').setLevel(logging.WARNING)
+
+    import RPi.GPIO as GPIO
+    import valve_server
+
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+
+    tanks = load_tanks(valve_server=valve_server)
+    if not len(tanks):
+        logger.error('no [tank.<name>] section in config.txt')
+        sys.exit(1)
+    logger.info(f"{len(tanks)} tanks: {[tank.name for tank in tanks]}")
+    for tank in tanks:
+        records.add_table_prefix(tank.table_prefix)
+    records.create_schema()
+    startup.mark('tanks')
+
+    set_should_continue(True)
+
+    async def main():
+        hub = eztank.EventHub(asyncio.get_running_loop(), prefixes=[tank.key_prefix for tank in tanks])
+        eztank.hub = hub
+        hub.start()
+        startup.report()
+        await asyncio.gather(task_warning(tanks), *[run_tank(tank) for tank in tanks])
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        set_should_continue(False)
+        logging.info('user interrupted')
+    finally:
+        # always turn off all valves on exit
+        for tank in tanks:
+            use_tank(tank)
+            try:
+                set_valve_pwm('neutral')
+                trigger_valve_direct('neutral')
+            except Exception:
+                logger.exception(f"{tank}: could not close the valves")
+        GPIO.cleanup()
@@ -0,0 +1,302 @@
+"""Tank identification from the history we already record, and PID /
+deadband settings derived from it.
+
+    python3 sysid.py --day 7                      # this tank
+    python3 sysid.py --tank t01 --tank t02 --day 7 --write suggested.txt
+
+Reads tank_temperature (t0c and the hot/cold/ambient duty cycles logged
+by temp_log, once a minute) in chunks, and fits
+
+    dT/dt(t) = a + b*T(t) + h*hot(t - dead) + c*cold(t - dead) + m*ambient(t - dead)
+
+i.e. mpc.ThermalModel plus a dead time (the plumbing between the valve
+and the probes), by least squares. The normal equations for every
+candidate dead time (0, 1, 2... samples) are accumulated chunk by chunk,
+so memory doesn't depend on the time range, and the dead time with the
+smallest residual wins.
+
+This is closed-loop data, so the duty cycles depend on past readings.
+That's fine as long as the reading the controller acted on isn't the one
+logged: temp_log's t0c is its own, later, probe read. It's also why there
+needs to be some variety in the history (setpoint changes, maintenance
+flushes...): a week of holding 26 °C says little about the valves.
+
+From that (first order plus dead time, per unit of duty cycle):
+
+    - PID_P, PID_I: SIMC PI rules (Skogestad 2003), with the closed
+      loop time constant at the dead time (at least one loop period),
+      sized on the stronger of heating and cooling.
+    - PID_history_max_age_second/max_count: the I term here is over a
+      window, not since forever, so the window has to be a couple of Ti
+      long.
+    - deadband_celsius: wide enough for the probe noise (4 sigma) and
+      for what the tank does during the dead time after a switch.
+
+These are starting points: --sweep then runs pidtune around them
+against the identified model (dead time included) and picks the best.
+Nothing is written to config.txt; --write puts them in a file in
+config.txt's format for whoever reviews them.
+
+SL2021
+"""
+import logging, time, math
+from collections import deque
+import numpy as np
+import records
+from mpc import ThermalModel
+
+
+logger = logging.getLogger(__name__)
+
+
+def stream_history(start, stop, *, dbfn=None, table='tank_temperature', chunk=10000):
+    """(ts, t0c, hot, cold, ambient) arrays of at most "chunk" rows each,
+    in time order, for start <= ts < stop. Rows without a reading or
+    without duty cycles are skipped. Keyset pagination: no read
+    transaction is held open between chunks."""
+    last = start - 1
+    with records.connect(records.RECORDS_DB if dbfn is None else dbfn) as conn:
+        while True:
+            rows = conn.execute(f"""SELECT ts, t0c, hot, cold, ambient
+                                   FROM {table}
+                                   WHERE ts > ? AND ts < ?
+                                   AND t0c IS NOT NULL
+                                   AND hot IS NOT NULL
+                                   ORDER BY ts
+                                   LIMIT ?""", (last, stop, chunk)).fetchall()
+            if not len(rows):
+                return
+            last = rows[-1][0]
+            yield tuple(np.array(c, dtype=float) for c in zip(*rows))
+            if len(rows) < chunk:
+                return
+
+
+class Identification:
+    """What fit() found. model is the ThermalModel without dead time (for
+    mpc.py); dead_second is the dead time."""
+    def __init__(self, theta, dead_second, *, step_second, noise_celsius, n, rms_by_dead):
+        self.model = ThermalModel(theta)
+        self.dead_second = dead_second
+        self.step_second = step_second
+        self.noise_celsius = noise_celsius
+        self.n = n
+        # mean squared residual (°C/s)^2 for each candidate dead time
+        self.rms_by_dead = rms_by_dead
+
+    def __repr__(self):
+        a,b,h,c,m = self.model.theta
+        tau = self.time_constant_second
+        return (f"Identification(heating={3600*h:.3g} °C/h, cooling={3600*c:.3g} °C/h, "
+                f"tau={tau/3600:.3g} h, dead={self.dead_second:.0f} s, noise={self.noise_celsius:.3f} °C, n={self.n})")
+
+    @property
+    def heating_rate(self):
+        """°C/s at full hot, on top of the tank's drift."""
+        return float(self.model.theta[2])
+
+    @property
+    def cooling_rate(self):
+        return float(self.model.theta[3])
+
+    @property
+    def time_constant_second(self):
+        b = self.model.theta[1]
+        return -1/b if b < 0 else float('inf')
+
+    def recommend(self, *, loop_second=60, tau_c=None):
+        """config.txt settings (strings, as they'd go in the file)."""
+        theta = self.dead_second
+        tau_c = max(theta, loop_second) if tau_c is None else tau_c
+        # the stronger actuator sets the gain: sized on the weaker one,
+        # the other would oscillate
+        rate = max(self.heating_rate, -self.cooling_rate)
+        tau = self.time_constant_second
+        # SIMC for k*exp(-theta*s)/(tau*s + 1), k = rate*tau: Kc =
+        # tau/(k*(tau_c + theta)) = 1/(rate*(tau_c + theta)), whether or
+        # not tau is finite
+        kp = 1/(rate*(tau_c + theta))
+        ti = min(tau, 4*(tau_c + theta))
+        ki = kp/ti
+        history_second = int(math.ceil(2*ti/loop_second))*loop_second
+        # during the dead time (plus half a loop, on average, before the
+        # switch is even noticed) the tank keeps going the old way
+        lag = theta + loop_second/2
+        deadband = max(4*self.noise_celsius, 2*rate*lag, 0.1)
+        deadband = math.ceil(deadband/0.05)*0.05
+        return {
+            'PID_P':f"{kp:.3g}",
+            'PID_I':f"{ki:.3g}",
+            'PID_D':'0',
+            'PID_history_max_age_second':str(history_second),
+            'PID_history_max_count':str(history_second//loop_second + 1),
+            'deadband_celsius':f"{deadband:.2f}",
+        }
+
+
+def fit(chunks, *, step_second=60, max_dead_second=600, max_gap_second=180):
+    """Identification from stream_history()'s chunks, or None if there
+    isn't enough data or the data says heating doesn't heat (or cooling
+    doesn't cool)."""
+    D = int(max_dead_second//step_second)
+    # normal equations for each dead time (in samples) 0..D
+    XtX = np.zeros((D + 1, 5, 5))
+    Xty = np.zeros((D + 1, 5))
+    yty = np.zeros(D + 1)
+    n = np.zeros(D + 1, dtype=int)
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            # the last D+1 rows of the previous chunk, for the lags (and
+            # for the first derivative)
+            chunk = tuple(np.concatenate([p, c]) for p,c in zip(carry, chunk))
+        ts, T, hot, cold, ambient = chunk
+        if len(ts) > D + 1:
+            k0 = 0 if carry is None else len(carry[0]) - 1
+            _accumulate(XtX, Xty, yty, n, ts, T, hot, cold, ambient, k0=k0, D=D,
+                        step_second=step_second, max_gap_second=max_gap_second)
+            carry = tuple(c[-(D + 1):] for c in chunk)
+        else:
+            carry = chunk
+
+    if n.min() < 30:
+        logger.warning(f"only {n.min()} usable samples; no model")
+        return None
+    thetas = np.stack([np.linalg.lstsq(XtX[d], Xty[d], rcond=None)[0] for d in range(D + 1)])
+    rss = yty - 2*np.einsum('di,di->d', thetas, Xty) + np.einsum('di,dij,dj->d', thetas, XtX, thetas)
+    ms = np.maximum(rss, 0)/n
+    plausible = (thetas[:, 2] > 0) & (thetas[:, 3] < 0)
+    if not plausible.any():
+        logger.warning(f"implausible fit {thetas[0]}; no model")
+        return None
+    d = int(np.argmin(np.where(plausible, ms, np.inf)))
+    theta = thetas[d].copy()
+    # no runaway tanks
+    theta[1] = min(0, theta[1])
+    # the derivative residual is mostly probe noise: dT has two samples'
+    # worth of it
+    noise = float(np.sqrt(ms[d]))*step_second/np.sqrt(2)
+    return Identification(theta, d*step_second, step_second=step_second, noise_celsius=noise, n=int(n[d]),
+                          rms_by_dead={int(dd*step_second):float(np.sqrt(v)) for dd,v in enumerate(ms)})
+
+
+def _accumulate(XtX, Xty, yty, n, ts, T, hot, cold, ambient, *, k0, D, step_second, max_gap_second):
+    """Add rows k0+1.. of this chunk (rows up to k0 were in the previous
+    one) to the normal equations of every dead time."""
+    dt = np.diff(ts)
+    y = np.diff(T)/np.where(dt > 0, dt, 1)          # y[k]: from row k to k+1
+    ok = (dt > 0) & (dt <= max_gap_second) & np.isfinite(T[1:]) & np.isfinite(T[:-1])
+    k = np.arange(max(D, k0), len(ts) - 1)          # rows with D rows before them
+    for d in range(D + 1):
+        kd = k - d
+        # the lagged inputs really are d samples back, give or take
+        lag_ok = np.abs((ts[k] - ts[kd]) - d*step_second) <= 0.5*step_second
+        use = ok[k] & lag_ok
+        X = np.column_stack([np.ones(use.sum()), T[k][use], hot[kd][use], cold[kd][use], ambient[kd][use]])
+        Y = y[k][use]
+        XtX[d] += X.T @ X
+        Xty[d] += X.T @ Y
+        yty[d] += Y @ Y
+        n[d] += len(Y)
+
+
+class DeadTimePlant:
+    """ThermalModel with the valves acting "dead" seconds late, with
+    simulate() as pidtune expects it (one step at a time). Keeps state:
+    one per evaluate()."""
+    def __init__(self, ident):
+        self.model = ident.model
+        self.delay = int(round(ident.dead_second/ident.step_second))
+        self._queue = deque()
+
+    def simulate(self, T0, hot, cold, step_second, *, ambient=None):
+        self._queue.append((hot, cold, ))
+        if len(self._queue) > self.delay:
+            hot, cold = self._queue.popleft()
+        else:
+            hot, cold = np.zeros_like(hot), np.zeros_like(cold)
+        return self.model.simulate(T0, hot, cold, step_second, ambient=ambient)
+
+
+def sweep(ident, setpoints, *, loop_second=60, min_duty=0.2, noise=None, processes=None, seed=0):
+    """Refine recommend() with pidtune around it (min_duty:
+    PID_min_duty). Returns (settings, pidtune result, best index)."""
+    import pidtune
+    base = ident.recommend(loop_second=loop_second)
+    kp0, ki0 = float(base['PID_P']), float(base['PID_I'])
+    scale = np.array([0.25, 0.5, 1, 2, 4])
+    histories = sorted({int(base['PID_history_max_age_second']), 2*int(base['PID_history_max_age_second']), 600, 1200})
+    K, this_many, this_old = pidtune.grid(kp0*scale, np.concatenate([[0], ki0*scale]), [0],
+                                          [h//loop_second + 1 for h in histories], histories)
+    # only windows that make sense: enough samples to cover this_old
+    keep = this_many == this_old//loop_second + 1
+    K, this_many, this_old = K[keep], this_many[keep], this_old[keep]
+    result = pidtune.evaluate(DeadTimePlant(ident), setpoints, loop_second, K, this_many, this_old,
+                              deadband=float(base['deadband_celsius']),
+                              min_duty=min_duty,
+                              noise=ident.noise_celsius if noise is None else noise,
+                              seed=seed, processes=processes)
+    order, _ = pidtune.rank(result)
+    best = int(order[0])
+    settings = dict(base)
+    settings.update({
+        'PID_P':f"{K[best, 0]:.3g}",
+        'PID_I':f"{K[best, 1]:.3g}",
+        'PID_history_max_age_second':f"{this_old[best]:.0f}",
+        'PID_history_max_count':str(this_many[best]),
+    })
+    return settings, result, best
+
+
+if '__main__' == __name__:
+
+    import argparse
+    from common import Tank
+
+    parser = argparse.ArgumentParser(description='Identify the tank from records.db and suggest PID gains and deadband.')
+    parser.add_argument('--tank', action='append', default=[], help='supervised tank name (repeatable; default: the one tank)')
+    parser.add_argument('--day', type=float, default=7, help='this many days of history...')
+    parser.add_argument('--until', type=float, default=None, help='... up to this POSIX time (default: now)')
+    parser.add_argument('--dbfn', default=None, help='records.db')
+    parser.add_argument('--loop-second', type=int, default=60, help='thermostat_loop_period_second')
+    parser.add_argument('--max-dead-second', type=int, default=600)
+    parser.add_argument('--sweep', action='store_true', help='refine with a pidtune sweep around the SIMC gains')
+    parser.add_argument('--profile', default=None, help='--sweep against this profile.csv (default: pidtune.default_trace)')
+    parser.add_argument('--write', default=None, metavar='FN', help='write the suggestions here (config.txt format)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    until = time.time() if args.until is None else args.until
+    lines = [f"# sysid.py suggestions, {time.strftime('%Y-%m-%d %H:%M', time.localtime())}, from {args.day:g} days of history", '']
+    for name in args.tank or [None]:
+        table = 'tank_temperature' if name is None else Tank(name).table_prefix + 'tank_temperature'
+        ident = fit(stream_history(until - args.day*24*3600, until, dbfn=args.dbfn, table=table),
+                    step_second=60, max_dead_second=args.max_dead_second)
+        if ident is None:
+            logger.error(f"{name or 'tank'}: no usable model")
+            continue
+        logger.info(f"{name or 'tank'}: {ident}")
+        logger.info('RMS residual by dead time (°C/s): ' + ', '.join(f"{k}s:{v:.2e}" for k,v in ident.rms_by_dead.items()))
+        settings = ident.recommend(loop_second=args.loop_second)
+        if args.sweep:
+            import pidtune
+            if args.profile is not None:
+                from temperature_profile import ProfileIndex, ingest_csv
+                ingest_csv(args.profile, if_changed=True)
+                index = ProfileIndex(args.profile)
+                index.refresh(force=True)
+                _,setpoints = index.preview(float(index.ts[0]), float(index.ts[0]) + 24*3600, args.loop_second)
+            else:
+                setpoints = pidtune.default_trace(args.loop_second)
+            settings, result, best = sweep(ident, setpoints, loop_second=args.loop_second)
+            hours = len(setpoints)*args.loop_second/3600
+            logger.info(f"sweep: MAE {result['iae'][best]/(hours*3600):.4f} °C, {result['switches'][best]/hours:.0f} valve edges/h")
+        lines.append('[system]' if name is None else f"[tank.{name}]")
+        lines.append(f"# {ident}")
+        lines += [f"{k} = {v}" for k,v in settings.items()]
+        lines.append('')
+    print('\n'.join(lines))
+    if args.write is not None:
+        with open(args.write, 'w') as f:
+            f.write('\n'.join(lines))
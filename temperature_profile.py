@@ -0,0 +1,387 @@
+"""The temperature profile, kept in memory.
+
+profile.csv is converted into profile.db (table A: ts, t) by the web app
+on upload, and by eztank on startup. This loads table A once into sorted
+arrays so that "what's the setpoint now" is a couple of bisects instead
+of two SQLite range queries per thermostat loop. "NA" is kept as a mask
+(and as NaN in the values).
+
+The index reloads itself when profile.db or profile.csv changes on disk.
+Once loaded, the arrays are also saved next to profile.db (profile.npz,
+tagged with the CSV's SHA-1); the next process to start loads that
+instead of going through SQLite row by row.
+
+ingest_csv() does the profile.csv -> profile.db conversion: rows are
+streamed from the CSV, parsed in batches, bulk-inserted into a shadow
+table and swapped in at the end, so readers never see a missing or
+half-built table A. The SHA-1 of the CSV goes in with it, so that a
+reboot (if_changed=True) costs a hash instead of a rebuild.
+
+SL2021
+"""
+import os, sqlite3, logging, csv, time, hashlib
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# * * * * *
+# Timestamps in the temperature profile are interpreted as in HST!
+# Under the hood everything in the controller uses UTC.
+# * * * * *
+HST_OFFSET_SECOND = -10*3600
+
+INTERPOLATION_METHODS = {'nearest', 'linear', 'pchip', }
+
+
+def _signature(fn):
+    try:
+        st = os.stat(fn)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return None
+
+
+def parse_hst_timestamps(x):
+    """Vectorized strptime for the profile's 12-digit (%Y%m%d%H%M) and
+    14-digit (%Y%m%d%H%M%S) HST timestamps.
+
+    Returns (UTC POSIX seconds as int64, boolean mask of valid entries).
+    Invalid entries (wrong length, not digits, no such date/time) are
+    flagged, not raised.
+    """
+    x = np.asarray(x, dtype=str)
+    n = np.char.str_len(x)
+    valid = np.char.isdigit(x) & ((12 == n) | (14 == n))
+    # pad the 12-digit ones with :00 seconds
+    v = np.where(valid, np.char.ljust(x, 14, '0'), '19700101000000').astype(np.int64)
+
+    Y = v//10**10
+    M = v//10**8 % 100
+    D = v//10**6 % 100
+    h = v//10**4 % 100
+    m = v//10**2 % 100
+    s = v % 100
+    valid &= (M >= 1) & (M <= 12) & (D >= 1) & (D <= 31) & (h < 24) & (m < 60) & (s < 60)
+    M = np.where(valid, M, 1)
+    D = np.where(valid, D, 1)
+
+    month = ((Y - 1970)*12 + M - 1).astype('datetime64[M]')
+    day = month.astype('datetime64[D]') + (D - 1).astype('timedelta64[D]')
+    valid &= day.astype('datetime64[M]') == month     # e.g. Feb 30
+    ts = day.astype('datetime64[s]').astype(np.int64) + h*3600 + m*60 + s - HST_OFFSET_SECOND
+    return ts, valid
+
+
+def _parse_batch(batch):
+    """batch: list of (line number, row). Returns ([(ts, t), ...],
+    [(line number, row), ...] of the bad ones)."""
+    good = [(lineno, row) for lineno,row in batch if 2 == len(row)]
+    bad = [(lineno, row) for lineno,row in batch if 2 != len(row)]
+    if not len(good):
+        return [], bad
+
+    x = [row[0].strip() for _,row in good]
+    ts, valid = parse_hst_timestamps(x)
+
+    rows = []
+    for (lineno, row), tss, ok in zip(good, ts.tolist(), valid.tolist()):
+        y = row[1].strip()
+        if ok:
+            if 'NA' == y:
+                rows.append((tss, 'NA', ))
+                continue
+            try:
+                y = float(y)
+                if y == y and abs(y) != float('inf'):
+                    rows.append((tss, y, ))
+                    continue
+            except ValueError:
+                pass
+        bad.append((lineno, row))
+    return rows, bad
+
+
+def file_sha1(fn):
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def ingested_sha1(dbfn):
+    """SHA-1 of the CSV that table A in dbfn was built from. None if
+    unknown (no db, no table A, or built before the hash was kept)."""
+    if not os.path.exists(dbfn):
+        return None
+    try:
+        with sqlite3.connect(dbfn) as conn:
+            cur = conn.cursor()
+            cur.execute("""SELECT v FROM profile_meta WHERE k='csv_sha1'
+                           AND EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name='A')""")
+            r = cur.fetchone()
+            return None if r is None else r[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def ingest_csv(fn='/var/www/html/config/profile.csv', *, dbfn=None, batch_size=10000, if_changed=False):
+    """profile.csv -> table A in profile.db. Table A is replaced in one
+    transaction at the end; until then readers keep seeing the old
+    profile.
+
+    Duplicated timestamps: the last one wins (as before). Returns a
+    summary dict; invalid lines are listed there (the first few of them
+    anyway) and logged.
+
+    if_changed: don't rebuild if table A was built from a CSV with the
+    same content (summary['unchanged'] is True then).
+    """
+    started = time.monotonic()
+    dbfn = fn.rsplit('.', 1)[0] + '.db' if dbfn is None else dbfn
+    sha1 = file_sha1(fn)
+    summary = {'rows':0, 'invalid':0, 'invalid_lines':[], 'sha1':sha1, 'unchanged':False, }
+
+    if if_changed and sha1 == ingested_sha1(dbfn):
+        summary['unchanged'] = True
+        summary['elapsed_second'] = round(time.monotonic() - started, 3)
+        logger.info(f"{fn} unchanged ({sha1[:8]}), {summary['elapsed_second']}s")
+        return summary
+
+    # autocommit mode; the transactions are spelled out below
+    conn = sqlite3.connect(dbfn, isolation_level=None)
+    try:
+        cur = conn.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS profile_meta (
+                        'k' TEXT PRIMARY KEY,
+                        'v' TEXT
+                        )""")
+        cur.execute("""DROP TABLE IF EXISTS A_new""")
+        cur.execute("""CREATE TABLE A_new (
+                        'ts' INTEGER PRIMARY KEY,
+                        't' REAL NOT NULL
+                        )""")
+
+        def flush(batch):
+            rows, bad = _parse_batch(batch)
+            cur.executemany("""INSERT OR REPLACE INTO A_new ('ts', 't') VALUES (?,?)""", rows)
+            summary['rows'] += len(rows)
+            summary['invalid'] += len(bad)
+            for lineno,row in bad:
+                if len(summary['invalid_lines']) < 20:
+                    summary['invalid_lines'].append((lineno, row, ))
+                    logger.error(f'invalid line {lineno} in CSV: {row}')
+
+        cur.execute('BEGIN')
+        with open(fn, newline='') as csvfile:
+            batch = []
+            for lineno,row in enumerate(csv.reader(csvfile), start=1):
+                if not len(row):
+                    continue
+                batch.append((lineno, row, ))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+            flush(batch)
+        cur.execute('COMMIT')
+
+        # the swap
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute("""DROP TABLE IF EXISTS A""")
+        cur.execute("""ALTER TABLE A_new RENAME TO A""")
+        cur.execute("""INSERT OR REPLACE INTO profile_meta ('k', 'v') VALUES ('csv_sha1', ?)""", (sha1, ))
+        cur.execute('COMMIT')
+    except:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    summary['elapsed_second'] = round(time.monotonic() - started, 3)
+    logger.info(f"{fn}: {summary['rows']} rows, {summary['invalid']} invalid, {summary['elapsed_second']}s")
+    return summary
+
+
+class ProfileIndex:
+    def __init__(self, fn='/var/www/html/config/profile.csv'):
+        self.fn = fn
+        self.dbfn = fn.rsplit('.', 1)[0] + '.db'
+        self.snapshot_fn = fn.rsplit('.', 1)[0] + '.npz'
+        self._signature = None
+        self.ts = np.empty(0, dtype=np.int64)
+        self.t = np.empty(0, dtype=float)
+        self.na = np.empty(0, dtype=bool)
+        self._slopes = None
+
+    def __len__(self):
+        return len(self.ts)
+
+    def refresh(self, *, force=False):
+        signature = (_signature(self.dbfn), _signature(self.fn), )
+        if not force and signature == self._signature:
+            return False
+        self._load()
+        self._signature = signature
+        return True
+
+    def _load(self):
+        sha1 = ingested_sha1(self.dbfn)
+        if sha1 is not None and self._load_snapshot(sha1):
+            self._slopes = None
+            logger.debug(f"loaded {len(self.ts)} profile points from {self.snapshot_fn}")
+            return
+
+        rows = []
+        try:
+            with sqlite3.connect(self.dbfn) as conn:
+                cur = conn.cursor()
+                # NA is stored as the string "NA" in a REAL column
+                # (sqlite3 doesn't type check)
+                cur.execute("""SELECT ts,
+                                      CASE WHEN typeof(t) IN ('real', 'integer') THEN t ELSE NULL END,
+                                      typeof(t) NOT IN ('real', 'integer')
+                               FROM A ORDER BY ts""")
+                rows = cur.fetchall()
+        except sqlite3.OperationalError:
+            logger.warning(f"no profile in {self.dbfn}")
+
+        if len(rows):
+            ts,t,na = zip(*rows)
+            self.ts = np.array(ts, dtype=np.int64)
+            self.na = np.array(na, dtype=bool)
+            self.t = np.array([float('nan') if v is None else v for v in t], dtype=float)
+        else:
+            self.ts = np.empty(0, dtype=np.int64)
+            self.t = np.empty(0, dtype=float)
+            self.na = np.empty(0, dtype=bool)
+        self._slopes = None
+        logger.debug(f"loaded {len(self.ts)} profile points from {self.dbfn}")
+        if sha1 is not None:
+            self._save_snapshot(sha1)
+
+    def _load_snapshot(self, sha1):
+        try:
+            with np.load(self.snapshot_fn) as z:
+                if str(z['sha1']) != sha1:
+                    return False
+                self.ts, self.t, self.na = z['ts'], z['t'], z['na']
+            return True
+        except (OSError, KeyError, ValueError):
+            return False
+
+    def _save_snapshot(self, sha1):
+        # write-then-rename: a reader never sees half a file
+        tmp = f"{self.snapshot_fn}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, sha1=np.array(sha1), ts=self.ts, t=self.t, na=self.na)
+            os.replace(tmp, self.snapshot_fn)
+        except OSError:
+            logger.warning(f"could not write {self.snapshot_fn}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def nearest(self, now):
+        """Setpoint closest to "now" (ties go to the earlier one). NaN if
+        "now" is outside of the window the profile covers, or if the
+        nearest point is NA."""
+        return self.evaluate(now, method='nearest')
+
+    def evaluate(self, x, *, method='nearest'):
+        """Profile value(s) at time(s) x (POSIX seconds, scalar or array).
+
+        method is one of INTERPOLATION_METHODS:
+            nearest     the closest point, same as it ever was
+            linear      straight lines between points
+            pchip       monotone cubic (Fritsch-Carlson). Doesn't
+                        overshoot the key points, so a sparse profile
+                        of peaks and troughs stays within its range.
+
+        NA points are gaps: any time whose neighbouring point(s) is NA
+        evaluates to NaN. So does anything outside of the profile.
+        """
+        assert method in INTERPOLATION_METHODS, f"unknown interpolation method {method}"
+        self.refresh()
+
+        scalar = np.ndim(x) == 0
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        ts, t = self.ts, self.t
+        n = len(ts)
+
+        y = np.full(x.shape, float('nan'))
+        inside = (x >= ts[0]) & (x <= ts[-1]) if n else np.zeros(x.shape, dtype=bool)
+        if scalar and not inside[0]:
+            if not n or x[0] < ts[0]:
+                # we're too early, or the profile is empty
+                logger.warning('>we are here< [profile]')
+            else:
+                # we're too late
+                logger.warning('[profile] >we are here<')
+        if not inside.any():
+            return float(y[0]) if scalar else y
+
+        xi = x[inside]
+        left = np.searchsorted(ts, xi, side='right') - 1    # ts[left] <= x
+        exact = ts[left] == xi
+
+        if 'nearest' == method or n < 2:
+            right = np.minimum(left + 1, n - 1)
+            i = np.where(xi - ts[left] <= ts[right] - xi, left, right)
+            i = np.where(exact, left, i)
+            y[inside] = t[i]
+        else:
+            # segment k is [ts[k], ts[k+1]]
+            k = np.minimum(left, n - 2)
+            h = (ts[k + 1] - ts[k]).astype(float)
+            s = (xi - ts[k])/h
+            if 'linear' == method:
+                yi = t[k] + s*(t[k + 1] - t[k])
+            else:
+                d = self._pchip_slopes()
+                h00 = (1 + 2*s)*(1 - s)**2
+                h10 = s*(1 - s)**2
+                h01 = s**2*(3 - 2*s)
+                h11 = s**2*(s - 1)
+                yi = h00*t[k] + h10*h*d[k] + h01*t[k + 1] + h11*h*d[k + 1]
+            # a key point is a key point, NA next door or not
+            y[inside] = np.where(exact, t[left], yi)
+
+        return float(y[0]) if scalar else y
+
+    def preview(self, start, stop, step=60, *, method='nearest'):
+        """Setpoints on a regular grid [start, stop) (POSIX seconds), for
+        plotting and for looking ahead. Returns (timestamps, values)."""
+        x = np.arange(start, stop, step, dtype=float)
+        return x, self.evaluate(x, method=method)
+
+    def _pchip_slopes(self):
+        if self._slopes is not None:
+            return self._slopes
+
+        ts, t = self.ts.astype(float), self.t
+        h = np.diff(ts)
+        delta = np.diff(t)/h    # NaN wherever an NA is involved
+        nan1 = np.full(1, float('nan'))
+        dl = np.concatenate([nan1, delta])     # slope of the segment on the left
+        dr = np.concatenate([delta, nan1])     # ... and on the right
+        hl = np.concatenate([nan1, h])
+        hr = np.concatenate([h, nan1])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Fritsch-Carlson: weighted harmonic mean if the two sides
+            # agree in sign, flat otherwise.
+            w1 = 2*hr + hl
+            w2 = hr + 2*hl
+            harmonic = (w1 + w2)/(w1/dl + w2/dr)
+        same_sign = dl*dr > 0
+        d = np.where(same_sign, harmonic, 0.)
+        # ends of the profile, and ends of runs bounded by NA: one-sided
+        d = np.where(np.isnan(dl) & ~np.isnan(dr), dr, d)
+        d = np.where(np.isnan(dr) & ~np.isnan(dl), dl, d)
+        d = np.where(np.isnan(dl) & np.isnan(dr), float('nan'), d)
+        self._slopes = d
+        return d